@@ -0,0 +1,221 @@
+import logging
+import os
+import numpy as np
+from compare.index import compare_index
+from compare.search import euclidean_distances, rank
+from compare.trees import SharedCompareModel
+from wine_api.resources import SharedResource
+from wine_api.settings import BASE_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+def nearest_centroids(vectors, centroids, chunk_size=65536):
+    """
+    Index of the nearest centroid of every vector
+    :param vectors: array of shape (n, n_features)
+    :param centroids: array of shape (n_lists, n_features)
+    :param chunk_size: number of vectors compared at once
+    :return: array of shape (n,)
+    """
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float64)
+        # Squared distances without the norm of the vectors, which does not change the argmin
+        assignments[start:start + chunk_size] = np.argmin(centroid_norms - 2 * chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def kmeans(vectors, n_lists, n_iter=10, sample_size=None, seed=0):
+    """
+    Centroids of the vectors with Lloyd's algorithm on a sample
+    :param vectors: array of shape (n, n_features)
+    :param n_lists: number of centroids
+    :param n_iter: number of iterations
+    :param sample_size: number of vectors the centroids are trained on, 256 per centroid by default
+    :param seed:
+    :return: array of shape (n_lists, n_features)
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or n_lists * 256)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float64)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = nearest_centroids(sample, centroids)
+        counts = np.bincount(assignments, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        # Move the empty centroids to random vectors of the sample
+        centroids[~non_empty] = sample[rng.choice(len(sample), int((~non_empty).sum()), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index: the vectors are partitioned by their nearest centroid,
+    and a query only compares the vectors of the lists of its n_probe nearest centroids.
+    query and get_arrays follow the sklearn trees, so the index can replace a tree of CompareModel.
+    """
+
+    def __init__(self, vectors, centroids, order, offsets, n_probe, fingerprint=None):
+        """
+        Constructor
+        :param vectors: array of shape (n, n_features), in the order of the rows of the dataset
+        :param centroids: array of shape (n_lists, n_features)
+        :param order: rows of the vectors sorted by list
+        :param offsets: array of shape (n_lists + 1,), the rows of list i are order[offsets[i]:offsets[i + 1]]
+        :param n_probe: number of lists compared by a query
+        :param fingerprint: fingerprint of the dataset files the index was built from
+        """
+        self.vectors = vectors
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.n_probe = n_probe
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, n_probe=8, n_iter=10, seed=0, fingerprint=None):
+        """
+        Build the index of vectors
+        :param vectors: array of shape (n, n_features)
+        :param n_lists: number of lists, sqrt(n) by default
+        :param n_probe: number of lists compared by a query
+        :param n_iter: number of iterations of k-means
+        :param seed:
+        :param fingerprint: fingerprint of the dataset files of the vectors
+        :return:
+        """
+        n_lists = min(len(vectors), n_lists or max(1, int(np.sqrt(len(vectors)))))
+        centroids = kmeans(vectors, n_lists, n_iter=n_iter, seed=seed)
+        assignments = nearest_centroids(vectors, centroids)
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.r_[0, np.cumsum(np.bincount(assignments, minlength=n_lists))].astype(np.int64)
+        return cls(vectors, centroids, order, offsets, n_probe, fingerprint=fingerprint)
+
+    @classmethod
+    def exact(cls, vectors):
+        """
+        Index of a single list, every vector is compared by a query
+        :param vectors: array of shape (n, n_features)
+        :return:
+        """
+        centroids = np.zeros((1, vectors.shape[1]))
+        return cls(vectors, centroids, np.arange(len(vectors), dtype=np.int64),
+                   np.array([0, len(vectors)], dtype=np.int64), n_probe=1)
+
+    def save(self, path):
+        # Write to a temporary file so the workers never read a partial file
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets, n_probe=self.n_probe,
+                     fingerprint=self.fingerprint or '')
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, path, vectors):
+        """
+        Load an index saved by save, on the vectors it was built from
+        :param path:
+        :param vectors:
+        :return:
+        """
+        with np.load(path) as arrays:
+            fingerprint = str(arrays['fingerprint']) if 'fingerprint' in arrays.files else None
+            return cls(vectors, arrays['centroids'], arrays['order'], arrays['offsets'], int(arrays['n_probe']),
+                       fingerprint=fingerprint or None)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def get_arrays(self):
+        return (self.vectors,)
+
+    def get_candidates(self, query, k, n_probe=None):
+        """
+        Rows of the lists of the nearest centroids of a query, with at least k rows
+        :param query: array of shape (n_features,)
+        :param k:
+        :param n_probe: number of lists, self.n_probe by default
+        :return: array of rows
+        """
+        n_probe = n_probe or self.n_probe
+        lists = np.argsort(euclidean_distances(query[None], self.centroids), kind='stable')
+        sizes = self.offsets[lists + 1] - self.offsets[lists]
+        # Probe more lists when the nearest ones hold less than k rows
+        n_probe = max(n_probe, int(np.searchsorted(np.cumsum(sizes), min(k, len(self))) + 1))
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists[:n_probe]])
+
+    def query(self, X, k=1, n_probe=None):
+        """
+        Approximate k nearest neighbors of every row of X
+        :param X: array of shape (n_queries, n_features)
+        :param k:
+        :param n_probe: number of lists, self.n_probe by default
+        :return: tuple of distances, indices, both of shape (n_queries, k) and sorted by distance
+        """
+        X = np.asarray(X, dtype=np.float64)
+        k = min(k, len(self))
+        all_distances = np.empty((len(X), k))
+        all_indices = np.empty((len(X), k), dtype=np.int64)
+        for i, query in enumerate(X):
+            rows = self.get_candidates(query, k, n_probe=n_probe)
+            distances = euclidean_distances(query[None], self.vectors[rows])
+            top = rank(distances, rows, k)
+            all_distances[i] = distances[top]
+            all_indices[i] = rows[top]
+        return all_distances, all_indices
+
+
+class CompareANN(SharedResource):
+    """
+    Approximate index of the compare dataset written by the build_ann_index command.
+    It replaces the composition and weather tree of the compare model for the requests with search=approx.
+    search_top_k only queries that tree for candidates and computes their text review distances exactly,
+    so the text review side is a single list over the vectors and is not built.
+    """
+
+    name = 'compare approximate index'
+
+    def __init__(self, path_composition_weather_index):
+        # The index is reloaded with the vectors of the compare index when it switches to a new version
+        super().__init__(path_composition_weather_index, *compare_index.paths, watch=True)
+
+    def load(self):
+        """
+        Load the approximate index of the current version of the compare index
+        :return: tuple of CompareIndexVersion, SharedCompareModel or None if it is not built or outdated
+        """
+        path_composition_weather_index = self.paths[0]
+        index = compare_index.get()
+        if not os.path.exists(path_composition_weather_index):
+            return index, None
+        compare_data = index.compare_data
+        composition_weather_index = IVFIndex.load(path_composition_weather_index,
+                                                  compare_data.composition_weather.vectors)
+        if composition_weather_index.fingerprint != index.fingerprint or \
+                len(composition_weather_index.order) != len(composition_weather_index.vectors):
+            logger.warning('The approximate index is outdated, run build_ann_index again')
+            return index, None
+        return index, SharedCompareModel(wine_composition_weather_tree=composition_weather_index,
+                                         wine_text_review_tree=IVFIndex.exact(compare_data.text_review.vectors))
+
+    def get_compare_model(self, index):
+        """
+        Return the compare model on the approximate index, None if it is not built or outdated
+        :param index: CompareIndexVersion searched by the caller
+        :return:
+        """
+        loaded_index, compare_model = self.get()
+        if loaded_index is not index:
+            # Built on another version of the compare index
+            return None
+        return compare_model
+
+
+compare_ann = CompareANN(
+    path_composition_weather_index=f'{BASE_DIR}/compare_data/ann_composition_weather.npz',
+)
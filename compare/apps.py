@@ -1,6 +1,25 @@
+import logging
 from django.apps import AppConfig
 
 
+logger = logging.getLogger(__name__)
+
+
 class CompareConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'compare'
+
+    def preload(self):
+        """
+        Load the models and datasets before the first request, called by wsgi.py in the serving processes only
+        :return:
+        """
+        from compare.index import compare_index
+        from compare.neighbors import precomputed_neighbors
+        from compare.ann import compare_ann
+        for resource in [compare_index, precomputed_neighbors, compare_ann]:
+            try:
+                resource.get()
+            except (OSError, IOError) as e:
+                # The resource will be loaded on the first request instead
+                logger.warning(f'Could not preload the {resource.name}: {e}')
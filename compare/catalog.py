@@ -0,0 +1,108 @@
+import uuid
+import numpy as np
+from django.core.cache import cache
+from compare.index import compare_index
+from wine.models import Wine
+from wine_api.resources import SharedResource
+
+
+CATALOG_VERSION_KEY = 'compare_catalog_version'
+
+
+class WineCatalog:
+    """
+    Type, region, ABV, body and acidity of the wine of every row of normalized_wine_data,
+    to filter the neighbors with boolean masks
+    """
+
+    def __init__(self, compare_data, wine_catalog):
+        """
+        Constructor
+        :param compare_data: CompareData the rows are aligned with
+        :param wine_catalog: list of tuples of WineID, type, region id, ABV, body, acidity,
+        the first one of a WineID is kept
+        """
+        self.compare_data = compare_data
+        wines = {}
+        for wine_id, *attributes in wine_catalog:
+            wines.setdefault(wine_id, attributes)
+        self.type_codes = {}
+        types = []
+        rows = [wines.get(wine_id, [None] * 5) for wine_id in compare_data.composition_weather.keys['WineID'].tolist()]
+        for wine_type, _, _, _, _ in rows:
+            types.append(self.type_codes.setdefault(wine_type, len(self.type_codes)) if wine_type is not None else -1)
+        self.types = np.array(types, dtype=np.int32)
+        self.region_ids = np.array([row[1] if row[1] is not None else -1 for row in rows], dtype=np.int64)
+        self.abv = np.array([row[2] if row[2] is not None else np.nan for row in rows], dtype=np.float64)
+        self.body = np.array([row[3] for row in rows], dtype=object)
+        self.acidity = np.array([row[4] for row in rows], dtype=object)
+
+    def get_mask(self, wine_type=None, region_id=None):
+        """
+        Get the rows of normalized_wine_data matching the filters
+        :param wine_type: type of the wine, e.g. Red
+        :param region_id: id of the region in the DB
+        :return: boolean array, None without filters
+        """
+        if wine_type is None and region_id is None:
+            return None
+        mask = np.ones(len(self.types), dtype=bool)
+        if wine_type is not None:
+            mask &= self.types == self.type_codes.get(wine_type, -2)
+        if region_id is not None:
+            mask &= self.region_ids == region_id
+        return mask
+
+
+class CompareCatalog(SharedResource):
+    """
+    Catalog of the wines of the compare dataset, read from the DB once.
+    It is loaded again when the compare dataset changes, or when a wine of the dataset is changed:
+    the wine endpoints invalidate it for every worker through a random version in the cache.
+    """
+
+    name = 'compare catalog'
+
+    def __init__(self):
+        super().__init__(watch=True)
+        self.version = None
+
+    def get_version(self):
+        return cache.get(CATALOG_VERSION_KEY)
+
+    def load(self):
+        # The version is read before the DB, so a wine changed during the load invalidates the catalog again
+        self.version = self.get_version()
+        return WineCatalog(compare_index.get().compare_data, Wine.objects.get_wine_catalog())
+
+    def has_changed(self):
+        return self._value.compare_data is not compare_index.get().compare_data or \
+            self.version != self.get_version()
+
+    def invalidate(self):
+        """
+        Load the catalog again in every worker, on its next use
+        :return:
+        """
+        # A new random version rather than a counter, which could not be incremented once evicted
+        cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+    def get_catalog(self, compare_data):
+        """
+        Return the catalog aligned with the rows of a compare dataset
+        :param compare_data: CompareData of the version searched by the request
+        :return: WineCatalog
+        """
+        catalog = self.get()
+        if catalog.compare_data is not compare_data:
+            # The compare index switched to a new version during the request
+            return WineCatalog(compare_data, Wine.objects.get_wine_catalog())
+        return catalog
+
+    def get_mask(self, compare_data, wine_type=None, region_id=None):
+        if wine_type is None and region_id is None:
+            return None
+        return self.get_catalog(compare_data).get_mask(wine_type=wine_type, region_id=region_id)
+
+
+compare_catalog = CompareCatalog()
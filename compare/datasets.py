@@ -0,0 +1,239 @@
+import os
+import numpy as np
+import pandas as pd
+from likewines.processor import CompareDataProcessor
+from wine_api.indexes import GroupedArrays
+
+
+# Columns of the datasets which are not features
+NORMALIZED_KEY_COLUMNS = ['WineID', 'Vintage', 'WineName']
+DOC_VECTOR_KEY_COLUMNS = ['WineID', 'Vintage']
+
+
+class WineVectors:
+    """
+    Keys and feature vectors of a dataframe indexed by WineID and Vintage.
+    The vectors are a read-only float array aligned with the rows of the keys,
+    either in memory or memory-mapped from a .npy file.
+    """
+
+    def __init__(self, keys, vectors, columns=None):
+        """
+        Constructor
+        :param keys: dataframe with WineID and Vintage columns
+        :param vectors: array of shape (len(keys), n_features)
+        :param columns: names of the features
+        """
+        self.keys = keys.reset_index(drop=True)
+        self.vectors = vectors
+        self.columns = columns
+        if self.vectors.flags.writeable:
+            self.vectors.setflags(write=False)
+        self.rows = {}
+        for row, key in enumerate(zip(self.keys['WineID'].tolist(), self.keys['Vintage'].tolist())):
+            # Same row as the first match of a filter on WineID and Vintage
+            self.rows.setdefault(key, row)
+
+    @classmethod
+    def from_df(cls, df, key_columns: list):
+        """
+        Split a dataframe into its keys and its feature vectors
+        :param df: dataframe with WineID and Vintage columns
+        :param key_columns: columns which are not features
+        :return:
+        """
+        features = df.drop(key_columns, axis=1)
+        vectors = np.ascontiguousarray(features.to_numpy(dtype=np.float64))
+        return cls(df[key_columns], vectors, columns=features.columns.tolist())
+
+    @classmethod
+    def from_files(cls, path_keys, path_vectors, columns=None):
+        """
+        Load the keys written by convert_compare_data and memory-map the vectors
+        :param path_keys: parquet file of the keys
+        :param path_vectors: .npy file of the vectors
+        :param columns: names of the features
+        :return:
+        """
+        return cls(pd.read_parquet(path_keys), np.load(path_vectors, mmap_mode='r'), columns=columns)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def get_vector(self, wine_id, vintage):
+        """
+        Get the feature vector of a wine vintage
+        :param wine_id: Identifier of the wine from X-Wines dataset
+        :param vintage:
+        :return: read-only array of shape (1, n_features), None if the wine vintage is missing
+        """
+        row = self.rows.get((wine_id, vintage))
+        if row is None:
+            return None
+        return self.vectors[row:row + 1]
+
+
+class CompareData:
+    """
+    Datasets of the compare model, loaded once
+    """
+
+    def __init__(self, pertinent_wine_ratings, normalized_wine_data, pertinent_ratings_non_null,
+                 aggregated_doc_vector):
+        """
+        Constructor
+        :param pertinent_wine_ratings: dataframe of the wine vintages which can be compared
+        :param normalized_wine_data: WineVectors of the composition and weather features
+        :param pertinent_ratings_non_null: dataframe of the wine vintages with a text review
+        :param aggregated_doc_vector: WineVectors of the text review vectors
+        """
+        self.pertinent_wine_ratings = pertinent_wine_ratings
+        # Sorted unique vintages of every WineID
+        self.vintages = GroupedArrays(
+            pertinent_wine_ratings[['WineID', 'Vintage']].drop_duplicates().sort_values('Vintage', kind='stable'),
+            key='WineID', columns=['Vintage'])
+        self.pertinent_keys = set(zip(pertinent_wine_ratings['WineID'].tolist(),
+                                      pertinent_wine_ratings['Vintage'].tolist()))
+        self.reviewed_keys = set(zip(pertinent_ratings_non_null['WineID'].tolist(),
+                                     pertinent_ratings_non_null['Vintage'].tolist()))
+        self.composition_weather = normalized_wine_data
+        self.text_review = aggregated_doc_vector
+        # Row of the text review vector of every row of normalized_wine_data, -1 without text review
+        self.text_rows = np.array([self.text_review.rows.get(key, -1) for key in zip(
+            self.composition_weather.keys['WineID'].tolist(), self.composition_weather.keys['Vintage'].tolist())],
+            dtype=np.int64)
+        self.text_rows.setflags(write=False)
+
+    def get_vintages(self, wine_id):
+        """
+        Get the vintages of a wine which can be compared
+        :param wine_id: Identifier of the wine from X-Wines dataset
+        :return: sorted read-only array, empty if the wine is missing
+        """
+        return self.vintages.get(wine_id, 'Vintage')
+
+    def get_inputs(self, wine_id, vintage):
+        """
+        Get the inputs of the trees for a wine vintage
+        :param wine_id: Identifier of the wine from X-Wines dataset
+        :param vintage:
+        :return: tuple of input_wine_composition_and_weather, input_wine_text_review
+        """
+        input_wine_composition_and_weather = self.composition_weather.get_vector(wine_id, vintage)
+        if (wine_id, vintage) in self.reviewed_keys:
+            # There is at least one text review
+            input_wine_text_review = self.text_review.get_vector(wine_id, vintage)
+        else:
+            # There is no text review
+            input_wine_text_review = None
+        return input_wine_composition_and_weather, input_wine_text_review
+
+
+def read_columns(path):
+    """
+    Names of the columns of a parquet or csv file, without reading the rows
+    :param path:
+    :return:
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path, nrows=0).columns.tolist()
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        # Another parquet engine, read the whole file
+        return pd.read_parquet(path).columns.tolist()
+    return pq.read_schema(path).names
+
+
+def get_binary_paths(path):
+    """
+    Paths of the keys and of the vectors written by convert_compare_data for a dataset file
+    :param path: parquet or csv file
+    :return: tuple of path_keys, path_vectors
+    """
+    root = os.path.splitext(path)[0]
+    return f'{root}_keys.parquet', f'{root}.npy'
+
+
+def load_vectors(path, read, key_columns, binary=True):
+    """
+    Load the vectors of a dataset, from its binary files when they are newer than the dataset
+    :param path: parquet or csv file
+    :param read: function reading the file into a dataframe
+    :param key_columns: columns which are not features
+    :param binary: use the binary files when they are up to date
+    :return: WineVectors
+    """
+    path_keys, path_vectors = get_binary_paths(path)
+    if binary and os.path.exists(path_keys) and os.path.exists(path_vectors) and \
+            min(os.path.getmtime(path_keys), os.path.getmtime(path_vectors)) >= os.path.getmtime(path):
+        # Only the header of the dataset is read, for the names of the features
+        columns = [column for column in read_columns(path)
+                   if column not in key_columns and not column.startswith('__index_level_')]
+        return WineVectors.from_files(path_keys, path_vectors, columns=columns)
+    return WineVectors.from_df(read(path), key_columns)
+
+
+def write_binary_files(wine_vectors, path):
+    """
+    Write the keys and the vectors of a dataset to the binary files which the workers memory-map
+    :param wine_vectors: WineVectors of the dataset
+    :param path: parquet or csv file of the dataset
+    :return:
+    """
+    path_keys, path_vectors = get_binary_paths(path)
+    # Write to temporary files so the workers never map a partial file
+    wine_vectors.keys.to_parquet(f'{path_keys}.tmp', index=False)
+    with open(f'{path_vectors}.tmp', 'wb') as f:
+        np.save(f, wine_vectors.vectors)
+    os.replace(f'{path_keys}.tmp', path_keys)
+    os.replace(f'{path_vectors}.tmp', path_vectors)
+
+
+def load_compare_data(path_pertinent_wine_ratings, path_normalized_wine_data, path_pertinent_ratings_non_null,
+                      path_aggregated_doc_vector):
+    """
+    Load the datasets of the compare model.
+    The feature vectors are memory-mapped from the .npy files written by convert_compare_data when they are
+    up to date, so the workers share their pages through the page cache.
+    :return: CompareData
+    """
+    return CompareData(
+        pertinent_wine_ratings=pd.read_parquet(path_pertinent_wine_ratings, columns=['WineID', 'Vintage']),
+        normalized_wine_data=load_vectors(path_normalized_wine_data, pd.read_parquet, NORMALIZED_KEY_COLUMNS),
+        pertinent_ratings_non_null=pd.read_parquet(path_pertinent_ratings_non_null, columns=['WineID', 'Vintage']),
+        aggregated_doc_vector=load_vectors(path_aggregated_doc_vector, pd.read_csv, DOC_VECTOR_KEY_COLUMNS),
+    )
+
+
+class SharedCompareDataProcessor(CompareDataProcessor):
+    """
+    CompareDataProcessor reading the shared compare dataset instead of the files.
+    normalized_wine_data and aggregated_doc_vector only hold the key columns,
+    the features stay in the shared read-only arrays.
+    """
+
+    def __init__(self, compare_data):
+        """
+        Constructor
+        :param compare_data: CompareData of the compare index
+        """
+        # The files are not read again, so the constructor of the parent is not called
+        self.data = compare_data
+        self.pertinent_wine_ratings = self.data.pertinent_wine_ratings
+        self.normalized_wine_data = self.data.composition_weather.keys
+        self.aggregated_doc_vector = self.data.text_review.keys
+
+    def process_data(self, wine_id: int, vintage: int):
+        """
+        Process the data
+        :param wine_id: Identifier of the wine from X-Wines dataset
+        :param vintage:
+        :return: tuple of input_wine_composition_and_weather, input_wine_text_review
+        """
+        if (wine_id, vintage) not in self.data.pertinent_keys:
+            raise Exception('wine_id and vintage must be valid')
+        return self.data.get_inputs(wine_id, vintage)
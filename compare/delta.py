@@ -0,0 +1,324 @@
+import logging
+import threading
+import uuid
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+from compare.catalog import compare_catalog
+from compare.index import compare_index
+from compare.models import DeltaEntry, DeltaTombstone
+from compare.search import euclidean_distances, select
+from wine.models import Wine
+
+
+logger = logging.getLogger(__name__)
+
+DELTA_VERSION_KEY = 'compare_delta_version'
+
+# Features set from the wine itself, with the attribute of the wine and of the catalog
+WINE_FEATURES = {'abv': 'abv', 'body': 'body', 'acidity': 'acidity'}
+
+
+def get_compare_wine_id(wine):
+    """
+    Identifier of a wine in the compare indexes: its WineID, or minus its id for the wines created without WineID
+    :param wine:
+    :return:
+    """
+    return wine.wine_id if wine.wine_id is not None else -wine.id
+
+
+def map_feature(catalog_values, features, value):
+    """
+    Normalized feature of a wine attribute, fitted on the wines of the compare dataset.
+    Numbers are mapped with a linear fit, the same as a min-max or a standard scaling,
+    categories with the mean feature of the wines of the category.
+    :param catalog_values: attribute of the wine of every row of the dataset
+    :param features: feature of every row of the dataset
+    :param value: attribute of the wine
+    :return: None if it cannot be fitted
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        values = catalog_values.astype(np.float64)
+        known = np.isfinite(values)
+        if len(np.unique(values[known])) < 2:
+            return None
+        slope, intercept = np.polyfit(values[known], features[known], 1)
+        return float(slope * value + intercept)
+    matches = catalog_values == value
+    if not np.any(matches):
+        return None
+    return float(features[matches].mean())
+
+
+def build_vectors(wine, compare_data, catalog):
+    """
+    Feature vectors of the vintages of a wine.
+    They are copied from the rows of its WineID when it is in the compare dataset,
+    otherwise they are the mean of the rows of its region by vintage.
+    The ABV, body and acidity features are then set from the wine.
+    :param wine:
+    :param compare_data: CompareData
+    :param catalog: WineCatalog
+    :return: dict of vintage: tuple of vector, text review vector or None
+    """
+    composition_weather = compare_data.composition_weather
+    keys = composition_weather.keys
+    vintages = keys['Vintage'].to_numpy()
+    vectors = {}
+    rows = np.flatnonzero(keys['WineID'].to_numpy() == wine.wine_id) if wine.wine_id is not None else []
+    if len(rows):
+        for row in rows.tolist():
+            key = (wine.wine_id, int(vintages[row]))
+            if key[1] not in vectors:
+                text_vector = compare_data.text_review.get_vector(*key) if key in compare_data.reviewed_keys else None
+                vectors[key[1]] = (np.array(composition_weather.vectors[row]),
+                                   np.array(text_vector[0]) if text_vector is not None else None)
+    else:
+        rows = np.flatnonzero(catalog.region_ids == wine.region_id)
+        for vintage in np.unique(vintages[rows]).tolist():
+            vintage_rows = rows[vintages[rows] == vintage]
+            vectors[int(vintage)] = (np.asarray(composition_weather.vectors[vintage_rows]).mean(axis=0), None)
+
+    columns = [column.lower() for column in composition_weather.columns or []]
+    for column, attribute in WINE_FEATURES.items():
+        if column not in columns:
+            continue
+        index = columns.index(column)
+        value = map_feature(getattr(catalog, attribute), np.asarray(composition_weather.vectors[:, index]),
+                            getattr(wine, attribute))
+        if value is None:
+            continue
+        for vector, _ in vectors.values():
+            vector[index] = value
+    return vectors
+
+
+class DeltaIndex:
+    """
+    Wines created or changed since the compare dataset was built, searched by brute force next to the trees.
+    The rows of the dataset of a changed wine are masked by tombstones.
+    """
+
+    def __init__(self, compare_data, buffer, version):
+        """
+        Constructor
+        :param compare_data: CompareData the tombstones are aligned with
+        :param buffer: dict of entries and tombstoned wine_ids
+        :param version: version of the buffer
+        """
+        self.compare_data = compare_data
+        self.version = version
+        entries = buffer.get('entries', [])
+        self.keys = [(entry['compare_id'], entry['vintage']) for entry in entries]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.ids = [entry['id'] for entry in entries]
+        self.types = np.array([entry['type'] for entry in entries], dtype=object)
+        self.region_ids = np.array([entry['region_id'] for entry in entries], dtype=object)
+        self.vectors = np.array([entry['vector'] for entry in entries], dtype=np.float64).reshape(
+            len(entries), compare_data.composition_weather.vectors.shape[1])
+        self.have_text_review = np.array([entry['text_vector'] is not None for entry in entries], dtype=bool)
+        self.text_vectors = np.zeros((len(entries), compare_data.text_review.vectors.shape[1]))
+        for row, entry in enumerate(entries):
+            if entry['text_vector'] is not None:
+                self.text_vectors[row] = entry['text_vector']
+        wine_ids = buffer.get('wine_ids', [])
+        self.tombstones = np.isin(compare_data.composition_weather.keys['WineID'].to_numpy(), wine_ids) \
+            if wine_ids else None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def get_inputs(self, compare_id, vintage):
+        """
+        Get the inputs of the search for a wine vintage of the delta
+        :param compare_id:
+        :param vintage:
+        :return: tuple of input_wine_composition_and_weather, input_wine_text_review
+        """
+        row = self.rows[(compare_id, vintage)]
+        return self.vectors[row:row + 1], self.text_vectors[row:row + 1] if self.have_text_review[row] else None
+
+    def get_vintages(self, compare_id):
+        return sorted(vintage for key_compare_id, vintage in self.keys if key_compare_id == compare_id)
+
+    def get_mask(self, wine_type=None, region_id=None):
+        """
+        Get the entries matching the filters
+        :param wine_type:
+        :param region_id: id of the region in the DB
+        :return: boolean array, None without filters
+        """
+        if wine_type is None and region_id is None:
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        if wine_type is not None:
+            mask &= self.types == wine_type
+        if region_id is not None:
+            mask &= self.region_ids == region_id
+        return mask
+
+    def get_main_mask(self, mask=None):
+        """
+        Mask of the rows of the compare dataset, without the rows replaced by the delta
+        :param mask: mask of the filters, None without filters
+        :return: boolean array, None to allow every row
+        """
+        if self.tombstones is None:
+            return mask
+        if mask is None:
+            return ~self.tombstones
+        return mask & ~self.tombstones
+
+    def search(self, input_wine_composition_and_weather, input_wine_text_review, k, mask=None, max_distance=None):
+        """
+        Get the k entries with the smallest distance, computed like the distances of search_top_k
+        :param input_wine_composition_and_weather:
+        :param input_wine_text_review:
+        :param k:
+        :param mask: boolean array over the entries, None to allow every entry
+        :param max_distance: maximum distance, None for no maximum
+        :return: tuple of rows of the entries, distances, both sorted by distance
+        """
+        distances = euclidean_distances(input_wine_composition_and_weather, self.vectors)
+        if input_wine_text_review is not None:
+            distances[self.have_text_review] += euclidean_distances(input_wine_text_review,
+                                                                    self.text_vectors[self.have_text_review])
+        rows = np.arange(len(self))
+        top = select(rows, distances, k, mask=mask, max_distance=max_distance)
+        return rows[top], distances[top]
+
+
+class CompareDelta:
+    """
+    Delta buffer of the compare indexes, stored in the DB with one row per wine vintage and per tombstone.
+    Only its version is kept in the cache, it tells the workers when to rebuild their local DeltaIndex,
+    and the compact_compare_index command merges the buffer into the compare dataset.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get_version(self):
+        """
+        Version of the delta buffer, replaced by a new one when the buffer changes.
+        A version evicted from the cache is replaced too, so a worker never keeps an outdated index.
+        :return:
+        """
+        version = cache.get(DELTA_VERSION_KEY)
+        if version is None:
+            cache.add(DELTA_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(DELTA_VERSION_KEY)
+        return version
+
+    def get(self, version=None, compare_data=None):
+        """
+        Return the delta index of the current version
+        :param version: version read by the caller, read from the cache if None
+        :param compare_data: CompareData searched by the caller, the current compare index if None
+        :return: DeltaIndex
+        """
+        version = self.get_version() if version is None else version
+        compare_data = compare_index.get().compare_data if compare_data is None else compare_data
+        index = self._index
+        if index is None or index.version != version or index.compare_data is not compare_data:
+            with self._lock:
+                index = DeltaIndex(compare_data, self.read(), version)
+                self._index = index
+        return index
+
+    def update_wine(self, wine):
+        """
+        Add a created or changed wine to the delta buffer, replacing its previous entries
+        :param wine:
+        :return: number of vintages added
+        """
+        compare_data = compare_index.get().compare_data
+        vectors = build_vectors(wine, compare_data, compare_catalog.get_catalog(compare_data))
+        compare_id = get_compare_wine_id(wine)
+        new_entries = [{
+            'id': wine.id,
+            'wine_id': wine.wine_id,
+            'vintage': vintage,
+            'type': wine.type,
+            'region_id': wine.region_id,
+            'vector': vector.tolist(),
+            'text_vector': text_vector.tolist() if text_vector is not None else None,
+        } for vintage, (vector, text_vector) in vectors.items()]
+        in_dataset = wine.wine_id is not None and wine.wine_id in set(
+            compare_data.composition_weather.keys['WineID'].tolist())
+
+        with transaction.atomic():
+            # The changes of a wine are written one after the other, through the lock of its row
+            Wine.objects.select_for_update().filter(id=wine.id).first()
+            DeltaEntry.objects.replace_entries(compare_id, new_entries)
+            if in_dataset:
+                DeltaTombstone.objects.get_or_create(wine_id=wine.wine_id)
+            transaction.on_commit(self._new_version)
+        return len(new_entries)
+
+    def remove_wine(self, wine):
+        """
+        Remove a deleted wine from the delta buffer, and hide its rows of the compare dataset
+        :param wine: wine deleted in the same transaction
+        :return:
+        """
+        with transaction.atomic():
+            DeltaEntry.objects.replace_entries(get_compare_wine_id(wine), [])
+            if wine.wine_id is not None:
+                DeltaTombstone.objects.get_or_create(wine_id=wine.wine_id)
+            transaction.on_commit(self._new_version)
+
+    def read(self):
+        """
+        Read the delta buffer
+        :return: dict of entries and tombstoned wine_ids
+        """
+        return {'entries': DeltaEntry.objects.get_entries(), 'wine_ids': DeltaTombstone.objects.get_wine_ids()}
+
+    def remove(self, entries, wine_ids=None):
+        """
+        Remove the entries merged into the compare dataset, the wines changed again since are kept
+        :param entries: entries read from the buffer
+        :param wine_ids: tombstoned wine_ids read from the buffer, None for every tombstone
+        :return:
+        """
+        with transaction.atomic():
+            DeltaEntry.objects.filter(id__in=[entry['pk'] for entry in entries]).delete()
+            # The rows of the compare dataset of a wine still in the buffer stay tombstoned,
+            # like the wines deleted after the buffer was read
+            tombstones = DeltaTombstone.objects.exclude(wine_id__in=DeltaEntry.objects.values('compare_id'))
+            if wine_ids is not None:
+                tombstones = tombstones.filter(wine_id__in=wine_ids)
+            tombstones.delete()
+            transaction.on_commit(self._new_version)
+
+    @staticmethod
+    def _new_version():
+        cache.set(DELTA_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+compare_delta = CompareDelta()
+
+
+def update_compare_index(wine):
+    """
+    Make a created or changed wine searchable by compare_wine, without failing the request
+    :param wine:
+    :return:
+    """
+    try:
+        if wine.wine_id is not None:
+            # The catalog holds the type and the region of the wines of the compare dataset
+            compare_catalog.invalidate()
+        nb_vintages = compare_delta.update_wine(wine)
+        cache.delete(f'list_vintages_{wine.id}')
+        logger.info(f'Added {nb_vintages} vintages of the wine {wine.id} to the compare delta')
+    except Exception:
+        logger.exception(f'Could not add the wine {wine.id} to the compare delta')
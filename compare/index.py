@@ -0,0 +1,155 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from compare.datasets import get_binary_paths, load_compare_data
+from compare.trees import load_compare_model
+from wine_api.resources import SharedResource
+from wine_api.settings import BASE_DIR
+
+
+logger = logging.getLogger(__name__)
+
+DATASET_FILES = ['pertinent_wine_ratings.parquet', 'normalized_wine_data.parquet',
+                 'pertinent_ratings_non_null.parquet', 'aggregated_doc_vector.csv']
+TREE_FILES = ['wine_composition_weather_tree.joblib', 'wine_text_review_tree.joblib']
+
+
+class CompareIndexFiles:
+    """
+    Files of one version of the compare index: the compare datasets, their binary files and the trees
+    """
+
+    def __init__(self, version, dataset_paths, tree_paths):
+        """
+        Constructor
+        :param version: name of the version directory, None for the files outside of the version directories
+        :param dataset_paths: paths of pertinent_wine_ratings, normalized_wine_data, pertinent_ratings_non_null
+        and aggregated_doc_vector
+        :param tree_paths: paths of the composition and weather tree and of the text review tree
+        """
+        self.version = version
+        self.dataset_paths = dataset_paths
+        self.tree_paths = tree_paths
+
+    @classmethod
+    def in_directory(cls, version, directory):
+        return cls(version, [os.path.join(directory, name) for name in DATASET_FILES],
+                   [os.path.join(directory, name) for name in TREE_FILES])
+
+    @property
+    def binary_paths(self):
+        return [*get_binary_paths(self.dataset_paths[1]), *get_binary_paths(self.dataset_paths[3])]
+
+    @property
+    def paths(self):
+        return self.dataset_paths + self.binary_paths + self.tree_paths
+
+    def get_fingerprint(self):
+        """
+        Fingerprint of the files, saved with the neighbors table and the approximate index computed from them
+        :return:
+        """
+        values = [(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in self.paths]
+        return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:16]
+
+
+class CompareIndexVersion:
+    """
+    Compare datasets and trees loaded from the files of the same version
+    """
+
+    def __init__(self, files, compare_data, compare_model, fingerprint):
+        """
+        Constructor
+        :param files: CompareIndexFiles
+        :param compare_data: CompareData
+        :param compare_model: SharedCompareModel on the trees
+        :param fingerprint: fingerprint of the files
+        """
+        self.files = files
+        self.compare_data = compare_data
+        self.compare_model = compare_model
+        self.fingerprint = fingerprint
+
+    @property
+    def version(self):
+        return self.files.version
+
+
+class CompareIndex(SharedResource):
+    """
+    Compare datasets and trees shared by the requests of a process, loaded together as one version.
+    compact_compare_index writes every file of a new version into its own directory, then switches the
+    manifest to it with an atomic rename: a worker never mixes the files of two versions.
+    Without manifest, the files of compare_data and of model are loaded.
+    """
+
+    name = 'compare index'
+
+    def __init__(self, path_manifest, path_versions, base_files):
+        """
+        Constructor
+        :param path_manifest: JSON file of the current version
+        :param path_versions: directory of the version directories
+        :param base_files: CompareIndexFiles loaded without manifest
+        """
+        super().__init__(path_manifest, *base_files.paths, watch=True)
+        self.path_manifest = path_manifest
+        self.path_versions = path_versions
+        self.base_files = base_files
+
+    def get_files(self):
+        """
+        Files of the current version
+        :return: CompareIndexFiles
+        """
+        if not os.path.exists(self.path_manifest):
+            return self.base_files
+        with open(self.path_manifest) as f:
+            version = json.load(f)['version']
+        return CompareIndexFiles.in_directory(version, os.path.join(self.path_versions, version))
+
+    def load(self):
+        files = self.get_files()
+        return CompareIndexVersion(files, compare_data=load_compare_data(*files.dataset_paths),
+                                   compare_model=load_compare_model(*files.tree_paths),
+                                   fingerprint=files.get_fingerprint())
+
+    def new_files(self):
+        """
+        Create the directory of a new version, which is not loaded until it is published
+        :return: CompareIndexFiles
+        """
+        # Sorted by creation time
+        now = time.time_ns()
+        version = f'{time.strftime("%Y%m%d_%H%M%S", time.gmtime(now // 10 ** 9))}_{now % 10 ** 9:09d}'
+        directory = os.path.join(self.path_versions, version)
+        os.makedirs(directory)
+        return CompareIndexFiles.in_directory(version, directory)
+
+    def publish(self, files, keep=2):
+        """
+        Switch the workers to a new version, and remove the oldest versions
+        :param files: CompareIndexFiles of the new version, with all its files written
+        :param keep: number of versions kept, the previous ones are still read by the workers which did not switch
+        :return:
+        """
+        with open(f'{self.path_manifest}.tmp', 'w') as f:
+            json.dump({'version': files.version}, f)
+        os.replace(f'{self.path_manifest}.tmp', self.path_manifest)
+        versions = sorted(os.listdir(self.path_versions))
+        for version in versions[:-keep]:
+            if version != files.version:
+                shutil.rmtree(os.path.join(self.path_versions, version), ignore_errors=True)
+                logger.info(f'Removed the compare index version {version}')
+
+
+compare_index = CompareIndex(
+    path_manifest=f'{BASE_DIR}/compare_data/compare_index.json',
+    path_versions=f'{BASE_DIR}/compare_data/versions',
+    base_files=CompareIndexFiles(None, [f'{BASE_DIR}/compare_data/{name}' for name in DATASET_FILES],
+                                 [f'{BASE_DIR}/model/{name}' for name in TREE_FILES]),
+)
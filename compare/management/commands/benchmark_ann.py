@@ -0,0 +1,61 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from compare.ann import compare_ann
+from compare.index import compare_index
+from compare.search import search_top_k
+
+
+class Command(BaseCommand):
+    help = 'Compare the recall@k and the latency of the approximate index with the exact trees'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=200, help='Number of wine vintages queried')
+        parser.add_argument('--k', type=int, default=10, help='Number of neighbors')
+        parser.add_argument('--n-probes', type=str, default='1,2,4,8,16,32',
+                            help='Comma separated numbers of lists compared by a query')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        k = options['k']
+        compare_index_version = compare_index.get()
+        compare_data = compare_index_version.compare_data
+        exact_model = compare_index_version.compare_model
+        approx_model = compare_ann.get_compare_model(compare_index_version)
+        if approx_model is None:
+            self.stderr.write('The approximate index is missing or outdated, run build_ann_index first')
+            return
+        rng = np.random.default_rng(options['seed'])
+        keys = sorted(compare_data.pertinent_keys & set(compare_data.composition_weather.rows))
+        keys = [keys[i] for i in rng.choice(len(keys), min(options['queries'], len(keys)), replace=False)]
+        inputs = [compare_data.get_inputs(*key) for key in keys]
+
+        exact_results, exact_latencies = self.run(exact_model, compare_data, inputs, k)
+        self.stdout.write(f'{"search":>14} {"recall@k":>9} {"mean (ms)":>10} {"p95 (ms)":>10}')
+        self.write_row('exact', 1.0, exact_latencies)
+        index = approx_model.wine_composition_weather_tree
+        default_n_probe = index.n_probe
+        try:
+            for n_probe in [int(n_probe) for n_probe in options['n_probes'].split(',')]:
+                index.n_probe = n_probe
+                approx_results, approx_latencies = self.run(approx_model, compare_data, inputs, k)
+                recall = np.mean([len(set(exact_rows) & set(approx_rows)) / max(1, len(exact_rows))
+                                  for exact_rows, approx_rows in zip(exact_results, approx_results)])
+                self.write_row(f'approx n={n_probe}', recall, approx_latencies)
+        finally:
+            index.n_probe = default_n_probe
+
+    @staticmethod
+    def run(compare_model, compare_data, inputs, k):
+        results = []
+        latencies = []
+        for input_wine_composition_and_weather, input_wine_text_review in inputs:
+            start_time = time.perf_counter()
+            rows, _ = search_top_k(compare_model, compare_data, input_wine_composition_and_weather,
+                                   input_wine_text_review, k)
+            latencies.append(time.perf_counter() - start_time)
+            results.append(rows.tolist())
+        return results, np.array(latencies) * 1000
+
+    def write_row(self, name, recall, latencies):
+        self.stdout.write(f'{name:>14} {recall:>9.3f} {latencies.mean():>10.2f} {np.percentile(latencies, 95):>10.2f}')
@@ -0,0 +1,28 @@
+import time
+from django.core.management.base import BaseCommand
+from compare.ann import IVFIndex, compare_ann
+from compare.index import compare_index
+
+
+class Command(BaseCommand):
+    help = 'Build the approximate nearest neighbor index of the compare dataset for compare_wine?search=approx'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--n-lists', type=int, default=None,
+                            help='Number of lists of the index, the square root of the number of vectors by default')
+        parser.add_argument('--n-probe', type=int, default=8, help='Number of lists compared by a query')
+        parser.add_argument('--n-iter', type=int, default=10, help='Number of iterations of k-means')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # The text review distances of the candidates are computed exactly, only the composition side is indexed
+        start_time = time.perf_counter()
+        compare_index_version = compare_index.get()
+        vectors = compare_index_version.compare_data.composition_weather.vectors
+        path = compare_ann.paths[0]
+        index = IVFIndex.build(vectors, n_lists=options['n_lists'],
+                               n_probe=options['n_probe'], n_iter=options['n_iter'], seed=options['seed'],
+                               fingerprint=compare_index_version.fingerprint)
+        index.save(path)
+        self.stdout.write(f'{path}: {len(index)} vectors in {len(index.centroids)} lists, '
+                          f'built in {time.perf_counter() - start_time:.1f} s')
@@ -0,0 +1,118 @@
+import os
+import shutil
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from compare.datasets import DOC_VECTOR_KEY_COLUMNS, NORMALIZED_KEY_COLUMNS, WineVectors, write_binary_files
+from compare.delta import compare_delta
+from compare.index import compare_index
+from wine.models import Wine
+
+
+def write_dataset(df, path):
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+    else:
+        df.to_parquet(path, index=False)
+
+
+def append_keys(df, keys):
+    """
+    Append the wine vintages missing from a dataset of keys, the other columns are left empty
+    :param df: dataframe with WineID and Vintage columns
+    :param keys: list of (WineID, vintage)
+    :return:
+    """
+    existing = set(zip(df['WineID'].tolist(), df['Vintage'].tolist()))
+    keys = [key for key in dict.fromkeys(keys) if key not in existing]
+    if not keys:
+        return df
+    new_rows = pd.DataFrame(keys, columns=['WineID', 'Vintage']).astype(df[['WineID', 'Vintage']].dtypes.to_dict())
+    return pd.concat([df, new_rows], ignore_index=True)
+
+
+class Command(BaseCommand):
+    help = 'Merge the wines of the compare delta index into the compare dataset and rebuild the trees'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--leaf-size', type=int, default=40, help='Leaf size of the rebuilt trees')
+
+    def handle(self, *args, **options):
+        start_time = time.perf_counter()
+        buffer = compare_delta.read()
+        entries = buffer.get('entries', [])
+        if not entries and not buffer.get('wine_ids'):
+            self.stdout.write('The compare delta index is empty')
+            return
+        current_index = compare_index.get()
+        path_pertinent_wine_ratings, path_normalized_wine_data, path_pertinent_ratings_non_null, \
+            path_aggregated_doc_vector = current_index.files.dataset_paths
+        normalized_wine_data = pd.read_parquet(path_normalized_wine_data)
+        aggregated_doc_vector = pd.read_csv(path_aggregated_doc_vector)
+
+        # The wines created without WineID get a new one, after the WineIDs of the dataset and of the DB
+        wines = Wine.objects.get_wines_by_ids([entry['id'] for entry in entries])
+        next_wine_id = max(int(normalized_wine_data['WineID'].max()),
+                           Wine.objects.aggregate(Max('wine_id'))['wine_id__max'] or 0) + 1
+        for wine in wines.values():
+            if wine.wine_id is None:
+                wine.wine_id = next_wine_id
+                Wine.objects.filter(id=wine.id).update(wine_id=next_wine_id)
+                next_wine_id += 1
+        merged = [entry for entry in entries if entry['id'] in wines]
+
+        # Replace the rows of the changed wines by the rows of the delta index
+        replaced_wine_ids = set(buffer.get('wine_ids', [])) | {wines[entry['id']].wine_id for entry in merged}
+        normalized_wine_data = normalized_wine_data[~normalized_wine_data['WineID'].isin(replaced_wine_ids)]
+        aggregated_doc_vector = aggregated_doc_vector[~aggregated_doc_vector['WineID'].isin(replaced_wine_ids)]
+        feature_columns = [column for column in normalized_wine_data.columns if column not in NORMALIZED_KEY_COLUMNS]
+        new_rows = pd.DataFrame([entry['vector'] for entry in merged], columns=feature_columns)
+        new_rows['WineID'] = [wines[entry['id']].wine_id for entry in merged]
+        new_rows['Vintage'] = [entry['vintage'] for entry in merged]
+        new_rows['WineName'] = [wines[entry['id']].wine_name for entry in merged]
+        normalized_wine_data = pd.concat([normalized_wine_data, new_rows[normalized_wine_data.columns]],
+                                         ignore_index=True)
+        reviewed = [entry for entry in merged if entry['text_vector'] is not None]
+        text_columns = [column for column in aggregated_doc_vector.columns if column not in DOC_VECTOR_KEY_COLUMNS]
+        new_text_rows = pd.DataFrame([entry['text_vector'] for entry in reviewed], columns=text_columns)
+        new_text_rows['WineID'] = [wines[entry['id']].wine_id for entry in reviewed]
+        new_text_rows['Vintage'] = [entry['vintage'] for entry in reviewed]
+        aggregated_doc_vector = pd.concat([aggregated_doc_vector, new_text_rows[aggregated_doc_vector.columns]],
+                                          ignore_index=True)
+        new_keys = list(zip(new_rows['WineID'].tolist(), new_rows['Vintage'].tolist()))
+        new_text_keys = list(zip(new_text_rows['WineID'].tolist(), new_text_rows['Vintage'].tolist()))
+        pertinent_wine_ratings = append_keys(pd.read_parquet(path_pertinent_wine_ratings), new_keys)
+        pertinent_ratings_non_null = append_keys(pd.read_parquet(path_pertinent_ratings_non_null), new_text_keys)
+
+        # Every file is written into the directory of a new version, which the workers load once it is published
+        files = compare_index.new_files()
+        try:
+            compare_model = current_index.compare_model
+            for path, tree, df, columns in [
+                (files.tree_paths[0], compare_model.wine_composition_weather_tree, normalized_wine_data,
+                 feature_columns),
+                (files.tree_paths[1], compare_model.wine_text_review_tree, aggregated_doc_vector, text_columns),
+            ]:
+                new_tree = type(tree)(np.ascontiguousarray(df[columns].to_numpy(dtype=np.float64)),
+                                      leaf_size=options['leaf_size'])
+                joblib.dump(new_tree, path)
+            for df, path in zip([pertinent_wine_ratings, normalized_wine_data, pertinent_ratings_non_null,
+                                 aggregated_doc_vector], files.dataset_paths):
+                write_dataset(df, path)
+            write_binary_files(WineVectors.from_df(normalized_wine_data, NORMALIZED_KEY_COLUMNS),
+                               files.dataset_paths[1])
+            write_binary_files(WineVectors.from_df(aggregated_doc_vector, DOC_VECTOR_KEY_COLUMNS),
+                               files.dataset_paths[3])
+        except Exception:
+            shutil.rmtree(os.path.dirname(files.dataset_paths[0]), ignore_errors=True)
+            raise
+        compare_index.publish(files)
+
+        compare_delta.remove(merged + [entry for entry in entries if entry['id'] not in wines],
+                             wine_ids=buffer.get('wine_ids', []))
+        self.stdout.write(f'{len(merged)} wine vintages merged into the compare index version {files.version} '
+                          f'({len(normalized_wine_data)} rows) in {time.perf_counter() - start_time:.1f} s. '
+                          f'Run compute_neighbors and build_ann_index again to update them.')
@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from compare.index import compare_index
+from compare.neighbors import search_rows, precomputed_neighbors
+from wine_api.settings import COMPARE_CACHE_DEPTH
+
+
+class Command(BaseCommand):
+    help = 'Compute the nearest neighbors of every wine vintage of normalized_wine_data for compare_wine'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--k', type=int, default=COMPARE_CACHE_DEPTH,
+                            help='Number of neighbors of a wine vintage, compare_wine serves nb_wines <= k')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of wine vintages searched by a task')
+
+    def handle(self, *args, **options):
+        if options['k'] < 1:
+            self.stderr.write('k must be a positive integer')
+            return
+        start_time = time.perf_counter()
+        # Loaded before the workers are forked, so they share the dataset and the trees
+        index = compare_index.get()
+        nb_rows = len(index.compare_data.composition_weather)
+        # One more neighbor than nb_wines, the wine itself is removed by compare_wine
+        k = options['k'] + 1
+        tasks = [(start, min(start + options['chunk_size'], nb_rows), k, index.fingerprint)
+                 for start in range(0, nb_rows, options['chunk_size'])]
+        rows = np.full((nb_rows, k), -1, dtype=np.int32)
+        distances = np.full((nb_rows, k), np.inf)
+
+        def store(result):
+            start, chunk_rows, chunk_distances = result
+            rows[start:start + len(chunk_rows)] = chunk_rows
+            distances[start:start + len(chunk_distances)] = chunk_distances
+
+        if options['workers'] > 1 and len(tasks) > 1:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(processes=min(options['workers'], len(tasks))) as pool:
+                for result in pool.imap_unordered(search_rows, tasks):
+                    store(result)
+        else:
+            for task in tasks:
+                store(search_rows(task))
+
+        precomputed_neighbors.write(rows, distances, k=k, fingerprint=index.fingerprint)
+        self.stdout.write(f'{options["k"]} neighbors of {nb_rows} wine vintages written to '
+                          f'{precomputed_neighbors.paths[0]} in {time.perf_counter() - start_time:.1f} s')
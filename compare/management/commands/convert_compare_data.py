@@ -0,0 +1,47 @@
+import time
+import pandas as pd
+from django.core.management.base import BaseCommand
+from compare.datasets import (
+    DOC_VECTOR_KEY_COLUMNS,
+    NORMALIZED_KEY_COLUMNS,
+    WineVectors,
+    load_vectors,
+    write_binary_files,
+)
+from compare.index import compare_index
+from wine_api.resources import get_rss
+
+
+class Command(BaseCommand):
+    help = 'Write the vectors of the compare datasets to .npy files which the workers memory-map'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-benchmark', action='store_true',
+                            help='Do not compare the load time and the memory of both formats')
+
+    def handle(self, *args, **options):
+        # The files of the current version, compact_compare_index writes the binary files of the new ones
+        files = compare_index.get_files()
+        path_normalized_wine_data, path_aggregated_doc_vector = files.dataset_paths[1], files.dataset_paths[3]
+        datasets = [
+            (path_normalized_wine_data, pd.read_parquet, NORMALIZED_KEY_COLUMNS),
+            (path_aggregated_doc_vector, pd.read_csv, DOC_VECTOR_KEY_COLUMNS),
+        ]
+        for path, read, key_columns in datasets:
+            wine_vectors = WineVectors.from_df(read(path), key_columns)
+            write_binary_files(wine_vectors, path)
+            self.stdout.write(f'{path}: {wine_vectors.vectors.shape[0]} x {wine_vectors.vectors.shape[1]} '
+                              f'{wine_vectors.vectors.dtype}')
+
+        if options['no_benchmark']:
+            return
+        self.stdout.write(f'{"format":>8} {"load (ms)":>10} {"RSS (MB)":>10}')
+        for binary in [False, True]:
+            rss = get_rss()
+            start_time = time.perf_counter()
+            loaded = [load_vectors(path, read, key_columns, binary=binary)
+                      for path, read, key_columns in datasets]
+            load_time = time.perf_counter() - start_time
+            self.stdout.write(f'{"npy" if binary else "source":>8} {load_time * 1000:>10.1f} '
+                              f'{(get_rss() - rss) / 2 ** 20:>10.1f}')
+            del loaded
@@ -0,0 +1,36 @@
+from django.db import models
+
+
+class DeltaEntryManager(models.Manager):
+    use_in_migrations = True
+
+    def get_entries(self):
+        """
+        Returns the entries of the delta index, by increasing id
+        :return: list of dict of pk, compare_id, id and wine_id of the wine, vintage, type, region_id,
+        vector and text_vector
+        """
+        labels = ['pk', 'compare_id', 'id', 'wine_id', 'vintage', 'type', 'region_id', 'vector', 'text_vector']
+        entries = self.order_by("id").values_list("id", "compare_id", "wine_pk", "wine_id", "vintage", "type",
+                                                   "region_pk", "vector", "text_vector")
+        return [dict(zip(labels, entry)) for entry in entries]
+
+    def replace_entries(self, compare_id, entries):
+        """
+        Replace the entries of a wine
+        :param compare_id: WineID, or minus the id of the wine
+        :param entries: list of dict of id and wine_id of the wine, vintage, type, region_id, vector and text_vector
+        :return:
+        """
+        self.filter(compare_id=compare_id).delete()
+        self.bulk_create([self.model(compare_id=compare_id, wine_pk=entry['id'], wine_id=entry['wine_id'],
+                                     vintage=entry['vintage'], type=entry['type'], region_pk=entry['region_id'],
+                                     vector=entry['vector'], text_vector=entry['text_vector'])
+                          for entry in entries])
+
+
+class DeltaTombstoneManager(models.Manager):
+    use_in_migrations = True
+
+    def get_wine_ids(self):
+        return list(self.order_by("id").values_list("wine_id", flat=True))
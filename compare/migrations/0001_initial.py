@@ -0,0 +1,55 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:51
+
+import compare.managers
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeltaTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, null=True)),
+                ('wine_id', models.IntegerField(unique=True)),
+            ],
+            options={
+                'db_table': 'compare_delta_tombstone',
+                'ordering': ['id'],
+            },
+            managers=[
+                ('objects', compare.managers.DeltaTombstoneManager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeltaEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, null=True)),
+                ('compare_id', models.IntegerField(db_index=True)),
+                ('wine_pk', models.BigIntegerField()),
+                ('wine_id', models.IntegerField(null=True)),
+                ('vintage', models.IntegerField()),
+                ('type', models.CharField(max_length=255)),
+                ('region_pk', models.BigIntegerField(null=True)),
+                ('vector', models.JSONField()),
+                ('text_vector', models.JSONField(null=True)),
+            ],
+            options={
+                'db_table': 'compare_delta_entry',
+                'ordering': ['id'],
+                'unique_together': {('compare_id', 'vintage')},
+            },
+            managers=[
+                ('objects', compare.managers.DeltaEntryManager()),
+            ],
+        ),
+    ]
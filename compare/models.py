@@ -1,3 +1,40 @@
 from django.db import models
+from wine_api.models import BaseEntity
+from compare.managers import DeltaEntryManager, DeltaTombstoneManager
 
-# Create your models here.
+
+class DeltaEntry(BaseEntity):
+    """
+    Vintage of a wine created or changed since the compare dataset was built, searched by the delta index
+    """
+
+    class Meta:
+        db_table = "compare_delta_entry"
+        ordering = ["id"]
+        unique_together = [("compare_id", "vintage")]
+
+    # WineID, or minus the id of the wine for the wines created without WineID
+    compare_id = models.IntegerField(db_index=True)
+    wine_pk = models.BigIntegerField()
+    wine_id = models.IntegerField(null=True)
+    vintage = models.IntegerField()
+    type = models.CharField(max_length=255)
+    region_pk = models.BigIntegerField(null=True)
+    vector = models.JSONField()
+    text_vector = models.JSONField(null=True)
+
+    objects = DeltaEntryManager()
+
+
+class DeltaTombstone(BaseEntity):
+    """
+    WineID of the rows of the compare dataset replaced by delta entries
+    """
+
+    class Meta:
+        db_table = "compare_delta_tombstone"
+        ordering = ["id"]
+
+    wine_id = models.IntegerField(unique=True)
+
+    objects = DeltaTombstoneManager()
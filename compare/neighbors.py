@@ -0,0 +1,133 @@
+import json
+import os
+import numpy as np
+from compare.index import compare_index
+from compare.search import search_top_k
+from wine_api.resources import SharedResource
+from wine_api.settings import BASE_DIR
+
+
+def search_rows(task):
+    """
+    Search the neighbors of a range of rows of normalized_wine_data
+    :param task: tuple of start, stop, k, fingerprint of the compare index searched
+    :return: tuple of start, rows, distances
+    """
+    start, stop, k, fingerprint = task
+    index = compare_index.get()
+    if index.fingerprint != fingerprint:
+        raise RuntimeError('The compare index switched to a new version during the computation')
+    compare_data = index.compare_data
+    compare_model = index.compare_model
+    keys = compare_data.composition_weather.keys
+    rows = np.full((stop - start, k), -1, dtype=np.int32)
+    distances = np.full((stop - start, k), np.inf)
+    for i, key in enumerate(zip(keys['WineID'].iloc[start:stop].tolist(), keys['Vintage'].iloc[start:stop].tolist())):
+        input_wine_composition_and_weather, input_wine_text_review = compare_data.get_inputs(*key)
+        top_rows, top_distances = search_top_k(compare_model, compare_data, input_wine_composition_and_weather,
+                                               input_wine_text_review, k)
+        rows[i, :len(top_rows)] = top_rows
+        distances[i, :len(top_distances)] = top_distances
+    return start, rows, distances
+
+
+class NeighborsTable:
+    """
+    Nearest neighbors of every row of normalized_wine_data, sorted by distance
+    """
+
+    def __init__(self, rows, distances, k, fingerprint):
+        """
+        Constructor
+        :param rows: array of shape (n, k) of rows of normalized_wine_data, -1 when there are less than k rows
+        :param distances: array of shape (n, k)
+        :param k: number of neighbors of a row, including the row itself
+        :param fingerprint: fingerprint of the compare index the table was computed from
+        """
+        self.rows = rows
+        self.distances = distances
+        self.k = k
+        self.fingerprint = fingerprint
+
+
+class PrecomputedNeighbors(SharedResource):
+    """
+    Neighbors table computed offline by the compute_neighbors command
+    """
+
+    name = 'precomputed neighbors'
+
+    def __init__(self, path_rows, path_distances, path_meta):
+        super().__init__(path_rows, path_distances, path_meta, watch=True)
+
+    def load(self):
+        path_rows, path_distances, path_meta = self.paths
+        if not all(os.path.exists(path) for path in self.paths):
+            return NeighborsTable(np.empty((0, 0), dtype=np.int32), np.empty((0, 0)), k=0, fingerprint=None)
+        with open(path_meta) as f:
+            meta = json.load(f)
+        return NeighborsTable(np.load(path_rows, mmap_mode='r'), np.load(path_distances, mmap_mode='r'),
+                              k=meta['k'], fingerprint=meta['fingerprint'])
+
+    def get_neighbors(self, index, wine_id, vintage, k, mask=None, max_distance=None):
+        """
+        Get the k nearest neighbors of a wine vintage allowed by the filters,
+        None if they are not precomputed, outdated or if the table is not deep enough for the filters
+        :param index: CompareIndexVersion searched by the caller
+        :param wine_id: Identifier of the wine from X-Wines dataset
+        :param vintage:
+        :param k:
+        :param mask: boolean array over the rows of normalized_wine_data, None to allow every row
+        :param max_distance: maximum distance, None for no maximum
+        :return: tuple of rows of normalized_wine_data, distances, both sorted by distance
+        """
+        table = self.get()
+        composition_weather = index.compare_data.composition_weather
+        row = composition_weather.rows.get((wine_id, vintage))
+        if row is None or len(table.rows) != len(composition_weather) or table.fingerprint != index.fingerprint:
+            return None
+        if mask is None and max_distance is None:
+            if k > table.k:
+                return None
+            rows = table.rows[row, :k]
+            valid = rows >= 0
+            return rows[valid], table.distances[row, :k][valid]
+
+        rows = table.rows[row]
+        distances = table.distances[row]
+        valid = rows >= 0
+        rows, distances = rows[valid], distances[valid]
+        allowed = np.ones(len(rows), dtype=bool) if mask is None else mask[rows]
+        if max_distance is not None:
+            allowed &= distances <= max_distance
+        # The table holds every row, or the rows after it are further than max_distance
+        complete = len(rows) < table.k or (max_distance is not None and len(rows) > 0 and
+                                           distances[-1] > max_distance)
+        if np.count_nonzero(allowed) < k and not complete:
+            return None
+        return rows[allowed][:k], distances[allowed][:k]
+
+    def write(self, rows, distances, k, fingerprint):
+        """
+        Write a neighbors table, through temporary files so the workers never map a partial file
+        :param rows:
+        :param distances:
+        :param k:
+        :param fingerprint: fingerprint of the compare index the table was computed from
+        :return:
+        """
+        path_rows, path_distances, path_meta = self.paths
+        for path, array in [(path_rows, rows), (path_distances, distances)]:
+            with open(f'{path}.tmp', 'wb') as f:
+                np.save(f, array)
+        with open(f'{path_meta}.tmp', 'w') as f:
+            json.dump({'k': k, 'fingerprint': fingerprint}, f)
+        for path in self.paths:
+            os.replace(f'{path}.tmp', path)
+
+
+precomputed_neighbors = PrecomputedNeighbors(
+    path_rows=f'{BASE_DIR}/compare_data/neighbors_rows.npy',
+    path_distances=f'{BASE_DIR}/compare_data/neighbors_distances.npy',
+    path_meta=f'{BASE_DIR}/compare_data/neighbors_meta.json',
+)
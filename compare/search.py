@@ -0,0 +1,171 @@
+import numpy as np
+
+
+# Number of composition candidates of the first query, multiplied until the top-k is exact
+MIN_CANDIDATES = 64
+CANDIDATES_GROWTH = 4
+
+
+def euclidean_distances(query, vectors):
+    """
+    Euclidean distances between a vector and the rows of a matrix.
+    The squares are summed in the same order as the sklearn trees, so the distances are bitwise equal.
+    :param query: array of shape (1, n_features)
+    :param vectors: array of shape (n, n_features)
+    :return: array of shape (n,)
+    """
+    if len(vectors) == 0:
+        return np.zeros(0)
+    diff = np.asarray(vectors, dtype=np.float64) - np.asarray(query, dtype=np.float64)
+    return np.sqrt(np.cumsum(diff * diff, axis=1)[:, -1])
+
+
+def is_euclidean(tree, nb_samples=8):
+    """
+    Check that the distances of a tree are the euclidean distances computed by euclidean_distances
+    :param tree: sklearn KDTree or BallTree
+    :param nb_samples: number of neighbors compared
+    :return:
+    """
+    data = tree.get_arrays()[0]
+    if len(data) == 0:
+        return False
+    query = np.asarray(data[:1], dtype=np.float64) + 0.5
+    dist, ind = tree.query(query, k=min(nb_samples, len(data)))
+    return bool(np.array_equal(dist[0], euclidean_distances(query, data[ind[0]])))
+
+
+def rank(distances, rows, k):
+    """
+    Positions of the k smallest distances, sorted by distance then by row
+    :param distances:
+    :param rows:
+    :param k:
+    :return:
+    """
+    if k < len(distances):
+        top = np.argpartition(distances, k - 1)[:k]
+    else:
+        top = np.arange(len(distances))
+    return top[np.lexsort((rows[top], distances[top]))]
+
+
+def add_text_distances(distances, rows, compare_data, text_review_data, input_wine_text_review):
+    """
+    Add the text review distances to the distances of rows of normalized_wine_data
+    :param distances: composition and weather distances, modified in place
+    :param rows: rows of normalized_wine_data
+    :param compare_data: CompareData
+    :param text_review_data: text review vectors of the text tree
+    :param input_wine_text_review:
+    :return:
+    """
+    text_rows = compare_data.text_rows[rows]
+    have_text_review = text_rows >= 0
+    distances[have_text_review] += euclidean_distances(input_wine_text_review,
+                                                       text_review_data[text_rows[have_text_review]])
+
+
+def select(rows, distances, k, mask=None, max_distance=None):
+    """
+    Positions of the k smallest distances of the rows allowed by the filters, sorted by distance then by row
+    :param rows:
+    :param distances:
+    :param k:
+    :param mask: boolean array over the rows of normalized_wine_data, None to allow every row
+    :param max_distance: maximum distance, None for no maximum
+    :return:
+    """
+    allowed = np.ones(len(rows), dtype=bool) if mask is None else mask[rows]
+    if max_distance is not None:
+        allowed &= distances <= max_distance
+    positions = np.flatnonzero(allowed)
+    return positions[rank(distances[positions], rows[positions], k)]
+
+
+def search_top_k(compare_model, compare_data, input_wine_composition_and_weather, input_wine_text_review, k,
+                 mask=None, max_distance=None):
+    """
+    Get the k wines with the smallest distance, the sum of the composition and weather distance
+    and of the text review distance (0 for the wines without text review).
+    The composition tree is queried for a bounded number of candidates, and the text distances are computed
+    for these candidates only. As the text distance is positive, no wine outside of the candidates can be
+    closer than the furthest candidate, so the candidates are extended until the k-th distance is below it.
+    The filters are applied to the candidates before ranking. The number of candidates grows with the share of
+    wines the mask removes, and a mask keeping fewer wines than that is searched by brute force.
+    :param compare_model: SharedCompareModel
+    :param compare_data: CompareData
+    :param input_wine_composition_and_weather:
+    :param input_wine_text_review: None if the wine has no text review
+    :param k:
+    :param mask: boolean array over the rows of normalized_wine_data, None to allow every row
+    :param max_distance: maximum distance, None for no maximum
+    :return: tuple of rows of normalized_wine_data, distances, both sorted by distance
+    """
+    nb_rows = len(compare_data.composition_weather)
+    nb_allowed = nb_rows if mask is None else int(np.count_nonzero(mask))
+    k = min(k, nb_allowed)
+    if k == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    composition_weather_tree = compare_model.wine_composition_weather_tree
+    if input_wine_text_review is None and mask is None and max_distance is None:
+        dist, ind = composition_weather_tree.query(input_wine_composition_and_weather, k=k)
+        return ind[0], dist[0]
+
+    if input_wine_text_review is not None and not compare_model.text_review_euclidean:
+        # The text distances cannot be computed outside of the tree, query every wine
+        return search_all(compare_model, compare_data, input_wine_composition_and_weather,
+                          input_wine_text_review, k, mask=mask, max_distance=max_distance)
+
+    text_review_data = compare_model.wine_text_review_tree.get_arrays()[0]
+    # Enough candidates to keep about 2 * k of them after the mask
+    nb_candidates = min(nb_rows, -(-max(MIN_CANDIDATES, 2 * k) * nb_rows // nb_allowed))
+    if mask is not None and nb_candidates >= nb_allowed and compare_model.composition_weather_euclidean:
+        # Less wines are allowed than candidates would be queried, compare all of them
+        rows = np.flatnonzero(mask)
+        distances = euclidean_distances(input_wine_composition_and_weather,
+                                        composition_weather_tree.get_arrays()[0][rows])
+        if input_wine_text_review is not None:
+            add_text_distances(distances, rows, compare_data, text_review_data, input_wine_text_review)
+        top = select(rows, distances, k, max_distance=max_distance)
+        return rows[top], distances[top]
+
+    while True:
+        dist, ind = composition_weather_tree.query(input_wine_composition_and_weather, k=nb_candidates)
+        dist, ind = dist[0], ind[0]
+        distances = dist.copy()
+        if input_wine_text_review is not None:
+            add_text_distances(distances, ind, compare_data, text_review_data, input_wine_text_review)
+        top = select(ind, distances, k, mask=mask, max_distance=max_distance)
+        if nb_candidates == nb_rows or (max_distance is not None and dist[-1] > max_distance) or \
+                (len(top) == k and distances[top[-1]] <= dist[-1]):
+            return ind[top], distances[top]
+        nb_candidates = min(nb_rows, nb_candidates * CANDIDATES_GROWTH)
+
+
+def search_all(compare_model, compare_data, input_wine_composition_and_weather, input_wine_text_review, k,
+               mask=None, max_distance=None):
+    """
+    Get the k wines with the smallest distance by querying every wine from both trees
+    :param compare_model: SharedCompareModel
+    :param compare_data: CompareData
+    :param input_wine_composition_and_weather:
+    :param input_wine_text_review:
+    :param k:
+    :param mask: boolean array over the rows of normalized_wine_data, None to allow every row
+    :param max_distance: maximum distance, None for no maximum
+    :return: tuple of rows of normalized_wine_data, distances, both sorted by distance
+    """
+    dist_composition_weather, ind_composition_weather, dist_text_review, ind_text_review = compare_model.query_data(
+        input_wine_composition_and_weather, len_comp_weather=len(compare_data.composition_weather),
+        input_wine_text_review=input_wine_text_review, len_text_review=len(compare_data.text_review)
+    )
+    distances = np.empty(len(compare_data.composition_weather))
+    distances[ind_composition_weather[0]] = dist_composition_weather[0]
+    text_distances = np.empty(len(compare_data.text_review))
+    text_distances[ind_text_review[0]] = dist_text_review[0]
+    have_text_review = compare_data.text_rows >= 0
+    distances[have_text_review] += text_distances[compare_data.text_rows[have_text_review]]
+    rows = np.arange(len(distances))
+    top = select(rows, distances, k, mask=mask, max_distance=max_distance)
+    return rows[top], distances[top]
@@ -8,6 +8,12 @@ class ListVintagesSerializer(serializers.Serializer):
     )
 
 
+class BatchListVintagesSerializer(serializers.Serializer):
+    list_wines = serializers.ListField(
+        child=ListVintagesSerializer()
+    )
+
+
 class WineField(serializers.DictField):
     id = serializers.IntegerField()
     wine_id = serializers.IntegerField()
@@ -1,3 +1,401 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from unittest import mock
+import joblib
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import resolve
+from rest_framework.test import APIRequestFactory
+from sklearn.neighbors import KDTree
+from compare import search
+from compare.ann import IVFIndex
+from compare.catalog import CATALOG_VERSION_KEY, CompareCatalog
+from compare.datasets import CompareData, WineVectors
+from compare.delta import compare_delta
+from compare.index import CompareIndex, CompareIndexFiles, CompareIndexVersion, compare_index
+from compare.models import DeltaEntry
+from compare.search import search_all, search_top_k
+from compare.views import get_ranked_wines
+from compare.trees import SharedCompareModel
+from region.models import Region
+from wine.models import Wine
+from winery.models import Winery
 
-# Create your tests here.
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class CountingTree:
+    """
+    Tree recording the number of neighbors of its queries
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.queries = []
+
+    def query(self, X, k=1):
+        self.queries.append(k)
+        return self.tree.query(X, k=k)
+
+    def get_arrays(self):
+        return self.tree.get_arrays()
+
+
+def make_compare_data(composition_vectors, text_vectors, reviewed_rows):
+    """
+    Compare dataset of one vintage per WineID, with a text review for the given rows
+    :param composition_vectors: array of shape (n, n_features)
+    :param text_vectors: array of shape (len(reviewed_rows), n_text_features)
+    :param reviewed_rows: rows of the composition vectors with a text review
+    :return:
+    """
+    keys = pd.DataFrame({'WineID': np.arange(len(composition_vectors)), 'Vintage': 2000})
+    reviewed_keys = keys.iloc[reviewed_rows]
+    return CompareData(
+        pertinent_wine_ratings=keys,
+        normalized_wine_data=WineVectors(keys, composition_vectors),
+        pertinent_ratings_non_null=reviewed_keys,
+        aggregated_doc_vector=WineVectors(reviewed_keys, text_vectors),
+    )
+
+
+class SearchTopKTests(SimpleTestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        nb_rows = 1000
+        composition_vectors = random.rand(nb_rows, 6)
+        # A third of the wines have no text review
+        reviewed_rows = np.sort(random.choice(nb_rows, 2 * nb_rows // 3, replace=False))
+        text_vectors = random.rand(len(reviewed_rows), 4)
+        self.compare_data = make_compare_data(composition_vectors, text_vectors, reviewed_rows)
+        self.composition_tree = CountingTree(KDTree(composition_vectors, leaf_size=10))
+        self.compare_model = SharedCompareModel(self.composition_tree, KDTree(text_vectors, leaf_size=10))
+        self.composition_vectors = composition_vectors
+        self.text_vectors = text_vectors
+
+    def assert_same_top_k(self, input_wine_composition_and_weather, input_wine_text_review, k, **filters):
+        rows, distances = search_top_k(self.compare_model, self.compare_data, input_wine_composition_and_weather,
+                                       input_wine_text_review, k, **filters)
+        expected_rows, expected_distances = search_all(self.compare_model, self.compare_data,
+                                                       input_wine_composition_and_weather, input_wine_text_review,
+                                                       k, **filters)
+        np.testing.assert_array_equal(rows, expected_rows)
+        np.testing.assert_array_equal(distances, expected_distances)
+        return rows, distances
+
+    def test_same_rows_and_distances_as_search_all(self):
+        self.assertTrue(self.compare_model.composition_weather_euclidean)
+        self.assertTrue(self.compare_model.text_review_euclidean)
+        for row in [0, 17, 512]:
+            input_wine_composition_and_weather = self.composition_vectors[row:row + 1]
+            input_wine_text_review = self.text_vectors[row:row + 1]
+            for k in [1, 10, 100]:
+                rows, _ = self.assert_same_top_k(input_wine_composition_and_weather, input_wine_text_review, k)
+                self.assertEqual(len(rows), k)
+
+    def test_filters(self):
+        input_wine_composition_and_weather = self.composition_vectors[3:4]
+        input_wine_text_review = self.text_vectors[3:4]
+        mask = np.zeros(len(self.composition_vectors), dtype=bool)
+        mask[::3] = True
+        few_rows_mask = np.zeros(len(self.composition_vectors), dtype=bool)
+        few_rows_mask[[5, 50, 500, 999]] = True
+        for filters in [{'max_distance': 0.9}, {'mask': mask}, {'mask': mask, 'max_distance': 1.0},
+                        {'mask': few_rows_mask, 'max_distance': 1.5}, {'max_distance': 0.}]:
+            rows, distances = self.assert_same_top_k(input_wine_composition_and_weather, input_wine_text_review,
+                                                     20, **filters)
+            if 'mask' in filters:
+                self.assertTrue(filters['mask'][rows].all())
+            self.assertTrue((distances <= filters.get('max_distance', np.inf)).all())
+
+    def test_candidates_grow_until_the_top_k_is_exact(self):
+        # The text reviews of the closest compositions are far from the input, the top-k is further away
+        nb_rows = len(self.composition_vectors)
+        input_wine_composition_and_weather = np.full((1, 6), 0.5)
+        closest = np.argsort(np.linalg.norm(self.composition_vectors - 0.5, axis=1))[:search.MIN_CANDIDATES * 2]
+        reviewed_rows = np.arange(nb_rows)
+        text_vectors = np.zeros((nb_rows, 4))
+        text_vectors[closest] = 10.
+        self.compare_data = make_compare_data(self.composition_vectors, text_vectors, reviewed_rows)
+        self.compare_model = SharedCompareModel(self.composition_tree, KDTree(text_vectors, leaf_size=10))
+        self.composition_tree.queries = []
+
+        rows, _ = self.assert_same_top_k(input_wine_composition_and_weather, np.zeros((1, 4)), 10,
+                                         max_distance=5.)
+        self.assertEqual(len(rows), 10)
+        self.assertFalse(np.isin(rows, closest).any())
+        # search_top_k queried more candidates after the first query, search_all queried every wine
+        self.assertEqual(self.composition_tree.queries, [
+            search.MIN_CANDIDATES, search.MIN_CANDIDATES * search.CANDIDATES_GROWTH, nb_rows])
+
+
+class IVFIndexTests(SimpleTestCase):
+    def test_exact_index_matches_the_tree(self):
+        vectors = np.random.RandomState(0).rand(200, 4)
+        dist, ind = IVFIndex.exact(vectors).query(vectors[:3], k=5)
+        expected_dist, expected_ind = KDTree(vectors).query(vectors[:3], k=5)
+        np.testing.assert_array_equal(ind, expected_ind)
+        np.testing.assert_allclose(dist, expected_dist)
+
+    def test_fingerprint_is_saved_with_the_index(self):
+        vectors = np.random.RandomState(0).rand(200, 4)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.npz')
+            IVFIndex.build(vectors, fingerprint='abc').save(path)
+            self.assertEqual(IVFIndex.load(path, vectors).fingerprint, 'abc')
+            IVFIndex.build(vectors).save(path)
+            self.assertIsNone(IVFIndex.load(path, vectors).fingerprint)
+
+
+def write_compare_files(files, nb_rows):
+    """
+    Write a compare dataset of one vintage per WineID and its trees
+    :param files: CompareIndexFiles
+    :param nb_rows:
+    :return:
+    """
+    keys = pd.DataFrame({'WineID': np.arange(nb_rows), 'Vintage': 2000})
+    vectors = np.random.RandomState(nb_rows).rand(nb_rows, 2)
+    path_pertinent_wine_ratings, path_normalized_wine_data, path_pertinent_ratings_non_null, \
+        path_aggregated_doc_vector = files.dataset_paths
+    keys.to_parquet(path_pertinent_wine_ratings, index=False)
+    keys.assign(WineName='Wine', abv=vectors[:, 0], body=vectors[:, 1]).to_parquet(path_normalized_wine_data,
+                                                                                    index=False)
+    keys.to_parquet(path_pertinent_ratings_non_null, index=False)
+    keys.assign(text=vectors[:, 0]).to_csv(path_aggregated_doc_vector, index=False)
+    joblib.dump(KDTree(vectors), files.tree_paths[0])
+    joblib.dump(KDTree(vectors[:, :1]), files.tree_paths[1])
+
+
+class CompareIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        base_files = CompareIndexFiles.in_directory(None, self.directory)
+        write_compare_files(base_files, 3)
+        self.compare_index = CompareIndex(os.path.join(self.directory, 'compare_index.json'),
+                                          os.path.join(self.directory, 'versions'), base_files)
+
+    def test_new_version_is_loaded_once_published(self):
+        index = self.compare_index.get()
+        self.assertIsNone(index.version)
+        self.assertEqual(len(index.compare_data.composition_weather), 3)
+
+        # Written into the directory of a new version, the workers keep the current one
+        files = self.compare_index.new_files()
+        write_compare_files(files, 5)
+        self.assertIs(self.compare_index.get(), index)
+
+        self.compare_index.publish(files)
+        new_index = self.compare_index.get()
+        self.assertEqual(new_index.version, files.version)
+        # The dataset and the trees are loaded from the same version
+        self.assertEqual(len(new_index.compare_data.composition_weather), 5)
+        self.assertEqual(new_index.compare_model.wine_composition_weather_tree.data.shape, (5, 2))
+        self.assertNotEqual(new_index.fingerprint, index.fingerprint)
+
+    def test_previous_version_is_kept(self):
+        versions = []
+        for nb_rows in [3, 4, 5]:
+            files = self.compare_index.new_files()
+            write_compare_files(files, nb_rows)
+            self.compare_index.publish(files)
+            versions.append(files.version)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'versions'))), versions[1:])
+        self.assertEqual(len(self.compare_index.get().compare_data.composition_weather), 5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CompareCatalogTests(SimpleTestCase):
+    def test_catalog_is_loaded_once_until_invalidated(self):
+        compare_data = make_compare_data(np.zeros((3, 2)), np.zeros((0, 2)), [])
+        wine_catalog = [(0, 'Red', 1, 12.5, 'Full-bodied', 'High'), (1, 'White', 2, 11., 'Light', 'Low')]
+        catalog = CompareCatalog()
+        with mock.patch('compare.catalog.compare_index') as index, \
+                mock.patch.object(Wine.objects, 'get_wine_catalog', return_value=wine_catalog) as get_wine_catalog:
+            index.get.return_value.compare_data = compare_data
+            np.testing.assert_array_equal(catalog.get_mask(compare_data, wine_type='Red'), [True, False, False])
+            catalog.get_mask(compare_data, region_id=2)
+            self.assertEqual(get_wine_catalog.call_count, 1)
+
+            # A wine of the dataset changed in another worker
+            get_wine_catalog.return_value = [(0, 'Red', 1, 12.5, 'Full-bodied', 'High'),
+                                             (1, 'Red', 2, 11., 'Light', 'Low')]
+            CompareCatalog().invalidate()
+            np.testing.assert_array_equal(catalog.get_mask(compare_data, wine_type='Red'), [True, True, False])
+            self.assertEqual(get_wine_catalog.call_count, 2)
+
+            # A new version of the compare index
+            new_compare_data = make_compare_data(np.zeros((3, 2)), np.zeros((0, 2)), [])
+            index.get.return_value.compare_data = new_compare_data
+            catalog.get_mask(new_compare_data, wine_type='Red')
+            self.assertEqual(get_wine_catalog.call_count, 3)
+
+    def test_invalidate_after_the_version_is_evicted(self):
+        catalog = CompareCatalog()
+        catalog.invalidate()
+        version = catalog.get_version()
+        cache.delete(CATALOG_VERSION_KEY)
+        catalog.invalidate()
+        self.assertIsNotNone(catalog.get_version())
+        self.assertNotEqual(catalog.get_version(), version)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CompareDeltaTests(TestCase):
+    def setUp(self):
+        region = Region.objects.create(region_id=1, region_name='Bordeaux', country='France', code='FR',
+                                       latitude=44.8, longitude=-0.6)
+        winery = Winery.objects.create(winery_id=1, winery_name='Chateau', website='')
+        self.wine = Wine.objects.create(wine_id=1, wine_name='Grand Vin', type='Red', elaborate='Varietal/100%',
+                                        abv=13.5, body='Full-bodied', acidity='High', winery=winery, region=region)
+        compare_data = make_compare_data(np.arange(6, dtype=np.float64).reshape(3, 2), np.ones((1, 2)), [1])
+        patcher = mock.patch.object(compare_index, 'get', return_value=CompareIndexVersion(
+            None, compare_data, compare_model=None, fingerprint=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def update_wine(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            compare_delta.update_wine(self.wine)
+
+    def test_buffer_is_stored_in_the_db(self):
+        version = compare_delta.get_version()
+        self.update_wine()
+        self.assertNotEqual(compare_delta.get_version(), version)
+        buffer = compare_delta.read()
+        self.assertEqual([(entry['compare_id'], entry['vintage'], entry['id']) for entry in buffer['entries']],
+                         [(1, 2000, self.wine.id)])
+        self.assertEqual(buffer['entries'][0]['text_vector'], [1., 1.])
+        self.assertEqual(buffer['wine_ids'], [1])
+        np.testing.assert_array_equal(compare_delta.get().get_main_mask(), [True, False, True])
+
+        # The wine changed again while the buffer was merged, its new entry and its tombstone are kept
+        self.update_wine()
+        with self.captureOnCommitCallbacks(execute=True):
+            compare_delta.remove(buffer['entries'])
+        self.assertEqual(DeltaEntry.objects.count(), 1)
+        self.assertEqual(compare_delta.read()['wine_ids'], [1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            compare_delta.remove(compare_delta.read()['entries'])
+        self.assertEqual(compare_delta.read(), {'entries': [], 'wine_ids': []})
+        self.assertEqual(len(compare_delta.get()), 0)
+        self.assertIsNone(compare_delta.get().get_main_mask())
+
+    def test_wines_deleted_during_a_merge_stay_tombstoned(self):
+        buffer = compare_delta.read()
+        with self.captureOnCommitCallbacks(execute=True):
+            compare_delta.remove_wine(self.wine)
+        with self.captureOnCommitCallbacks(execute=True):
+            compare_delta.remove(buffer['entries'], wine_ids=buffer['wine_ids'])
+        self.assertEqual(compare_delta.read()['wine_ids'], [1])
+
+
+def get(path, **params):
+    """
+    Send a GET request to the view of a path
+    :param path:
+    :param params: query parameters
+    :return: response
+    """
+    request = APIRequestFactory().get(path, params)
+    match = resolve(path)
+    return match.func(request, *match.args, **match.kwargs)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ListVintagesBatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        region = Region.objects.create(region_id=1, region_name='Bordeaux', country='France', code='FR',
+                                       latitude=44.8, longitude=-0.6)
+        winery = Winery.objects.create(winery_id=1, winery_name='Chateau', website='')
+        # The WineID 3 is not in the compare dataset
+        self.wines = [Wine.objects.create(wine_id=wine_id, wine_name=f'Wine {wine_id}', type='Red',
+                                          elaborate='Varietal/100%', abv=13.5, body='Full-bodied', acidity='High',
+                                          winery=winery, region=region)
+                      for wine_id in [1, 2, 3]]
+        keys = pd.DataFrame({'WineID': [1, 1, 2], 'Vintage': [2000, 2001, 2005]})
+        compare_data = CompareData(
+            pertinent_wine_ratings=keys,
+            normalized_wine_data=WineVectors(keys, np.zeros((3, 2))),
+            pertinent_ratings_non_null=keys.iloc[:0],
+            aggregated_doc_vector=WineVectors(keys.iloc[:0], np.zeros((0, 2))),
+        )
+        patcher = mock.patch.object(compare_index, 'get', return_value=CompareIndexVersion(
+            None, compare_data, compare_model=None, fingerprint=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch_equals_single_lists(self):
+        ids = [wine.id for wine in self.wines]
+        cache_keys = [f'list_vintages_{wine_id}' for wine_id in ids]
+
+        # One of the wines is already cached
+        get('/api/v1/compare/list_vintages/', wine_id=ids[1])
+        response = get('/api/v1/compare/list_vintages_batch/', wine_ids=','.join(map(str, ids)))
+        self.assertEqual(response.status_code, 200)
+        batch_wines = json.loads(response.content)['list_wines']
+        batch_cache = cache.get_many(cache_keys)
+
+        cache.clear()
+        single_wines = []
+        for wine_id in ids:
+            response = get('/api/v1/compare/list_vintages/', wine_id=wine_id)
+            self.assertEqual(response.status_code, 200)
+            single_wines.append(json.loads(response.content))
+        single_cache = cache.get_many(cache_keys)
+
+        self.assertEqual(batch_wines, single_wines)
+        self.assertEqual([wine['list_vintages'] for wine in batch_wines], [[2000, 2001], [2005], []])
+        # The batch fills the cache entries read by list_vintages
+        self.assertEqual(batch_cache, single_cache)
+        self.assertEqual(set(batch_cache), set(cache_keys))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RankedWinesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        region = Region.objects.create(region_id=1, region_name='Bordeaux', country='France', code='FR',
+                                       latitude=44.8, longitude=-0.6)
+        winery = Winery.objects.create(winery_id=1, winery_name='Chateau', website='')
+        self.wines = [Wine.objects.create(wine_id=wine_id, wine_name=f'Wine {wine_id}', type='Red',
+                                          elaborate='Varietal/100%', abv=13.5, body='Full-bodied', acidity='High',
+                                          winery=winery, region=region)
+                      for wine_id in [0, 1, 2]]
+        compare_data = make_compare_data(np.arange(6, dtype=np.float64).reshape(3, 2), np.zeros((0, 2)), [])
+        self.index = CompareIndexVersion(None, compare_data, compare_model=None, fingerprint=None)
+        patcher = mock.patch.object(compare_index, 'get', return_value=self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_ranked_wines(self):
+        with mock.patch('compare.views.precomputed_neighbors.get_neighbors', return_value=None), \
+                mock.patch('compare.views.search_top_k', return_value=(np.array([0, 1, 2]), np.array([0., 1., 2.]))):
+            return get_ranked_wines(self.wines[0], 2000, 2, self.index, None, compare_delta.get())
+
+    def test_deleted_wines_are_skipped(self):
+        # The WineID 1 is deleted before the compare dataset is compacted
+        path = f'/api/v1/wines/{self.wines[1].id}/'
+        match = resolve(path)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = match.func(APIRequestFactory().delete(path), *match.args, **match.kwargs)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(compare_delta.read()['wine_ids'], [1])
+        np.testing.assert_array_equal(compare_delta.get().get_main_mask(), [True, False, True])
+
+        compare_ids, _ = self.get_ranked_wines()
+        self.assertEqual(compare_ids, [0, 2])
+
+    def test_deleted_wines_are_skipped_without_tombstone(self):
+        # Rows of the compare dataset without wine in the DB
+        Wine.objects.filter(wine_id=1).delete()
+        compare_ids, _ = self.get_ranked_wines()
+        self.assertEqual(compare_ids, [0, 2])
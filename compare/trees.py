@@ -0,0 +1,35 @@
+import joblib
+from likewines.model import CompareModel
+from compare.search import is_euclidean
+
+
+class SharedCompareModel(CompareModel):
+    """
+    CompareModel on trees which are already loaded
+    """
+
+    def __init__(self, wine_composition_weather_tree, wine_text_review_tree):
+        """
+        Constructor
+        :param wine_composition_weather_tree:
+        :param wine_text_review_tree:
+        """
+        # The trees are not loaded again, so the constructor of the parent is not called
+        self.wine_composition_weather_tree = wine_composition_weather_tree
+        self.wine_text_review_tree = wine_text_review_tree
+        # The distances of the top-k search are computed outside of the trees
+        self.composition_weather_euclidean = is_euclidean(wine_composition_weather_tree)
+        self.text_review_euclidean = is_euclidean(wine_text_review_tree)
+
+
+def load_compare_model(path_wine_composition_weather_tree, path_wine_text_review_tree):
+    """
+    Load the KD/Ball trees of the compare model.
+    The arrays of the trees are memory-mapped, so the workers share their pages through the page cache.
+    Trees dumped with compression cannot be memory-mapped and are loaded in memory instead.
+    :return: SharedCompareModel
+    """
+    return SharedCompareModel(
+        wine_composition_weather_tree=joblib.load(path_wine_composition_weather_tree, mmap_mode='r'),
+        wine_text_review_tree=joblib.load(path_wine_text_review_tree, mmap_mode='r'),
+    )
@@ -1,8 +1,9 @@
 from django.urls import path
-from compare.views import compare_wine, get_list_vintages
+from compare.views import compare_wine, get_list_vintages, get_list_vintages_batch
 
 
 urlpatterns = [
     path("list_vintages/", get_list_vintages, name="list_vintages"),
+    path("list_vintages_batch/", get_list_vintages_batch, name="list_vintages_batch"),
     path("compare_wine/", compare_wine, name="compare_wine"),
 ]
@@ -1,18 +1,37 @@
 from django.http import HttpResponse, JsonResponse
 from rest_framework.decorators import api_view, permission_classes
 from django.core.cache import cache
-from wine_api.settings import CACHE_TTL
+from wine_api.settings import CACHE_TTL, LIST_VINTAGES_BATCH_MAX_WINES, COMPARE_CACHE_DEPTH
 from compare.serializers import (
     WineCompareSerializer,
-    ListVintagesSerializer
+    ListVintagesSerializer,
+    BatchListVintagesSerializer,
 )
-import pandas as pd
 from wine.models import Wine
 import json
 from rest_framework.permissions import AllowAny
-from wine_api.settings import BASE_DIR
-from likewines.model import CompareModel
-from likewines.processor import CompareDataProcessor
+from compare.index import compare_index
+from compare.datasets import SharedCompareDataProcessor
+from compare.search import search_top_k
+from compare.neighbors import precomputed_neighbors
+from compare.ann import compare_ann
+from compare.catalog import compare_catalog
+from compare.delta import compare_delta, get_compare_wine_id
+
+
+def get_vintages(wine, compare_data, delta):
+    """
+    Get the sorted vintages of a wine, from the delta index when the wine was created or changed
+    :param wine:
+    :param compare_data: CompareData
+    :param delta: DeltaIndex
+    :return: list of vintages
+    """
+    # A wine of the delta index replaces its rows of the compare dataset
+    delta_vintages = delta.get_vintages(get_compare_wine_id(wine))
+    if delta_vintages:
+        return delta_vintages
+    return compare_data.get_vintages(wine.wine_id).tolist()
 
 
 @api_view(["GET"])
@@ -38,12 +57,9 @@ def get_list_vintages(request):
         returned_data = json.loads(cached_data)
         serializer = ListVintagesSerializer(returned_data)
         return JsonResponse(serializer.data, status=200)
-    # Get the wine
-    pertinent_wine_ratings = pd.read_parquet(f'{BASE_DIR}/compare_data/pertinent_wine_ratings.parquet')
-    xwine_wine_id = wine.wine_id
-
-    filter_wine_ratings = pertinent_wine_ratings[pertinent_wine_ratings['WineID'] == xwine_wine_id]
-    list_vintages = filter_wine_ratings['Vintage'].unique().tolist()
+    # Get the vintages from the shared compare dataset and from the wines added since it was built
+    compare_data = compare_index.get().compare_data
+    list_vintages = get_vintages(wine, compare_data, compare_delta.get(compare_data=compare_data))
     # Serialize the list of vintages
     returned_data = {
         "wine_id": wine_id,
@@ -58,6 +74,138 @@ def get_list_vintages(request):
     return HttpResponse(content='Invalid data', status=400)
 
 
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def get_list_vintages_batch(request):
+    """
+    Get the lists of vintages available for comparing
+    for several wine_ids
+    :param request:
+    :return:
+    """
+    wine_ids = request.query_params.get("wine_ids", None)
+    if wine_ids is None:
+        return HttpResponse("wine_ids is a required parameter", status=400)
+    try:
+        wine_ids = list(dict.fromkeys(int(wine_id) for wine_id in wine_ids.split(",")))
+    except ValueError:
+        return HttpResponse("wine_ids must be a comma separated list of integers", status=400)
+    if len(wine_ids) > LIST_VINTAGES_BATCH_MAX_WINES:
+        return HttpResponse(f"At most {LIST_VINTAGES_BATCH_MAX_WINES} wine_ids can be requested", status=400)
+    wines = Wine.objects.get_wines_by_ids(wine_ids)
+    for wine_id in wine_ids:
+        if wine_id not in wines:
+            return HttpResponse(f"wine_id must be valid: {wine_id}", status=400)
+    # Get the cached lists with a single request, with the keys of list_vintages
+    cache_keys = [f'list_vintages_{wine_id}' for wine_id in wine_ids]
+    cached_data = cache.get_many(cache_keys)
+    compare_data = compare_index.get().compare_data
+    delta = compare_delta.get(compare_data=compare_data)
+    list_wines = []
+    new_data = {}
+    for wine_id, cache_key in zip(wine_ids, cache_keys):
+        if cache_key in cached_data:
+            list_wines.append(json.loads(cached_data[cache_key]))
+            continue
+        returned_wine = {
+            "wine_id": wine_id,
+            "list_vintages": get_vintages(wines[wine_id], compare_data, delta)
+        }
+        list_wines.append(returned_wine)
+        new_data[cache_key] = json.dumps(returned_wine)
+    # Cache the data
+    cache.set_many(new_data, timeout=CACHE_TTL)
+
+    serializer = BatchListVintagesSerializer(data={"list_wines": list_wines})
+    if serializer.is_valid():
+        return JsonResponse(serializer.data, status=200)
+    return HttpResponse(content='Invalid data', status=400)
+
+
+def get_ranked_wines(wine, vintage, depth, index, compare_model, delta, wine_type=None, region_id=None,
+                     max_distance=None):
+    """
+    Get the depth + 1 wines nearest to a wine vintage allowed by the filters, sorted by distance.
+    The wines of the delta index are searched next to the compare dataset, whose rows they replace.
+    The wine itself is usually the first one and is removed by compare_wine.
+    :param wine: wine in the DB
+    :param vintage:
+    :param depth:
+    :param index: CompareIndexVersion searched
+    :param compare_model: compare model on the trees or on the approximate index
+    :param delta: DeltaIndex
+    :param wine_type: type of the wine, None for every type
+    :param region_id: id of the region in the DB, None for every region
+    :param max_distance: maximum distance, None for no maximum
+    :return: tuple of list of compare ids of the wines, list of wines
+    """
+    # Initialize the processor on the shared compare dataset
+    data_processor = SharedCompareDataProcessor(compare_data=index.compare_data)
+
+    mask = delta.get_main_mask(compare_catalog.get_mask(index.compare_data, wine_type=wine_type,
+                                                        region_id=region_id))
+    compare_id = get_compare_wine_id(wine)
+    if (compare_id, vintage) in delta:
+        input_wine_composition_and_weather, input_wine_text_review = delta.get_inputs(compare_id, vintage)
+        neighbors = None
+    else:
+        input_wine_composition_and_weather, input_wine_text_review = data_processor.process_data(wine.wine_id,
+                                                                                                 vintage)
+        # The neighbors are read from the precomputed neighbors table when it is up to date and deep enough
+        neighbors = precomputed_neighbors.get_neighbors(index, wine.wine_id, vintage, k=depth + 1,
+                                                        mask=mask, max_distance=max_distance)
+    if neighbors is not None:
+        rows, distances = neighbors
+    else:
+        rows, distances = search_top_k(compare_model, data_processor.data, input_wine_composition_and_weather,
+                                       input_wine_text_review, k=depth + 1, mask=mask, max_distance=max_distance)
+    neighbor_keys = data_processor.normalized_wine_data[['WineID', 'Vintage']].iloc[rows]
+    delta_rows, delta_distances = delta.search(input_wine_composition_and_weather, input_wine_text_review,
+                                               k=depth + 1, mask=delta.get_mask(wine_type=wine_type,
+                                                                                region_id=region_id),
+                                               max_distance=max_distance)
+
+    # Merge the neighbors by distance, the compare dataset first on ties
+    neighbors = [(distance, 0, i, key_wine_id, key_vintage, None)
+                 for i, (key_wine_id, key_vintage, distance) in enumerate(zip(
+                     neighbor_keys['WineID'].tolist(), neighbor_keys['Vintage'].tolist(), distances.tolist()))]
+    neighbors += [(distance, 1, i, delta.keys[row][0], delta.keys[row][1], delta.ids[row])
+                  for i, (row, distance) in enumerate(zip(delta_rows.tolist(), delta_distances.tolist()))]
+    neighbors = sorted(neighbors)[:depth + 1]
+
+    # Get the list of wines, with a single query for all of them
+    dict_wines = Wine.objects.get_wines_by_wine_ids([neighbor[3] for neighbor in neighbors if neighbor[5] is None])
+    dict_delta_wines = Wine.objects.get_wines_by_ids([neighbor[5] for neighbor in neighbors
+                                                      if neighbor[5] is not None])
+    compare_ids = []
+    wines = []
+    for distance, _, _, neighbor_compare_id, neighbor_vintage, neighbor_id in neighbors:
+        if neighbor_id is None:
+            neighbor_wine = dict_wines.get(neighbor_compare_id)
+        else:
+            neighbor_wine = dict_delta_wines.get(neighbor_id)
+        if neighbor_wine is None:
+            # Deleted since it was added to the compare dataset or to the delta index
+            continue
+        returned_wine = {
+            "id": neighbor_wine.id,
+            "wine_id": neighbor_wine.wine_id,
+            "vintage": neighbor_vintage,
+            "distance": distance,
+            "wine_name": neighbor_wine.wine_name,
+            "type": neighbor_wine.type,
+            "elaborate": neighbor_wine.elaborate,
+            "abv": neighbor_wine.abv,
+            "body": neighbor_wine.body,
+            "acidity": neighbor_wine.acidity,
+            "winery": neighbor_wine.winery.winery_name,
+            "region": neighbor_wine.region.region_name
+        }
+        compare_ids.append(neighbor_compare_id)
+        wines.append(returned_wine)
+    return compare_ids, wines
+
+
 @api_view(["GET"])
 @permission_classes([AllowAny])
 def compare_wine(request):
@@ -69,6 +217,10 @@ def compare_wine(request):
     wine_id = request.query_params.get("wine_id", None)
     vintage = request.query_params.get("vintage", None)
     nb_wines = request.query_params.get("nb_wines", '10')
+    search = request.query_params.get("search", "exact")
+    wine_type = request.query_params.get("type", None)
+    region_id = request.query_params.get("region_id", None)
+    max_distance = request.query_params.get("max_distance", None)
     if wine_id is None or vintage is None:
         return HttpResponse("wine_id and vintage are required parameters", status=400)
     wine_id = int(wine_id)
@@ -76,111 +228,64 @@ def compare_wine(request):
     nb_wines = int(nb_wines)
     if nb_wines <= 0:
         return HttpResponse("nb_wines must be a positive integer", status=400)
-    # Check if the data is in the cache
-    cache_key = f'compare_wine_{wine_id}_{vintage}_{nb_wines}'
+    if search not in ["exact", "approx"]:
+        return HttpResponse("search must be exact or approx", status=400)
+    try:
+        region_id = int(region_id) if region_id is not None else None
+        max_distance = float(max_distance) if max_distance is not None else None
+    except ValueError:
+        return HttpResponse("region_id must be an integer and max_distance a number", status=400)
+    # One ranked list is cached per wine, vintage and filters, and sliced for any nb_wines below its depth
+    cache_key = f'compare_wine_{wine_id}_{vintage}'
+    if search == "approx":
+        cache_key += '_approx'
+    if wine_type is not None:
+        cache_key += f'_type_{wine_type}'
+    if region_id is not None:
+        cache_key += f'_region_{region_id}'
+    if max_distance is not None:
+        cache_key += f'_max_distance_{max_distance!r}'
+    # The ranked lists are outdated when the delta index changes
+    delta_version = compare_delta.get_version()
+    cache_key += f'_delta_{delta_version}'
     cached_data = cache.get(cache_key)
-    if cached_data is not None:
-        returned_data = json.loads(cached_data)
-        serializer = WineCompareSerializer(returned_data)
-        return JsonResponse(serializer.data, status=200)
-    # Get the wine
-    path_pertinent_wine_ratings = f'{BASE_DIR}/compare_data/pertinent_wine_ratings.parquet'
-    path_normalized_wine_data = f'{BASE_DIR}/compare_data/normalized_wine_data.parquet'
-    path_pertinent_ratings_non_null = f'{BASE_DIR}/compare_data/pertinent_ratings_non_null.parquet'
-    path_aggregated_doc_vector = f'{BASE_DIR}/compare_data/aggregated_doc_vector.csv'
-
-    wine = Wine.objects.get_wine_by_id(wine_id)
-    xwine_wine_id = wine.wine_id
-
-    # Initialize the model and the processor
-    data_processor = CompareDataProcessor(path_pertinent_wine_ratings=path_pertinent_wine_ratings,
-                                          path_normalized_wine_data=path_normalized_wine_data,
-                                          path_pertinent_ratings_non_null=path_pertinent_ratings_non_null,
-                                          path_aggregated_doc_vector=path_aggregated_doc_vector)
-
-    input_wine_composition_and_weather, input_wine_text_review = data_processor.process_data(xwine_wine_id, vintage)
-
-    # Load the model
-    path_wine_composition_weather_tree = f'{BASE_DIR}/model/wine_composition_weather_tree.joblib'
-    path_wine_text_review_tree = f'{BASE_DIR}/model/wine_text_review_tree.joblib'
-
-    compare_model = CompareModel(path_wine_composition_weather_tree=path_wine_composition_weather_tree,
-                                 path_wine_text_review_tree=path_wine_text_review_tree)
-
-    normalized_wine_data = data_processor.normalized_wine_data
-    aggregated_doc_vector = data_processor.aggregated_doc_vector
-
-    # Query the data
-    if input_wine_text_review is None:
-        have_text_review = False
-        dist_composition_weather, ind_composition_weather, dist_text_review, ind_text_review = compare_model.query_data(
-            input_wine_composition_and_weather, len_comp_weather=len(normalized_wine_data)
-        )
-    else:
-        have_text_review = True
-        dist_composition_weather, ind_composition_weather, dist_text_review, ind_text_review = compare_model.query_data(
-            input_wine_composition_and_weather, len_comp_weather=len(normalized_wine_data),
-            input_wine_text_review=input_wine_text_review, len_text_review=len(aggregated_doc_vector)
-        )
-
-    # create a dictionary with ind as key and dist as value
-    dict_composition_weather_wine = dict(zip(ind_composition_weather[0], dist_composition_weather[0]))
+    ranked_data = json.loads(cached_data) if cached_data is not None else None
+    if ranked_data is None or ranked_data["depth"] < nb_wines or "compare_ids" not in ranked_data:
+        # Get the wine
+        wine = Wine.objects.get_wine_by_id(wine_id)
 
-    if have_text_review:
-        dict_text_review_wine = dict(zip(ind_text_review[0], dist_text_review[0]))
+        # Get the dataset and the trees shared by the requests of the worker, from the same version
+        index = compare_index.get()
+        # Get the model on the trees or on the approximate index.
+        # The search is exact while the approximate index is not built or outdated
+        compare_model = compare_ann.get_compare_model(index) if search == "approx" else None
+        if compare_model is None:
+            compare_model = index.compare_model
 
-    normalized_wine_name_data = normalized_wine_data[['WineID', 'Vintage', 'WineName']]
-    normalized_wine_name_data['distance_no_text'] = normalized_wine_data.index.map(dict_composition_weather_wine)
-
-    wine_name_data = aggregated_doc_vector[['WineID', 'Vintage']]
-    if have_text_review:
-        wine_name_data['distance_text'] = aggregated_doc_vector.index.map(dict_text_review_wine)
-
-    # Merge the datasets based on 'Name' and 'Age'
-    merged_wine_data = pd.merge(normalized_wine_name_data, wine_name_data, on=['WineID', 'Vintage'], how='left')
-
-    if have_text_review:
-        # Fill null values with 0 before adding 'ScoreDay1' and 'ScoreDay2'
-        merged_wine_data['distance'] = merged_wine_data['distance_no_text'].fillna(0) + merged_wine_data[
-            'distance_text'].fillna(0)
-
-        # Drop the redundant 'ScoreDay1' and 'ScoreDay2' columns if needed
-        merged_wine_data = merged_wine_data.drop(['distance_no_text', 'distance_text'], axis=1)
-
-    if have_text_review:
-        distance_column = 'distance'
-    else:
-        distance_column = 'distance_no_text'
-
-    sorted_df = merged_wine_data.sort_values(by=[distance_column])
+        depth = max(COMPARE_CACHE_DEPTH, nb_wines)
+        compare_ids, list_wines = get_ranked_wines(wine, vintage, depth, index, compare_model,
+                                                   compare_delta.get(delta_version, index.compare_data),
+                                                   wine_type=wine_type, region_id=region_id,
+                                                   max_distance=max_distance)
+        ranked_data = {
+            "compare_id": get_compare_wine_id(wine),
+            "depth": depth,
+            "compare_ids": compare_ids,
+            "list_wines": list_wines
+        }
+        # Cache the data
+        cache.set(cache_key, json.dumps(ranked_data), timeout=CACHE_TTL)
 
-    top_wines_plus_one = sorted_df.head(nb_wines + 1)
+    compare_id = ranked_data["compare_id"]
+    top_compare_ids = ranked_data["compare_ids"][:nb_wines + 1]
+    top_wines_plus_one = ranked_data["list_wines"][:nb_wines + 1]
     # Remove the wine itself from the list
-    if xwine_wine_id in top_wines_plus_one['WineID'].values and vintage in top_wines_plus_one['Vintage'].values:
-        top_wines = top_wines_plus_one[(top_wines_plus_one['WineID'] != xwine_wine_id) |
-                                       (top_wines_plus_one['Vintage'] != vintage)]
+    if compare_id in top_compare_ids and \
+            vintage in [wine["vintage"] for wine in top_wines_plus_one]:
+        wines = [wine for wine, wine_compare_id in zip(top_wines_plus_one, top_compare_ids)
+                 if wine_compare_id != compare_id or wine["vintage"] != vintage]
     else:
-        top_wines = top_wines_plus_one.head(nb_wines)
-
-    # Get the list of wines
-    wines = []
-    for index, row in top_wines.iterrows():
-        wine = Wine.objects.get_wine_by_wine_id(row['WineID'])
-        returned_wine = {
-            "id": wine.id,
-            "wine_id": row['WineID'],
-            "vintage": row['Vintage'],
-            "distance": row[distance_column],
-            "wine_name": wine.wine_name,
-            "type": wine.type,
-            "elaborate": wine.elaborate,
-            "abv": wine.abv,
-            "body": wine.body,
-            "acidity": wine.acidity,
-            "winery": wine.winery.winery_name,
-            "region": wine.region.region_name
-        }
-        wines.append(returned_wine)
+        wines = top_wines_plus_one[:nb_wines]
 
     # Serialize the list of wines
     returned_data = {
@@ -189,8 +294,6 @@ def compare_wine(request):
         "nb_wines": nb_wines,
         "list_wines": wines
     }
-    # Cache the data
-    cache.set(cache_key, json.dumps(returned_data), timeout=CACHE_TTL)
 
     serializer = WineCompareSerializer(data=returned_data)
     if serializer.is_valid():
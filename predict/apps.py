@@ -1,6 +1,24 @@
+import logging
 from django.apps import AppConfig
 
 
+logger = logging.getLogger(__name__)
+
+
 class PredictConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'predict'
+
+    def preload(self):
+        """
+        Load the models and datasets before the first request, called by wsgi.py in the serving processes only
+        :return:
+        """
+        from predict.registry import model_registry
+        from predict.stores import forecast_store, weather_store, scaler_store, ratings_index
+        for resource in [model_registry, forecast_store, weather_store, scaler_store, ratings_index]:
+            try:
+                resource.get()
+            except (OSError, IOError) as e:
+                # The resource will be loaded on the first request instead
+                logger.warning(f'Could not preload the {resource.name}: {e}')
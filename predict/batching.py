@@ -0,0 +1,151 @@
+import logging
+import queue
+import threading
+import time
+import numpy as np
+from predict.registry import model_registry
+from wine_api.settings import PREDICT_MICRO_BATCH_WINDOW_MS, PREDICT_MICRO_BATCH_MAX_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+# Put in the queue by stop(), distinct from the None of an empty carry
+_STOP = object()
+
+
+class PendingPrediction:
+    """
+    Inputs submitted by a caller and the place where its result is delivered
+    """
+
+    def __init__(self, time_series_input, numerical_input):
+        self.time_series_input = time_series_input
+        self.numerical_input = numerical_input
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.numerical_input)
+
+
+class MicroBatcher:
+    """
+    Collect the predictions submitted by concurrent requests during a short window
+    and run them as a single batch of the model
+    """
+
+    def __init__(self, model, window: float, max_batch_size: int):
+        """
+        Constructor
+        :param model: object with a predict(time_series_input, numerical_input) method
+        :param window: time to wait for other requests after the first one, in seconds
+        :param max_batch_size: maximum number of rows of a batch
+        """
+        self.model = model
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.nb_batches = 0
+        self.nb_rows = 0
+        self._queue = queue.Queue()
+        self._carry = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def predict(self, time_series_input, numerical_input):
+        """
+        Submit the inputs and wait for the predictions of this caller only
+        :param time_series_input:
+        :param numerical_input:
+        :return: list_predict_rating
+        """
+        self.start()
+        pending = PendingPrediction(time_series_input, numerical_input)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def start(self):
+        # The thread is started lazily so that it belongs to the worker process
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(_STOP)
+                self._thread.join()
+            self._thread = None
+
+    def _next_batch(self):
+        first = self._carry if self._carry is not None else self._queue.get()
+        self._carry = None
+        if first is _STOP:
+            return None
+        batch = [first]
+        size = len(first)
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if pending is _STOP or size + len(pending) > self.max_batch_size:
+                # Keep it for the next batch
+                self._carry = pending
+                break
+            batch.append(pending)
+            size += len(pending)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        try:
+            list_predict_rating = self.model.predict(
+                time_series_input=np.concatenate([pending.time_series_input for pending in batch]),
+                numerical_input=np.concatenate([pending.numerical_input for pending in batch]),
+            )
+            start = 0
+            for pending in batch:
+                pending.result = list_predict_rating[start:start + len(pending)]
+                start += len(pending)
+        except Exception as e:
+            logger.exception('Micro-batch prediction failed')
+            for pending in batch:
+                pending.error = e
+        self.nb_batches += 1
+        self.nb_rows += sum(len(pending) for pending in batch)
+        for pending in batch:
+            pending.done.set()
+
+
+micro_batcher = MicroBatcher(
+    model=model_registry,
+    window=PREDICT_MICRO_BATCH_WINDOW_MS / 1000,
+    max_batch_size=PREDICT_MICRO_BATCH_MAX_SIZE,
+)
+
+
+def get_predict_model():
+    """
+    Return the micro-batcher when it is enabled, the shared model otherwise
+    :return:
+    """
+    if PREDICT_MICRO_BATCH_WINDOW_MS > 0:
+        return micro_batcher
+    return model_registry.get_predict_model()
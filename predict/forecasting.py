@@ -0,0 +1,376 @@
+import hashlib
+import json
+import threading
+import time
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from nixtlats import TimeGPT
+from wine_api.settings import (
+    CACHE_TTL,
+    TIMEGPT_CLIENT,
+    TIMEGPT_TOKEN_TTL,
+    FORECAST_LOCK_TIMEOUT,
+    FORECAST_BACKEND,
+    LOCAL_FORECAST_METHOD,
+)
+from wine_api.singleflight import SingleFlight
+
+
+WEATHER_FIELDS = ['avg_temperature', 'min_temperature', 'max_temperature',
+                  'avg_sunshine_duration', 'min_sunshine_duration', 'max_sunshine_duration',
+                  'avg_precipitation', 'avg_rain', 'avg_snowfall',
+                  'avg_humidity', 'avg_wind_speed', 'avg_soil_temperature',
+                  'avg_soil_moisture']
+
+# Frequencies supported by the local engine, its seasonality is 12 months
+MONTHLY_FREQUENCIES = ['MS', 'M']
+
+
+class StubTimeGPT:
+    """
+    Local stand-in of the TimeGPT client, repeating the last year of the series.
+    Used for testing without network access or API quota.
+    """
+
+    def __init__(self, token):
+        self.token = token
+
+    def validate_token(self):
+        return bool(self.token)
+
+    def forecast(self, df, h, time_col='ds', target_col='y', freq='MS', id_col=None, **kwargs):
+        if id_col is not None and id_col in df.columns:
+            return pd.concat([
+                self.forecast(series_df, h, time_col=time_col, target_col=target_col, freq=freq)
+                .assign(**{id_col: unique_id})
+                for unique_id, series_df in df.groupby(id_col, sort=False)
+            ], ignore_index=True)
+        df = df.sort_values(time_col)
+        season = df[target_col].to_numpy()[-12:]
+        last_timestamp = pd.Timestamp(df[time_col].iloc[-1])
+        timestamps = pd.date_range(last_timestamp, periods=h + 1, freq=freq)[1:]
+        return pd.DataFrame({
+            time_col: timestamps.strftime('%Y-%m-%d').tolist(),
+            'TimeGPT': [float(season[i % len(season)]) for i in range(h)],
+        })
+
+
+def get_timegpt_client(token):
+    if TIMEGPT_CLIENT == 'stub':
+        return StubTimeGPT(token=token)
+    return TimeGPT(token=token)
+
+
+class TokenValidator:
+    """
+    Cache the result of TimeGPT.validate_token per token for a bounded time
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1024):
+        """
+        Constructor
+        :param ttl: time in seconds during which a validation is reused
+        :param max_size: maximum number of cached tokens
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._results = {}
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+
+    def is_valid(self, token):
+        # Only the hash of the token is kept in memory
+        key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            result = self._results.get(key)
+        if result is not None and result[1] > now:
+            return result[0]
+        is_valid = self._flight.do(key, lambda: bool(get_timegpt_client(token).validate_token()))
+        with self._lock:
+            if len(self._results) >= self.max_size:
+                self._results = {k: v for k, v in self._results.items() if v[1] > now}
+                if len(self._results) >= self.max_size:
+                    self._results.clear()
+            self._results[key] = (is_valid, now + self.ttl)
+        return is_valid
+
+
+token_validator = TokenValidator(ttl=TIMEGPT_TOKEN_TTL)
+forecast_flight = SingleFlight()
+
+
+class TimeGPTBackend:
+    """
+    Forecast with the remote TimeGPT API.
+    Several series are sent in one multi-series call, keyed by a unique_id.
+    """
+
+    name = 'timegpt'
+    requires_api_key = True
+
+    def forecast_regions(self, weather_index, region_ids, fields, h, freq, api_key=None, series=None):
+        """
+        Forecast weather fields of regions
+        :param weather_index: RegionIndex of the weather data with a timestamp column
+        :param region_ids: Identifiers of the regions from X-Wines dataset
+        :param fields: weather fields to forecast
+        :param h: number of periods to forecast
+        :param freq:
+        :param api_key:
+        :param series: (region_id, field) pairs to forecast, every field of every region by default
+        :return: dict of (region_id, field): dict of timestamp, predict_value
+        """
+        model = get_timegpt_client(api_key)
+        if len(region_ids) == 1 and len(fields) == 1:
+            region_id, field = region_ids[0], fields[0]
+            # Copy the rows so the shared dataset is never modified by the client
+            weather_data = weather_index.get_region(region_id).copy()
+            forecast_df = model.forecast(
+                df=weather_data,
+                h=h,
+                time_col='timestamp',
+                target_col=field,
+                freq=freq,
+            )
+            return {
+                (region_id, field): {
+                    'timestamp': forecast_df['timestamp'].tolist(),
+                    'predict_value': forecast_df['TimeGPT'].tolist(),
+                }
+            }
+
+        # Long format frame with one unique_id per (region, field)
+        weather_data = pd.concat([weather_index.get_region(region_id) for region_id in region_ids])
+        long_df = weather_data[['RegionID', 'timestamp'] + list(fields)].melt(
+            id_vars=['RegionID', 'timestamp'], var_name='field', value_name='value')
+        if series is None:
+            series = [(region_id, field) for region_id in region_ids for field in fields]
+        series_keys = {f'{region_id}|{field}': (region_id, field) for region_id, field in series}
+        long_df['unique_id'] = long_df['RegionID'].astype(str) + '|' + long_df['field']
+        # Only the requested series are sent, not every field of every region
+        long_df = long_df[long_df['unique_id'].isin(series_keys)]
+        forecast_df = model.forecast(
+            df=long_df[['unique_id', 'timestamp', 'value']],
+            h=h,
+            id_col='unique_id',
+            time_col='timestamp',
+            target_col='value',
+            freq=freq,
+        )
+        forecasts = {}
+        for unique_id, series_df in forecast_df.groupby('unique_id', sort=False):
+            if unique_id in series_keys:
+                forecasts[series_keys[unique_id]] = {
+                    'timestamp': series_df['timestamp'].tolist(),
+                    'predict_value': series_df['TimeGPT'].tolist(),
+                }
+        return forecasts
+
+
+class LocalBackend:
+    """
+    Forecast locally with NumPy, every series of every region in one vectorized pass
+    """
+
+    name = 'local'
+    requires_api_key = False
+    season = 12
+
+    def __init__(self, method='holt_winters', alpha=0.3, beta=0.05, gamma=0.2, phi=0.98):
+        """
+        Constructor
+        :param method: holt_winters (additive, damped trend) or seasonal_naive
+        :param alpha: smoothing of the level
+        :param beta: smoothing of the trend
+        :param gamma: smoothing of the seasonality
+        :param phi: damping of the trend
+        """
+        if method not in ['holt_winters', 'seasonal_naive']:
+            raise ValueError('method must be holt_winters or seasonal_naive')
+        self.method = method
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.phi = phi
+
+    def build_series(self, weather_index, region_ids, fields):
+        """
+        Stack the series of the regions in a matrix, aligned on their last month
+        :param weather_index: RegionIndex
+        :param region_ids:
+        :param fields:
+        :return: series of shape (regions, fields, months) padded with NaN on the left,
+        region_ids found in the index, timestamp of their last month
+        """
+        slices = [(region_id, weather_index.region_slices[region_id][:2]) for region_id in region_ids
+                  if region_id in weather_index.region_slices]
+        found_region_ids = [region_id for region_id, _ in slices]
+        if not slices:
+            return np.empty((0, len(fields), 0)), [], []
+        starts = np.array([start for _, (start, _) in slices])
+        stops = np.array([stop for _, (_, stop) in slices])
+        lengths = stops - starts
+        nb_months = int(lengths.max())
+        # Position of every row of the selected regions in the matrix
+        rows = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+        series_index = np.repeat(np.arange(len(slices)), lengths)
+        columns = rows - np.repeat(starts, lengths) + np.repeat(nb_months - lengths, lengths)
+        values = weather_index.df[fields].to_numpy(dtype=np.float64)[rows]
+        series = np.full((len(slices), len(fields), nb_months), np.nan)
+        series[series_index, :, columns] = values
+        last_timestamps = weather_index.df['timestamp'].to_numpy()[stops - 1]
+        return series, found_region_ids, last_timestamps
+
+    def forecast_series(self, series, h):
+        """
+        Forecast a matrix of series
+        :param series: array of shape (n, months), padded with NaN on the left
+        :param h: number of months to forecast
+        :return: array of shape (n, h)
+        """
+        n, nb_months = series.shape
+        horizon = np.arange(h)
+        observed = ~np.isnan(series)
+        if self.method == 'seasonal_naive' or nb_months < 2 * self.season:
+            # Repeat the last season, shortened to the observed months of the series shorter than a season
+            season_lengths = np.clip(np.minimum(self.season, nb_months - observed.argmax(axis=1)), 1, None)
+            columns = nb_months - season_lengths[:, None] + horizon[None, :] % season_lengths[:, None]
+            return series[np.arange(n)[:, None], columns]
+
+        # Initial state from the first season observed of every series
+        first = np.clip(observed.argmax(axis=1), 0, nb_months - self.season)
+        window = series[np.arange(n)[:, None], first[:, None] + np.arange(self.season)]
+        level = np.nanmean(window, axis=1)
+        trend = np.zeros(n)
+        seasonal = np.zeros((n, self.season))
+        seasonal[np.arange(n)[:, None], (first[:, None] + np.arange(self.season)) % self.season] = \
+            np.nan_to_num(window - level[:, None])
+
+        for t in range(nb_months):
+            value = series[:, t]
+            is_observed = observed[:, t]
+            season_index = t % self.season
+            season_value = seasonal[:, season_index]
+            new_level = self.alpha * (value - season_value) + (1 - self.alpha) * (level + self.phi * trend)
+            new_trend = self.beta * (new_level - level) + (1 - self.beta) * self.phi * trend
+            new_season_value = self.gamma * (value - new_level) + (1 - self.gamma) * season_value
+            # The state is only updated by the observed months
+            level = np.where(is_observed, new_level, level)
+            trend = np.where(is_observed, new_trend, trend)
+            seasonal[:, season_index] = np.where(is_observed, new_season_value, season_value)
+
+        damped_trend = np.cumsum(self.phi ** (horizon + 1))
+        return level[:, None] + damped_trend[None, :] * trend[:, None] + \
+            seasonal[:, (nb_months + horizon) % self.season]
+
+    def forecast_regions(self, weather_index, region_ids, fields, h, freq, api_key=None, series=None):
+        """
+        Forecast weather fields of regions in one pass over the data
+        :param weather_index: RegionIndex of the weather data with a timestamp column
+        :param region_ids: Identifiers of the regions from X-Wines dataset
+        :param fields: weather fields to forecast
+        :param h: number of periods to forecast
+        :param freq: monthly frequency
+        :param api_key: unused
+        :param series: (region_id, field) pairs to forecast, every field of every region by default
+        :return: dict of (region_id, field): dict of timestamp, predict_value
+        """
+        if freq not in MONTHLY_FREQUENCIES:
+            raise ValueError(f'freq must be in this list for the local backend: {", ".join(MONTHLY_FREQUENCIES)}')
+        values, found_region_ids, last_timestamps = self.build_series(weather_index, region_ids, fields)
+        if not found_region_ids:
+            return {}
+        # Only the rows of the requested series are forecast
+        region_indices = {region_id: i for i, region_id in enumerate(found_region_ids)}
+        field_indices = {field: j for j, field in enumerate(fields)}
+        if series is None:
+            series = [(region_id, field) for region_id in found_region_ids for field in fields]
+        series = [(region_id, field) for region_id, field in series if region_id in region_indices]
+        if not series:
+            return {}
+        rows = [region_indices[region_id] * len(fields) + field_indices[field] for region_id, field in series]
+        predictions = self.forecast_series(values.reshape(-1, values.shape[2])[rows], h)
+        timestamps = {}
+        forecasts = {}
+        for (region_id, field), prediction in zip(series, predictions):
+            last_timestamp = pd.Timestamp(last_timestamps[region_indices[region_id]])
+            if last_timestamp not in timestamps:
+                timestamps[last_timestamp] = pd.date_range(last_timestamp, periods=h + 1, freq=freq)[1:] \
+                    .strftime('%Y-%m-%d').tolist()
+            forecasts[(region_id, field)] = {
+                'timestamp': timestamps[last_timestamp],
+                'predict_value': prediction.tolist(),
+            }
+        return forecasts
+
+
+FORECAST_BACKENDS = {
+    'timegpt': TimeGPTBackend(),
+    'local': LocalBackend(method=LOCAL_FORECAST_METHOD),
+}
+
+
+def get_forecast_backend(name=None):
+    """
+    Get a forecasting backend by name, the FORECAST_BACKEND setting by default
+    :param name:
+    :return: backend, None if the name is unknown
+    """
+    return FORECAST_BACKENDS.get(name or FORECAST_BACKEND)
+
+
+def forecast_weather_data(cache_key, backend, weather_index, region_id, predict_field, nb_months, frequency,
+                          api_key=None):
+    """
+    Forecast a weather field of a region and cache the result.
+    Concurrent calls with the same cache_key make a single forecast,
+    inside a worker and across the workers sharing the cache.
+    :param cache_key:
+    :param backend: TimeGPTBackend or LocalBackend
+    :param weather_index: RegionIndex of the weather data with a timestamp column
+    :param region_id: Identifier of the region from X-Wines dataset
+    :param predict_field:
+    :param nb_months:
+    :param frequency:
+    :param api_key:
+    :return: dict of timestamp, predict_field, predict_value
+    """
+    return forecast_flight.do(cache_key, _forecast_once, cache_key, backend, weather_index, region_id,
+                              predict_field, nb_months, frequency, api_key)
+
+
+def _forecast_once(cache_key, backend, weather_index, region_id, predict_field, nb_months, frequency, api_key):
+    # Only one worker computes the forecast, the others wait for its result in the cache
+    lock_key = f'{cache_key}_lock'
+    deadline = time.monotonic() + FORECAST_LOCK_TIMEOUT
+    acquired = cache.add(lock_key, 1, timeout=FORECAST_LOCK_TIMEOUT)
+    while not acquired and time.monotonic() < deadline:
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            return json.loads(cached_response)
+        time.sleep(0.1)
+        acquired = cache.add(lock_key, 1, timeout=FORECAST_LOCK_TIMEOUT)
+    try:
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            return json.loads(cached_response)
+        forecast = backend.forecast_regions(
+            weather_index=weather_index,
+            region_ids=[region_id],
+            fields=[predict_field],
+            h=int(nb_months),
+            freq=frequency,
+            api_key=api_key,
+        )[(region_id, predict_field)]
+        returned_data = {
+            'timestamp': forecast['timestamp'],
+            'predict_field': predict_field,
+            'predict_value': forecast['predict_value'],
+        }
+        cache.set(cache_key, json.dumps(returned_data), timeout=CACHE_TTL)
+        return returned_data
+    finally:
+        if acquired:
+            cache.delete(lock_key)
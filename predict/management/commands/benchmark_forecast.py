@@ -0,0 +1,63 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from predict.forecasting import WEATHER_FIELDS, LocalBackend, TimeGPTBackend
+from predict.stores import RegionIndex, weather_store
+
+
+class Command(BaseCommand):
+    help = 'Compare the latency and the accuracy of the local forecasting engine with TimeGPT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--regions', type=int, default=100, help='Number of regions to forecast')
+        parser.add_argument('--nb-months', type=int, default=12, help='Number of months to forecast')
+        parser.add_argument('--api-key', type=str, default=None,
+                            help='TimeGPT api_key, the remote path is skipped without it')
+        parser.add_argument('--remote-series', type=int, default=5,
+                            help='Number of series forecast with TimeGPT, one call per series')
+
+    def handle(self, *args, **options):
+        h = options['nb_months']
+        weather_index = weather_store.get()
+        region_ids = list(weather_index.region_slices)[:options['regions']]
+
+        # Hold out the last h months of every region to measure the error
+        df = weather_index.df[weather_index.df['RegionID'].isin(region_ids)]
+        position_from_end = df.groupby('RegionID').cumcount(ascending=False)
+        train_index = RegionIndex(df[position_from_end >= h])
+        actual = {}
+        test_df = df[position_from_end < h]
+        for region_id, region_df in test_df.groupby('RegionID'):
+            for field in WEATHER_FIELDS:
+                actual[(region_id, field)] = region_df[field].to_numpy(dtype=np.float64)
+
+        nb_series = len(region_ids) * len(WEATHER_FIELDS)
+        self.stdout.write(f'{len(region_ids)} regions, {len(WEATHER_FIELDS)} fields, {nb_series} series, '
+                          f'{h} months')
+        self.stdout.write(f'{"backend":>28} {"total (ms)":>12} {"per series (ms)":>16} {"MAE":>10}')
+        for method in ['seasonal_naive', 'holt_winters']:
+            backend = LocalBackend(method=method)
+            start_time = time.perf_counter()
+            forecasts = backend.forecast_regions(train_index, region_ids, WEATHER_FIELDS, h, 'MS')
+            duration = time.perf_counter() - start_time
+            self.write_row(f'local ({method})', duration, len(forecasts), forecasts, actual)
+
+        if options['api_key'] is None:
+            self.stdout.write('TimeGPT skipped, give --api-key to benchmark the remote path')
+            return
+        backend = TimeGPTBackend()
+        series = [(region_id, field) for region_id in region_ids for field in WEATHER_FIELDS]
+        series = series[:options['remote_series']]
+        forecasts = {}
+        start_time = time.perf_counter()
+        for region_id, field in series:
+            forecasts.update(backend.forecast_regions(train_index, [region_id], [field], h, 'MS',
+                                                      api_key=options['api_key']))
+        duration = time.perf_counter() - start_time
+        self.write_row('timegpt', duration, len(forecasts), forecasts, actual)
+
+    def write_row(self, name, duration, nb_series, forecasts, actual):
+        errors = [np.nanmean(np.abs(np.array(forecast['predict_value'], dtype=np.float64) - actual[key]))
+                  for key, forecast in forecasts.items() if key in actual]
+        self.stdout.write(f'{name:>28} {duration * 1000:>12.1f} {duration * 1000 / max(nb_series, 1):>16.3f} '
+                          f'{np.nanmean(errors) if errors else float("nan"):>10.3f}')
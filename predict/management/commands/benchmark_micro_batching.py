@@ -0,0 +1,62 @@
+import threading
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from predict.batching import MicroBatcher
+from predict.registry import model_registry
+
+
+class Command(BaseCommand):
+    help = 'Measure the throughput and the latency of predict_rating inferences for several micro-batch windows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--windows', type=str, default='0,1,2,5,10,20',
+                            help='Comma separated micro-batch windows in milliseconds, 0 disables micro-batching')
+        parser.add_argument('--max-batch-size', type=int, default=64)
+        parser.add_argument('--clients', type=int, default=32, help='Number of concurrent clients')
+        parser.add_argument('--requests', type=int, default=20, help='Number of requests per client')
+
+    def handle(self, *args, **options):
+        windows = [float(window) for window in options['windows'].split(',')]
+        model = model_registry.get_predict_model()
+        self.stdout.write(f'Model loaded in {model_registry.load_time:.2f} s')
+        # Inputs of a single predict_rating request
+        shapes = [tuple(model_input.shape[1:]) for model_input in model_registry.get().cnn_model.inputs]
+        time_series_input = np.random.rand(1, *shapes[0]).astype(np.float32)
+        numerical_input = np.random.rand(1, *shapes[1]).astype(np.float32)
+
+        self.stdout.write(f'{"window (ms)":>12} {"req/s":>10} {"p50 (ms)":>10} {"p95 (ms)":>10} '
+                          f'{"p99 (ms)":>10} {"batch size":>11}')
+        for window in windows:
+            if window > 0:
+                batcher = MicroBatcher(model, window=window / 1000, max_batch_size=options['max_batch_size'])
+            else:
+                batcher = model
+            latencies = []
+            latencies_lock = threading.Lock()
+
+            def client():
+                client_latencies = []
+                for _ in range(options['requests']):
+                    start_time = time.perf_counter()
+                    batcher.predict(time_series_input=time_series_input, numerical_input=numerical_input)
+                    client_latencies.append(time.perf_counter() - start_time)
+                with latencies_lock:
+                    latencies.extend(client_latencies)
+
+            threads = [threading.Thread(target=client) for _ in range(options['clients'])]
+            start_time = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time.perf_counter() - start_time
+            if window > 0:
+                batcher.stop()
+                batch_size = batcher.nb_rows / max(batcher.nb_batches, 1)
+            else:
+                batch_size = 1
+            latencies_ms = np.array(latencies) * 1000
+            self.stdout.write(f'{window:>12g} {len(latencies) / duration:>10.1f} '
+                              f'{np.percentile(latencies_ms, 50):>10.2f} {np.percentile(latencies_ms, 95):>10.2f} '
+                              f'{np.percentile(latencies_ms, 99):>10.2f} {batch_size:>11.1f}')
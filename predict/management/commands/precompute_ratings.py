@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import time
+import pandas as pd
+from django.core.management.base import BaseCommand
+from wine.models import Wine
+from predict.precompute import (
+    PRECOMPUTED_COLUMNS,
+    fingerprint,
+    wine_fingerprint,
+    ratings_fingerprint,
+    model_fingerprint,
+    make_wine,
+    predict_task,
+    read_precomputed_ratings,
+    path_precomputed_ratings,
+)
+from predict.stores import ratings_index
+
+
+class Command(BaseCommand):
+    help = 'Predict the ratings of predict_all_rating for every wine of wine_ratings.parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rating-years', type=str, default='2023',
+                            help='Comma separated rating years to precompute')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=256,
+                            help='Number of wines predicted in one forward pass')
+        parser.add_argument('--full', action='store_true',
+                            help='Predict every wine again instead of only the wines whose inputs changed')
+
+    def handle(self, *args, **options):
+        rating_years = [int(rating_year) for rating_year in options['rating_years'].split(',')]
+        for rating_year in rating_years:
+            if rating_year < 2023:
+                self.stderr.write('rating_year must be greater than 2023')
+                return
+        start_time = time.perf_counter()
+
+        # Any change of the model or of its data invalidates all the predictions,
+        # a change of the ratings of a wine only its predictions
+        model_hash = model_fingerprint()
+
+        # Previous predictions, kept for the wines whose inputs did not change
+        previous_hashes = {}
+        previous_df = None if options['full'] else read_precomputed_ratings(path_precomputed_ratings)
+        if previous_df is not None:
+            previous_hashes = dict(zip(zip(previous_df['WineID'], previous_df['RatingYear']),
+                                       previous_df['InputHash']))
+
+        index = ratings_index.get()
+        wines = {}
+        for wine in Wine.objects.select_related('region').filter(wine_id__isnull=False).order_by('id'):
+            # Same wine as get_wine_by_wine_id when the WineID is duplicated
+            wines.setdefault(wine.wine_id, wine)
+
+        tasks = []
+        kept_keys = set()
+        for wine_id in index.offsets:
+            wine = wines.get(int(wine_id))
+            if wine is None:
+                continue
+            batch_vintage = index.get(wine_id, 'Vintage').tolist()
+            list_actual_rating = index.get(wine_id, 'AverageRating').tolist()
+            wine_hash = wine_fingerprint(wine)
+            ratings_hash = ratings_fingerprint(batch_vintage, list_actual_rating)
+            for rating_year in rating_years:
+                input_hash = fingerprint(model_hash, wine_hash, rating_year, ratings_hash)
+                if previous_hashes.get((wine.wine_id, rating_year)) == input_hash:
+                    kept_keys.add((wine.wine_id, rating_year))
+                    continue
+                tasks.append({
+                    'wine_id': wine.wine_id,
+                    'wine': make_wine(wine),
+                    'rating_year': rating_year,
+                    'batch_vintage': batch_vintage,
+                    'list_actual_rating': list_actual_rating,
+                    'wine_hash': wine_hash,
+                    'ratings_hash': ratings_hash,
+                    'model_hash': model_hash,
+                    'input_hash': input_hash,
+                })
+        self.stdout.write(f'{len(tasks)} predictions to compute, {len(kept_keys)} unchanged')
+
+        chunks = [tasks[i:i + options['chunk_size']] for i in range(0, len(tasks), options['chunk_size'])]
+        records = []
+        if options['workers'] > 1 and len(chunks) > 1:
+            # Spawn the workers, TensorFlow is not fork-safe
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(processes=min(options['workers'], len(chunks))) as pool:
+                for chunk_records in pool.imap_unordered(predict_task, chunks):
+                    records.extend(chunk_records)
+        else:
+            for chunk in chunks:
+                records.extend(predict_task(chunk))
+
+        precomputed_df = pd.DataFrame.from_records(records, columns=PRECOMPUTED_COLUMNS)
+        if previous_df is not None:
+            kept = pd.Series(list(zip(previous_df['WineID'], previous_df['RatingYear'])),
+                             index=previous_df.index).isin(kept_keys)
+            precomputed_df = pd.concat([previous_df[kept], precomputed_df], ignore_index=True)
+        precomputed_df = precomputed_df.sort_values(['WineID', 'RatingYear'], kind='stable')
+
+        # Write to a temporary file so the workers never read a partial file
+        path_tmp = f'{path_precomputed_ratings}.tmp'
+        precomputed_df.to_parquet(path_tmp, index=False)
+        os.replace(path_tmp, path_precomputed_ratings)
+        self.stdout.write(f'{len(precomputed_df)} ratings written to {path_precomputed_ratings} '
+                          f'in {time.perf_counter() - start_time:.1f} s')
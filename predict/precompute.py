@@ -0,0 +1,164 @@
+import hashlib
+import os
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from predict.stores import ratings_index
+from wine_api.resources import SharedResource
+from wine_api.settings import BASE_DIR
+
+
+PRECOMPUTED_COLUMNS = ['WineID', 'RatingYear', 'Vintage', 'ActualRating', 'PredictRating',
+                       'WineHash', 'RatingsHash', 'ModelHash', 'InputHash']
+
+# Files the predictions of every wine depend on, the ratings of a wine are fingerprinted with the wine
+MODEL_PATHS = [
+    f'{BASE_DIR}/model/cnn_model.h5',
+    f'{BASE_DIR}/model/minmax_scaler.save',
+    f'{BASE_DIR}/model/std_scaler.save',
+    f'{BASE_DIR}/predict_data/forecast_agg_monthly.parquet',
+]
+
+
+def fingerprint(*values):
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:16]
+
+
+def wine_fingerprint(wine):
+    """
+    Fingerprint of the columns of a wine used by the prediction
+    :param wine:
+    :return:
+    """
+    return fingerprint(wine.region.region_id, wine.abv, wine.body, wine.acidity)
+
+
+def ratings_fingerprint(batch_vintage, list_actual_rating):
+    """
+    Fingerprint of the vintages and of the actual ratings of a wine in wine_ratings.parquet
+    :param batch_vintage:
+    :param list_actual_rating:
+    :return:
+    """
+    return fingerprint(np.asarray(batch_vintage).tolist(), np.asarray(list_actual_rating).tolist())
+
+
+def model_fingerprint(paths=MODEL_PATHS):
+    """
+    Fingerprint of the model and of its data files, a change reruns every wine
+    :param paths:
+    :return:
+    """
+    return fingerprint(*[(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in paths])
+
+
+def read_precomputed_ratings(path):
+    """
+    Read the precomputed ratings
+    :param path:
+    :return: dataframe, None if the file is missing or was written without every column
+    """
+    if not os.path.exists(path):
+        return None
+    df = pd.read_parquet(path)
+    if not set(PRECOMPUTED_COLUMNS) <= set(df.columns):
+        return None
+    return df[PRECOMPUTED_COLUMNS]
+
+
+def predict_task(task):
+    """
+    Predict the ratings of a chunk of wines with one forward pass of the model
+    :param task: list of dict with wine_id, wine, batch_vintage, list_actual_rating, rating_year,
+    wine_hash, ratings_hash, model_hash, input_hash
+    :return: list of records
+    """
+    from predict.processor import IndexedPredictDataProcessor
+    from predict.registry import model_registry
+    from predict.stores import forecast_store, scaler_store
+
+    list_time_series_input = []
+    list_numerical_input = []
+    for item in task:
+        data_processor = IndexedPredictDataProcessor(
+            wine=item['wine'],
+            rating_year=item['rating_year'],
+            forecast_store=forecast_store,
+            batch_vintage=item['batch_vintage'],
+            scaler_store=scaler_store,
+        )
+        time_series_input, numerical_input = data_processor.process_data()
+        list_time_series_input.append(time_series_input)
+        list_numerical_input.append(numerical_input)
+    list_predict_rating = model_registry.predict(
+        time_series_input=np.concatenate(list_time_series_input),
+        numerical_input=np.concatenate(list_numerical_input),
+    )
+    records = []
+    start = 0
+    for item in task:
+        for vintage, actual_rating in zip(item['batch_vintage'], item['list_actual_rating']):
+            records.append((item['wine_id'], item['rating_year'], vintage, actual_rating,
+                            list_predict_rating[start], item['wine_hash'], item['ratings_hash'],
+                            item['model_hash'], item['input_hash']))
+            start += 1
+    return records
+
+
+def make_wine(wine):
+    """
+    Picklable copy of the columns of a wine used by the prediction
+    :param wine:
+    :return:
+    """
+    return SimpleNamespace(abv=wine.abv, body=wine.body, acidity=wine.acidity,
+                           region=SimpleNamespace(region_id=wine.region.region_id))
+
+
+class PrecomputedRatings(SharedResource):
+    """
+    Ratings predicted offline by the precompute_ratings command,
+    indexed by WineID and RatingYear.
+    The model and its data are loaded once per process, so their fingerprint is computed once with the ratings:
+    the ratings predicted by another model are not loaded.
+    """
+
+    name = 'precomputed ratings'
+
+    def __init__(self, path_precomputed_ratings):
+        super().__init__(path_precomputed_ratings, watch=True)
+
+    def load(self):
+        df = read_precomputed_ratings(self.paths[0])
+        if df is None:
+            return {}
+        df = df[df['ModelHash'] == model_fingerprint()]
+        index = {}
+        for (wine_id, rating_year), group in df.groupby(['WineID', 'RatingYear'], sort=False):
+            index[(int(wine_id), int(rating_year))] = {
+                'wine_hash': group['WineHash'].iloc[0],
+                'ratings_hash': group['RatingsHash'].iloc[0],
+                'batch_vintage': group['Vintage'].tolist(),
+                'list_actual_rating': group['ActualRating'].tolist(),
+                'list_predict_rating': group['PredictRating'].tolist(),
+            }
+        return index
+
+    def get_ratings(self, wine, rating_year):
+        """
+        Get the precomputed ratings of a wine, None if they are missing or outdated
+        :param wine:
+        :param rating_year:
+        :return:
+        """
+        ratings = self.get().get((wine.wine_id, rating_year))
+        if ratings is None or ratings['wine_hash'] != wine_fingerprint(wine):
+            return None
+        # Only the wines whose ratings changed in wine_ratings.parquet are predicted again
+        if ratings['ratings_hash'] != ratings_fingerprint(*ratings_index.get_ratings(wine.wine_id)):
+            return None
+        return ratings
+
+
+path_precomputed_ratings = f'{BASE_DIR}/predict_data/precomputed_ratings.parquet'
+precomputed_ratings = PrecomputedRatings(path_precomputed_ratings=path_precomputed_ratings)
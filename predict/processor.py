@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from likewines.processor import PredictDataProcessor
+from wine_api.settings import PREDICT_FEATURE_CACHE_MAX_BYTES
+
+
+class FeatureCache:
+    """
+    LRU cache of the scaled features of a wine for a vintage, bounded by the size of its arrays
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Constructor
+        :param max_bytes: maximum size of the cached arrays, 0 disables the cache
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        nbytes = sum(array.nbytes for array in entry)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= sum(array.nbytes for array in previous)
+            self._entries[key] = entry
+            self.size += nbytes
+            # Evict the least recently used entries
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= sum(array.nbytes for array in evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+feature_cache = FeatureCache(max_bytes=PREDICT_FEATURE_CACHE_MAX_BYTES)
+
+
+class IndexedPredictDataProcessor(PredictDataProcessor):
+    """
+    PredictDataProcessor reading the forecast of the region of the wine
+    from the in-memory forecast store instead of the parquet file.
+    The scaled features of each vintage are cached, only the rating_year
+    column is computed for every request.
+    """
+
+    def __init__(self, wine,
+                 rating_year: int,
+                 forecast_store,
+                 batch_vintage: list,
+                 scaler_store,
+                 feature_cache: FeatureCache = feature_cache):
+        """
+        Constructor
+        :param wine:
+        :param rating_year:
+        :param forecast_store: ForecastStore
+        :param batch_vintage:
+        :param scaler_store: ScalerStore
+        :param feature_cache: FeatureCache
+        """
+        self.wine = wine
+        self.rating_year = rating_year
+        self.forecast_store = forecast_store
+        self.forecast_df = None
+        self.batch_vintage = batch_vintage
+        self.minmax_scaler, self.standard_scaler = scaler_store.get()
+        self.feature_cache = feature_cache
+
+    def get_wine_key(self):
+        """
+        Values of the wine the features depend on
+        :return:
+        """
+        return self.wine.region.region_id, self.wine.abv, self.wine.body, self.wine.acidity
+
+    def process_data(self):
+        """
+        Process the data
+        :return: time_series_input, numerical_input
+        """
+        wine_key = self.get_wine_key()
+        features = {}
+        for vintage in set(self.batch_vintage):
+            entry = self.feature_cache.get(wine_key + (vintage,))
+            if entry is not None:
+                features[vintage] = entry
+        missing_vintage = sorted(set(self.batch_vintage) - set(features))
+        if missing_vintage:
+            features.update(self.compute_features(wine_key, missing_vintage))
+
+        time_series_input = np.stack([features[vintage][0] for vintage in self.batch_vintage])
+        numerical_input = np.stack([features[vintage][1] for vintage in self.batch_vintage])
+        # Only the difference between rating_year and the vintage depends on rating_year
+        list_delta_time_rating = self.rating_year - np.array(self.batch_vintage)
+        scaled_list_delta_time_rating = self.standard_scaler.transform(list_delta_time_rating.reshape(-1, 1))
+        numerical_input = np.column_stack([numerical_input, scaled_list_delta_time_rating[:, 0]])
+        return time_series_input, numerical_input
+
+    def compute_features(self, wine_key, batch_vintage):
+        """
+        Compute and cache the features of the given vintages
+        :param wine_key:
+        :param batch_vintage: sorted list of vintages
+        :return: dict of vintage: (time_series_array, numerical_array)
+        """
+        region_id = wine_key[0]
+        self.forecast_df = self.forecast_store.get_window(region_id, batch_vintage)
+        requested_vintage = self.batch_vintage
+        self.batch_vintage = batch_vintage
+        try:
+            time_series_input, numerical_input = super().process_data()
+        finally:
+            self.batch_vintage = requested_vintage
+        features = {}
+        for i, vintage in enumerate(batch_vintage):
+            # The last numerical column depends on rating_year, it is not cached
+            entry = (time_series_input[i].copy(), numerical_input[i, :3].copy())
+            for array in entry:
+                array.setflags(write=False)
+            self.feature_cache.set(wine_key + (vintage,), entry)
+            features[vintage] = entry
+        return features
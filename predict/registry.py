@@ -0,0 +1,71 @@
+import logging
+import threading
+import numpy as np
+from likewines.model import PredictModel
+from wine_api.resources import SharedResource, get_rss
+from wine_api.settings import BASE_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+class PredictModelRegistry(SharedResource):
+    """
+    Keep a single CNN model per worker process.
+    The model is warmed up with a dummy batch after loading and every
+    call to ``predict`` is serialized so the instance can be shared by threads.
+    """
+
+    name = 'CNN model'
+
+    def __init__(self, path_cnn_model):
+        super().__init__(path_cnn_model)
+        self.path_cnn_model = path_cnn_model
+        self.memory_footprint = None
+        self.weights_size = None
+        self._predict_lock = threading.Lock()
+
+    def load(self):
+        rss_before = get_rss()
+        model = PredictModel(path_cnn_model=self.path_cnn_model)
+        # Warm up the model so the first request does not pay for graph tracing
+        dummy_inputs = [np.zeros((1,) + tuple(model_input.shape[1:]), dtype=np.float32)
+                        for model_input in model.cnn_model.inputs]
+        model.predict(time_series_input=dummy_inputs[0], numerical_input=dummy_inputs[1])
+        self.memory_footprint = get_rss() - rss_before
+        self.weights_size = sum(weight.nbytes for weight in model.cnn_model.get_weights())
+        return model
+
+    def get_predict_model(self):
+        """
+        Return the shared model, loading it on first use
+        :return:
+        """
+        self.get()
+        return self
+
+    def predict(self, time_series_input, numerical_input):
+        """
+        Predict the ratings with the shared model
+        :param time_series_input:
+        :param numerical_input:
+        :return: list_predict_rating
+        """
+        model = self.get()
+        with self._predict_lock:
+            return model.predict(
+                time_series_input=time_series_input,
+                numerical_input=numerical_input,
+            )
+
+    def stats(self):
+        return {
+            'loaded': self.is_loaded,
+            'path': self.path_cnn_model,
+            'load_time': self.load_time,
+            'memory_footprint': self.memory_footprint,
+            'weights_size': self.weights_size,
+        }
+
+
+model_registry = PredictModelRegistry(path_cnn_model=f'{BASE_DIR}/model/cnn_model.h5')
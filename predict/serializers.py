@@ -7,6 +7,16 @@ class PredictSerializer(serializers.Serializer):
     predict_value = serializers.ListField(child=serializers.FloatField())
 
 
+class RegionPredictSerializer(PredictSerializer):
+    region_id = serializers.IntegerField()
+
+
+class BatchPredictSerializer(serializers.Serializer):
+    list_forecasts = serializers.ListField(
+        child=RegionPredictSerializer()
+    )
+
+
 class RatingSerializer(serializers.Serializer):
     wine_id = serializers.IntegerField()
     batch_vintage = serializers.IntegerField()
@@ -14,6 +24,12 @@ class RatingSerializer(serializers.Serializer):
     predict_rating = serializers.FloatField()
 
 
+class BatchRatingSerializer(serializers.Serializer):
+    list_ratings = serializers.ListField(
+        child=RatingSerializer()
+    )
+
+
 class PredictField(serializers.DictField):
     batch_vintage = serializers.IntegerField()
     actual_rating = serializers.FloatField()
@@ -26,3 +42,11 @@ class ListRatingSerializer(serializers.Serializer):
     list_ratings = serializers.ListField(
         child=PredictField()
     )
+
+
+class ModelInfoSerializer(serializers.Serializer):
+    loaded = serializers.BooleanField()
+    path = serializers.CharField()
+    load_time = serializers.FloatField(allow_null=True)
+    memory_footprint = serializers.IntegerField(allow_null=True)
+    weights_size = serializers.IntegerField(allow_null=True)
@@ -0,0 +1,166 @@
+import joblib
+import numpy as np
+import pandas as pd
+from wine_api.indexes import GroupedArrays
+from wine_api.resources import SharedResource
+from wine_api.settings import BASE_DIR
+
+
+class RegionIndex:
+    """
+    Monthly weather data sorted by RegionID, year and month.
+    The rows of a region are contiguous so they can be sliced without scanning the frame.
+    """
+
+    def __init__(self, df):
+        """
+        Constructor
+        :param df: dataframe with RegionID, year and month columns
+        """
+        self.df = df.sort_values(['RegionID', 'year', 'month'], kind='stable').reset_index(drop=True)
+        region_ids = self.df['RegionID'].to_numpy()
+        self.periods = self.df['year'].to_numpy().astype(np.int64) * 12 + self.df['month'].to_numpy() - 1
+        starts = np.flatnonzero(np.r_[True, region_ids[1:] != region_ids[:-1]]) if len(region_ids) else \
+            np.array([], dtype=np.int64)
+        stops = np.r_[starts[1:], len(region_ids)].astype(np.int64)
+        self.region_slices = {}
+        for region_id, start, stop in zip(region_ids[starts].tolist(), starts.tolist(), stops.tolist()):
+            periods = self.periods[start:stop]
+            # When there is one row per month, the row of a month is found by its offset
+            contiguous = bool(np.all(np.diff(periods) == 1))
+            self.region_slices[region_id] = (start, stop, int(periods[0]), contiguous)
+
+    def __len__(self):
+        return len(self.df)
+
+    def get_region(self, region_id):
+        """
+        Get the rows of a region
+        :param region_id: Identifier of the region from X-Wines dataset
+        :return: dataframe
+        """
+        region_slice = self.region_slices.get(region_id)
+        if region_slice is None:
+            return self.df.iloc[0:0]
+        start, stop, _, _ = region_slice
+        return self.df.iloc[start:stop]
+
+    def get_rows(self, region_id, year, month=None):
+        """
+        Get the positions of the rows of a region for a year, or for a month of that year
+        :param region_id: Identifier of the region from X-Wines dataset
+        :param year:
+        :param month: optional, all the months of the year if None
+        :return: array of row positions
+        """
+        region_slice = self.region_slices.get(region_id)
+        if region_slice is None:
+            return np.array([], dtype=np.int64)
+        start, stop, first_period, contiguous = region_slice
+        if month is None:
+            low, high = year * 12, year * 12 + 12
+        else:
+            low, high = year * 12 + month - 1, year * 12 + month
+        if contiguous:
+            low = min(max(start + low - first_period, start), stop)
+            high = min(max(start + high - first_period, start), stop)
+        else:
+            periods = self.periods[start:stop]
+            low = start + np.searchsorted(periods, low, side='left')
+            high = start + np.searchsorted(periods, high, side='left')
+        return np.arange(low, high)
+
+    def get_window(self, region_id, years):
+        """
+        Get the rows of a region for the given years, in chronological order
+        :param region_id: Identifier of the region from X-Wines dataset
+        :param years:
+        :return: dataframe
+        """
+        rows = [self.get_rows(region_id, int(year)) for year in sorted(set(years))]
+        if not rows:
+            return self.df.iloc[0:0]
+        return self.df.iloc[np.concatenate(rows)]
+
+
+class ForecastStore(SharedResource):
+    """
+    Forecast of the monthly weather of every region, kept in memory
+    """
+
+    name = 'forecast dataset'
+
+    def __init__(self, path_forecast_df):
+        super().__init__(path_forecast_df)
+
+    def load(self):
+        return RegionIndex(pd.read_parquet(self.paths[0]))
+
+    def get_region(self, region_id):
+        return self.get().get_region(region_id)
+
+    def get_window(self, region_id, years):
+        return self.get().get_window(region_id, years)
+
+
+class WeatherStore(ForecastStore):
+    """
+    Historical monthly weather of every region, kept in memory with its timestamp column
+    """
+
+    name = 'weather dataset'
+
+    def load(self):
+        weather_data = pd.read_parquet(self.paths[0])
+        weather_data['timestamp'] = pd.to_datetime(weather_data[['year', 'month']].assign(DAY=1))
+        return RegionIndex(weather_data)
+
+
+class ScalerStore(SharedResource):
+    """
+    MinMax and standard scalers of the CNN model inputs
+    """
+
+    name = 'scalers'
+
+    def __init__(self, path_minmax_scaler, path_standard_scaler):
+        super().__init__(path_minmax_scaler, path_standard_scaler)
+
+    def load(self):
+        path_minmax_scaler, path_standard_scaler = self.paths
+        with open(path_minmax_scaler, 'rb') as f:
+            minmax_scaler = joblib.load(f)
+        with open(path_standard_scaler, 'rb') as f:
+            standard_scaler = joblib.load(f)
+        return minmax_scaler, standard_scaler
+
+
+class RatingsIndex(SharedResource):
+    """
+    Vintages and average ratings of wine_ratings.parquet grouped by WineID
+    """
+
+    name = 'ratings index'
+
+    def __init__(self, path_wine_ratings):
+        super().__init__(path_wine_ratings)
+
+    def load(self):
+        wine_ratings = pd.read_parquet(self.paths[0], columns=['WineID', 'Vintage', 'AverageRating'])
+        return GroupedArrays(wine_ratings, key='WineID', columns=['Vintage', 'AverageRating'])
+
+    def get_ratings(self, wine_id):
+        """
+        Get the vintages and the actual ratings of a wine
+        :param wine_id: Identifier of the wine from X-Wines dataset
+        :return: tuple of read-only arrays vintages, average_ratings
+        """
+        index = self.get()
+        return index.get(wine_id, 'Vintage'), index.get(wine_id, 'AverageRating')
+
+
+forecast_store = ForecastStore(path_forecast_df=f'{BASE_DIR}/predict_data/forecast_agg_monthly.parquet')
+weather_store = WeatherStore(path_forecast_df=f'{BASE_DIR}/predict_data/agg_monthly.parquet')
+scaler_store = ScalerStore(path_minmax_scaler=f'{BASE_DIR}/model/minmax_scaler.save',
+                           path_standard_scaler=f'{BASE_DIR}/model/std_scaler.save')
+ratings_index = RatingsIndex(path_wine_ratings=f'{BASE_DIR}/db_data/wine_ratings.parquet')
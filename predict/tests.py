@@ -1,3 +1,443 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import resolve
+from rest_framework.test import APIRequestFactory
+from predict.batching import MicroBatcher
+from predict.forecasting import (
+    LocalBackend,
+    StubTimeGPT,
+    TimeGPTBackend,
+    TokenValidator,
+    forecast_weather_data,
+)
+from predict.precompute import (
+    PRECOMPUTED_COLUMNS,
+    PrecomputedRatings,
+    fingerprint,
+    ratings_fingerprint,
+    wine_fingerprint,
+)
+from predict.stores import RegionIndex, weather_store
+from region.models import Region
+from wine.models import Wine
+from wine_api.singleflight import SingleFlight
+from winery.models import Winery
 
-# Create your tests here.
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_weather_index(region_id=1, nb_months=24):
+    timestamps = pd.date_range('2020-01-01', periods=nb_months, freq='MS')
+    return RegionIndex(pd.DataFrame({
+        'RegionID': region_id,
+        'year': timestamps.year,
+        'month': timestamps.month,
+        'timestamp': timestamps,
+        'avg_temperature': np.arange(nb_months, dtype=np.float64),
+    }))
+
+
+def call(request):
+    """
+    Send a request to the view of its path
+    :param request: request built by APIRequestFactory
+    :return: response
+    """
+    match = resolve(request.path)
+    return match.func(request, *match.args, **match.kwargs)
+
+
+def run_concurrently(fn, nb_threads):
+    """
+    Call fn from several threads at once
+    :return: list of results, or of the exceptions raised
+    """
+    barrier = threading.Barrier(nb_threads)
+    results = [None] * nb_threads
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(nb_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class LocalBackendTests(SimpleTestCase):
+    def test_short_series_repeat_their_observed_months(self):
+        # A region with 5 months of data next to a region with 2 years, padded with NaN on the left
+        long_series = np.arange(24, dtype=np.float64)
+        short_series = np.concatenate([np.full(19, np.nan), [1., 2., 3., 4., 5.]])
+        series = np.stack([long_series, short_series])
+        for method in ['seasonal_naive', 'holt_winters']:
+            predictions = LocalBackend(method=method).forecast_series(series[:, 5:], 14)
+            self.assertFalse(np.isnan(predictions[1]).any(), method)
+            np.testing.assert_array_equal(predictions[1], [1., 2., 3., 4., 5.] * 2 + [1., 2., 3., 4.])
+
+        predictions = LocalBackend(method='seasonal_naive').forecast_series(series, 14)
+        np.testing.assert_array_equal(predictions[0], np.concatenate([np.arange(12, 24), [12., 13.]]))
+        np.testing.assert_array_equal(predictions[1], [1., 2., 3., 4., 5.] * 2 + [1., 2., 3., 4.])
+
+    def test_holt_winters_short_series(self):
+        series = np.stack([np.sin(np.arange(36) * np.pi / 6) + 10,
+                           np.concatenate([np.full(31, np.nan), [10., 11., 12., 11., 10.]])])
+        predictions = LocalBackend(method='holt_winters').forecast_series(series, 12)
+        self.assertEqual(predictions.shape, (2, 12))
+        self.assertTrue(np.isfinite(predictions).all())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ForecastCoalescingTests(SimpleTestCase):
+    def test_concurrent_identical_forecasts_make_one_call(self):
+        weather_index = make_weather_index()
+        original_forecast = StubTimeGPT.forecast
+        calls = []
+
+        def slow_forecast(client, *args, **kwargs):
+            calls.append(kwargs['target_col'])
+            # Keep the call in progress while the other requests arrive
+            time.sleep(0.2)
+            return original_forecast(client, *args, **kwargs)
+
+        with mock.patch('predict.forecasting.TIMEGPT_CLIENT', 'stub'), \
+                mock.patch.object(StubTimeGPT, 'forecast', slow_forecast):
+            results = run_concurrently(lambda: forecast_weather_data(
+                'test_forecast_coalescing', TimeGPTBackend(), weather_index, 1, 'avg_temperature', 6, 'MS',
+                api_key='key'), 8)
+
+        self.assertEqual(calls, ['avg_temperature'])
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(results[0]['predict_value'], [12., 13., 14., 15., 16., 17.])
+
+    def test_failed_forecast_releases_the_waiters(self):
+        weather_index = make_weather_index()
+        calls = []
+
+        def failing_forecast(client, *args, **kwargs):
+            calls.append(kwargs['target_col'])
+            time.sleep(0.2)
+            raise ConnectionError('TimeGPT is unreachable')
+
+        with mock.patch('predict.forecasting.TIMEGPT_CLIENT', 'stub'), \
+                mock.patch.object(StubTimeGPT, 'forecast', failing_forecast):
+            results = run_concurrently(lambda: forecast_weather_data(
+                'test_forecast_error', TimeGPTBackend(), weather_index, 1, 'avg_temperature', 6, 'MS',
+                api_key='key'), 4)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(result, ConnectionError) for result in results))
+
+        # The lock is released, the next request forecasts again
+        with mock.patch('predict.forecasting.TIMEGPT_CLIENT', 'stub'):
+            result = forecast_weather_data('test_forecast_error', TimeGPTBackend(), weather_index, 1,
+                                           'avg_temperature', 6, 'MS', api_key='key')
+        self.assertEqual(len(result['predict_value']), 6)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_error_is_raised_to_every_waiter(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fail():
+            calls.append(1)
+            started.set()
+            release.wait()
+            raise ValueError('failed')
+
+        leader = threading.Thread(target=lambda: self.assertRaises(ValueError, flight.do, 'key', fail))
+        leader.start()
+        started.wait()
+        waiter_errors = []
+
+        def wait():
+            try:
+                flight.do('key', fail)
+            except ValueError as e:
+                waiter_errors.append(e)
+
+        waiters = [threading.Thread(target=wait) for _ in range(4)]
+        for waiter in waiters:
+            waiter.start()
+        # Let the waiters block on the call in progress
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + waiters:
+            thread.join(timeout=5)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(waiter_errors), 4)
+        # The failed call is forgotten, the next caller runs the function again
+        self.assertEqual(flight.do('key', lambda: 'ok'), 'ok')
+
+
+class TokenValidatorTests(SimpleTestCase):
+    def test_validation_is_cached_for_its_ttl(self):
+        validator = TokenValidator(ttl=300)
+        now = [1000.0]
+        with mock.patch('predict.forecasting.TIMEGPT_CLIENT', 'stub'), \
+                mock.patch('predict.forecasting.time.monotonic', lambda: now[0]), \
+                mock.patch.object(StubTimeGPT, 'validate_token', autospec=True, return_value=True) as validate:
+            self.assertTrue(validator.is_valid('token'))
+            now[0] += 299
+            self.assertTrue(validator.is_valid('token'))
+            self.assertEqual(validate.call_count, 1)
+
+            # Checked again once the validation expired
+            now[0] += 2
+            validate.return_value = False
+            self.assertFalse(validator.is_valid('token'))
+            self.assertEqual(validate.call_count, 2)
+
+            self.assertFalse(validator.is_valid('other token'))
+            self.assertEqual(validate.call_count, 3)
+
+
+class PrecomputedRatingsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'precomputed_ratings.parquet')
+        region = SimpleNamespace(region_id=1)
+        self.wines = {wine_id: SimpleNamespace(wine_id=wine_id, region=region, abv=13., body='Full-bodied',
+                                               acidity='High') for wine_id in [7, 8]}
+        self.ratings = {7: ([2000, 2001], [4.1, 4.2]), 8: ([2010], [3.9])}
+        records = []
+        for wine_id, (batch_vintage, list_actual_rating) in self.ratings.items():
+            wine_hash = wine_fingerprint(self.wines[wine_id])
+            ratings_hash = ratings_fingerprint(batch_vintage, list_actual_rating)
+            for vintage, actual_rating in zip(batch_vintage, list_actual_rating):
+                records.append((wine_id, 2023, vintage, actual_rating, 4., wine_hash, ratings_hash, 'model',
+                                fingerprint('model', wine_hash, 2023, ratings_hash)))
+        pd.DataFrame.from_records(records, columns=PRECOMPUTED_COLUMNS).to_parquet(self.path, index=False)
+
+        def get_ratings(wine_id):
+            batch_vintage, list_actual_rating = self.ratings[wine_id]
+            return np.array(batch_vintage), np.array(list_actual_rating)
+
+        patcher = mock.patch('predict.precompute.ratings_index.get_ratings', side_effect=get_ratings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_the_wines_whose_ratings_changed_are_outdated(self):
+        with mock.patch('predict.precompute.model_fingerprint', return_value='model') as model_fingerprint:
+            precomputed_ratings = PrecomputedRatings(self.path)
+            self.assertEqual(precomputed_ratings.get_ratings(self.wines[7], 2023)['batch_vintage'], [2000, 2001])
+            self.assertIsNotNone(precomputed_ratings.get_ratings(self.wines[8], 2023))
+
+            # A new rating of the wine 7 in wine_ratings.parquet
+            self.ratings[7] = ([2000, 2001, 2002], [4.1, 4.2, 4.3])
+            self.assertIsNone(precomputed_ratings.get_ratings(self.wines[7], 2023))
+            self.assertIsNotNone(precomputed_ratings.get_ratings(self.wines[8], 2023))
+            # The model files are fingerprinted once per load, not on every request
+            self.assertEqual(model_fingerprint.call_count, 1)
+
+    def test_ratings_of_another_model_are_not_loaded(self):
+        with mock.patch('predict.precompute.model_fingerprint', return_value='new model'):
+            precomputed_ratings = PrecomputedRatings(self.path)
+            self.assertIsNone(precomputed_ratings.get_ratings(self.wines[7], 2023))
+
+
+class StubModel:
+    def predict(self, time_series_input, numerical_input):
+        return numerical_input[:, 0].tolist()
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def test_stop_during_an_open_window(self):
+        batcher = MicroBatcher(StubModel(), window=1., max_batch_size=32)
+        results = []
+
+        def predict():
+            results.append(batcher.predict(np.zeros((2, 3, 4)), np.array([[1.], [2.]])))
+
+        # Daemon threads, a batcher which does not stop fails the test instead of blocking the test runner
+        caller = threading.Thread(target=predict, daemon=True)
+        caller.start()
+        # Let the batcher open the window of the first prediction
+        time.sleep(0.1)
+        stopper = threading.Thread(target=batcher.stop, daemon=True)
+        stopper.start()
+        stopper.join(timeout=5)
+        caller.join(timeout=5)
+        self.assertFalse(stopper.is_alive())
+        self.assertFalse(caller.is_alive())
+        # The prediction in flight is run before the thread stops
+        self.assertEqual(results, [[1., 2.]])
+        self.assertEqual(batcher.nb_batches, 1)
+
+
+class StubPredictDataProcessor:
+    """
+    Inputs of the model identifying the wine, the vintage and the rating year, predicted as is by StubModel
+    """
+
+    def __init__(self, wine, rating_year, forecast_store, batch_vintage, scaler_store):
+        self.wine = wine
+        self.rating_year = rating_year
+        self.batch_vintage = batch_vintage
+
+    def process_data(self):
+        numerical_input = np.array([[self.wine.wine_id * 10000 + vintage + self.rating_year / 10000]
+                                    for vintage in self.batch_vintage])
+        return np.zeros((len(self.batch_vintage), 2, 1)), numerical_input
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PredictRatingBatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        region = Region.objects.create(region_id=1, region_name='Bordeaux', country='France', code='FR',
+                                       latitude=44.8, longitude=-0.6)
+        winery = Winery.objects.create(winery_id=1, winery_name='Chateau', website='')
+        self.wines = [Wine.objects.create(wine_id=wine_id, wine_name=f'Wine {wine_id}', type='Red',
+                                          elaborate='Varietal/100%', abv=13.5, body='Full-bodied', acidity='High',
+                                          winery=winery, region=region)
+                      for wine_id in [7, 8]]
+        for patcher in [mock.patch('predict.views.IndexedPredictDataProcessor', StubPredictDataProcessor),
+                        mock.patch('predict.views.get_predict_model', return_value=StubModel())]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_batch_equals_single_predictions(self):
+        items = [(self.wines[0].id, 2000, 2023), (self.wines[1].id, 2010, 2020), (self.wines[0].id, 2001, 2023),
+                 (self.wines[0].id, 2000, 2021)]
+        cache_keys = [f'predict_rating_{wine_id}_{batch_vintage}_{rating_year}'
+                      for wine_id, batch_vintage, rating_year in items]
+
+        # One of the items is already cached
+        call(APIRequestFactory().get('/api/v1/predict/predict_rating/', {
+            'wine_id': items[2][0], 'batch_vintage': items[2][1], 'rating_year': items[2][2]}))
+        response = call(APIRequestFactory().post('/api/v1/predict/predict_rating_batch/', {
+            'items': [{'wine_id': wine_id, 'batch_vintage': batch_vintage, 'rating_year': rating_year}
+                      for wine_id, batch_vintage, rating_year in items]}, format='json'))
+        self.assertEqual(response.status_code, 200)
+        batch_ratings = json.loads(response.content)['list_ratings']
+        batch_cache = cache.get_many(cache_keys)
+
+        cache.clear()
+        single_ratings = []
+        for wine_id, batch_vintage, rating_year in items:
+            response = call(APIRequestFactory().get('/api/v1/predict/predict_rating/', {
+                'wine_id': wine_id, 'batch_vintage': batch_vintage, 'rating_year': rating_year}))
+            self.assertEqual(response.status_code, 200)
+            single_ratings.append(json.loads(response.content))
+        single_cache = cache.get_many(cache_keys)
+
+        self.assertEqual(batch_ratings, single_ratings)
+        self.assertEqual(batch_ratings[1]['predict_rating'], 80000 + 2010 + 0.202)
+        # The batch fills the cache entries read by predict_rating
+        self.assertEqual(set(batch_cache), set(cache_keys))
+        self.assertEqual(set(single_cache), set(cache_keys))
+        for cache_key in cache_keys:
+            self.assertEqual(json.loads(batch_cache[cache_key])['predict_rating'],
+                             json.loads(single_cache[cache_key])['predict_rating'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ForecastBatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.regions = [Region.objects.create(region_id=region_id, region_name=f'Region {region_id}',
+                                              country='France', code='FR', latitude=0., longitude=0.)
+                        for region_id in [1, 2]]
+        df = pd.concat([make_weather_index(1, nb_months=30).df, make_weather_index(2, nb_months=36).df])
+        df['avg_temperature'] *= df['RegionID']
+        df['min_temperature'] = np.sin(np.arange(len(df))) - df['RegionID']
+        self.fields = ['avg_temperature', 'min_temperature']
+        for patcher in [mock.patch.object(weather_store, 'get', return_value=RegionIndex(df)),
+                        mock.patch('predict.forecasting.TIMEGPT_CLIENT', 'stub')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def forecast_batch(self, backend):
+        return call(APIRequestFactory().post('/api/v1/predict/forecast_weather_batch/', {
+            'region_ids': [region.id for region in self.regions], 'predict_fields': self.fields, 'nb_months': 6,
+            'freq': 'MS', 'api_key': 'key', 'backend': backend}, format='json'))
+
+    def get_cache_key(self, region, predict_field, backend):
+        suffix = '' if backend == 'timegpt' else f'_{backend}'
+        return f'forecast_weather_{region.id}_{predict_field}_6_MS{suffix}'
+
+    def test_batch_equals_single_forecasts(self):
+        for backend in ['timegpt', 'local']:
+            cache.clear()
+            cache_keys = [self.get_cache_key(region, predict_field, backend)
+                          for region in self.regions for predict_field in self.fields]
+            response = self.forecast_batch(backend)
+            self.assertEqual(response.status_code, 200, backend)
+            batch_forecasts = json.loads(response.content)['list_forecasts']
+            batch_cache = cache.get_many(cache_keys)
+
+            cache.clear()
+            single_forecasts = []
+            for region in self.regions:
+                for predict_field in self.fields:
+                    response = call(APIRequestFactory().get('/api/v1/predict/forecast_weather/', {
+                        'region_id': region.id, 'predict_field': predict_field, 'nb_months': 6, 'freq': 'MS',
+                        'api_key': 'key', 'backend': backend}))
+                    self.assertEqual(response.status_code, 200, backend)
+                    single_forecasts.append(dict(json.loads(response.content), region_id=region.id))
+            single_cache = cache.get_many(cache_keys)
+
+            self.assertEqual(len(batch_forecasts), 4, backend)
+            for batch_forecast, single_forecast in zip(batch_forecasts, single_forecasts):
+                self.assertEqual(batch_forecast['timestamp'], single_forecast['timestamp'], backend)
+                np.testing.assert_allclose(batch_forecast['predict_value'], single_forecast['predict_value'])
+            # The batch fills the cache entries read by forecast_weather
+            self.assertEqual(set(batch_cache), set(cache_keys), backend)
+            self.assertEqual(set(single_cache), set(cache_keys), backend)
+
+    def test_cached_series_are_not_forecast_again(self):
+        original_forecast = StubTimeGPT.forecast
+        unique_ids = []
+
+        def forecast(client, df, *args, **kwargs):
+            # The stub forecasts every series of a multi-series call with a single-series call
+            if kwargs.get('id_col') is not None:
+                unique_ids.extend(df['unique_id'].unique().tolist())
+            return original_forecast(client, df, *args, **kwargs)
+
+        for backend in ['timegpt', 'local']:
+            cache.clear()
+            unique_ids.clear()
+            # One field of each region is cached, the other one is missing
+            cached_keys = [self.get_cache_key(self.regions[0], 'avg_temperature', backend),
+                           self.get_cache_key(self.regions[1], 'min_temperature', backend)]
+            cached_forecast = {'timestamp': ['2030-01-01'], 'predict_field': 'cached', 'predict_value': [0.]}
+            cache.set_many({cache_key: json.dumps(cached_forecast) for cache_key in cached_keys})
+            with mock.patch.object(StubTimeGPT, 'forecast', forecast), \
+                    mock.patch.object(LocalBackend, 'forecast_series', autospec=True,
+                                      side_effect=LocalBackend.forecast_series) as forecast_series:
+                response = self.forecast_batch(backend)
+            self.assertEqual(response.status_code, 200, backend)
+
+            # Only the 2 missing series are forecast, the cached ones are returned and kept as is
+            if backend == 'timegpt':
+                self.assertEqual(sorted(unique_ids), ['1|min_temperature', '2|avg_temperature'])
+            else:
+                self.assertEqual(forecast_series.call_args.args[1].shape[0], 2)
+            list_forecasts = json.loads(response.content)['list_forecasts']
+            self.assertEqual([forecast['predict_field'] for forecast in list_forecasts],
+                             ['cached', 'min_temperature', 'avg_temperature', 'cached'], backend)
+            for cache_key in cached_keys:
+                self.assertEqual(json.loads(cache.get(cache_key)), cached_forecast, backend)
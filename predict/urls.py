@@ -1,13 +1,19 @@
 from django.urls import path
 from predict.views import (
     forecast_weather,
+    forecast_weather_batch,
     predict_rating,
+    predict_rating_batch,
     predict_all_rating,
+    model_info,
 )
 
 
 urlpatterns = [
     path("forecast_weather/", forecast_weather, name="forecast_weather"),
+    path("forecast_weather_batch/", forecast_weather_batch, name="forecast_weather_batch"),
     path("predict_rating/", predict_rating, name="predict_rating"),
+    path("predict_rating_batch/", predict_rating_batch, name="predict_rating_batch"),
     path("predict_all_rating/", predict_all_rating, name="predict_all_rating"),
+    path("model_info/", model_info, name="model_info"),
 ]
@@ -1,21 +1,33 @@
 from django.http import HttpResponse, JsonResponse
 from rest_framework.decorators import api_view, permission_classes
 from django.core.cache import cache
-from wine_api.settings import CACHE_TTL
+from wine_api.settings import CACHE_TTL, PREDICT_BATCH_MAX_ITEMS, FORECAST_BATCH_MAX_SERIES
 from predict.serializers import (
     PredictSerializer,
+    BatchPredictSerializer,
     RatingSerializer,
+    BatchRatingSerializer,
     ListRatingSerializer,
+    ModelInfoSerializer,
 )
-from nixtlats import TimeGPT
-import pandas as pd
+import numpy as np
 from region.models import Region
 from wine.models import Wine
 import json
 from rest_framework.permissions import AllowAny
-from wine_api.settings import BASE_DIR
-from likewines.processor import PredictDataProcessor
-from likewines.model import PredictModel
+from predict.processor import IndexedPredictDataProcessor
+from predict.registry import model_registry
+from predict.batching import get_predict_model
+from predict.precompute import precomputed_ratings
+from predict.forecasting import (
+    WEATHER_FIELDS,
+    MONTHLY_FREQUENCIES,
+    FORECAST_BACKENDS,
+    get_forecast_backend,
+    token_validator,
+    forecast_weather_data,
+)
+from predict.stores import forecast_store, weather_store, scaler_store, ratings_index
 
 
 @api_view(['GET'])
@@ -26,34 +38,33 @@ def forecast_weather(request):
     nb_months = request.query_params.get('nb_months', None)
     frequency = request.query_params.get('freq', None)
     api_key = request.query_params.get('api_key', None)
+    backend = get_forecast_backend(request.query_params.get('backend', None))
+    if backend is None:
+        return HttpResponse(content='backend must be in this list: ' + ', '.join(FORECAST_BACKENDS), status=400)
     if region_id is None or predict_field is None or \
-            nb_months is None or frequency is None or api_key is None:
+            nb_months is None or frequency is None or (api_key is None and backend.requires_api_key):
         return HttpResponse(content='Missing parameters: region_id, predict_field, nb_months, freq, api_key',
                             status=400)
-    list_fields = ['avg_temperature', 'min_temperature', 'max_temperature',
-                   'avg_sunshine_duration', 'min_sunshine_duration', 'max_sunshine_duration',
-                   'avg_precipitation', 'avg_rain', 'avg_snowfall',
-                   'avg_humidity', 'avg_wind_speed', 'avg_soil_temperature',
-                   'avg_soil_moisture']
-    if predict_field not in list_fields:
+    if predict_field not in WEATHER_FIELDS:
         return HttpResponse(content='''predict_field must be in this list: avg_temperature, min_temperature,
         max_temperature, avg_sunshine_duration, min_sunshine_duration, max_sunshine_duration, avg_precipitation,
         avg_rain, avg_snowfall, avg_humidity, avg_wind_speed, avg_soil_temperature, avg_soil_moisture''',
                             status=400)
+    if not backend.requires_api_key and frequency not in MONTHLY_FREQUENCIES:
+        return HttpResponse(content='freq must be in this list for the local backend: ' +
+                                    ', '.join(MONTHLY_FREQUENCIES), status=400)
     # Check if the request is cached
     cache_key = f'forecast_weather_{region_id}_{predict_field}_{nb_months}_{frequency}'
+    if backend.name != 'timegpt':
+        cache_key += f'_{backend.name}'
     cached_response = cache.get(cache_key)
     if cached_response is not None:
         returned_data = json.loads(cached_response)
         serializer = PredictSerializer(returned_data)
         return JsonResponse(serializer.data, status=200)
 
-    # Initialize the model
-    model = TimeGPT(
-        token=api_key,
-    )
-    # Check if api_key is valid
-    if not model.validate_token():
+    # Check if api_key is valid, the result is cached per api_key
+    if backend.requires_api_key and not token_validator.is_valid(api_key):
         return HttpResponse(content='Invalid api_key', status=400)
 
     # Get the region
@@ -64,34 +75,130 @@ def forecast_weather(request):
     # Get the xwine_id
     xwine_id = region.region_id
 
-    # Get the weather data
-    weather_data = pd.read_parquet(f'{BASE_DIR}/predict_data/agg_monthly.parquet')
-    weather_data = weather_data[weather_data['RegionID'] == xwine_id]
+    # Get the weather data, the timestamp column is already built
+    weather_index = weather_store.get()
+    if xwine_id not in weather_index.region_slices:
+        return HttpResponse(content='There is no weather data for this region', status=400)
+
+    # Forecast weather, concurrent requests of the same cache_key share one forecast
+    # The forecast is cached by forecast_weather_data
+    returned_data = forecast_weather_data(
+        cache_key=cache_key,
+        backend=backend,
+        weather_index=weather_index,
+        region_id=xwine_id,
+        predict_field=predict_field,
+        nb_months=nb_months,
+        frequency=frequency,
+        api_key=api_key,
+    )
 
-    # Add timestamp column
-    weather_data['timestamp'] = pd.to_datetime(weather_data[['year', 'month']].assign(DAY=1))
+    # Serialize the data
+    serializer = PredictSerializer(data=returned_data)
+    if serializer.is_valid():
+        return JsonResponse(serializer.data, status=200)
+    return HttpResponse(content='Invalid data', status=400)
 
-    # Forecast weather
-    forecast_df = model.forecast(
-        df=weather_data,
-        h=int(nb_months),
-        time_col='timestamp',
-        target_col=predict_field,
-        freq=frequency,
-    )
 
-    # Return the forecast
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def forecast_weather_batch(request):
+    """
+    Forecast weather fields of several regions with a single multi-series forecast
+    :param request:
+    :return:
+    """
+    data = request.data if isinstance(request.data, dict) else {}
+    region_ids = data.get('region_ids', None)
+    predict_fields = data.get('predict_fields', None)
+    nb_months = data.get('nb_months', None)
+    frequency = data.get('freq', None)
+    api_key = data.get('api_key', None)
+    backend = get_forecast_backend(data.get('backend', None))
+    if backend is None:
+        return HttpResponse(content='backend must be in this list: ' + ', '.join(FORECAST_BACKENDS), status=400)
+    if not isinstance(region_ids, list) or not isinstance(predict_fields, list) or len(region_ids) == 0 or \
+            len(predict_fields) == 0 or nb_months is None or frequency is None or \
+            (api_key is None and backend.requires_api_key):
+        return HttpResponse(content='Missing parameters: region_ids, predict_fields, nb_months, freq, api_key',
+                            status=400)
+    try:
+        region_ids = list(dict.fromkeys(int(region_id) for region_id in region_ids))
+        nb_months = int(nb_months)
+    except (TypeError, ValueError):
+        return HttpResponse(content='region_ids and nb_months must be integers', status=400)
+    predict_fields = list(dict.fromkeys(predict_fields))
+    for predict_field in predict_fields:
+        if predict_field not in WEATHER_FIELDS:
+            return HttpResponse(content='predict_fields must be in this list: ' + ', '.join(WEATHER_FIELDS),
+                                status=400)
+    if len(region_ids) * len(predict_fields) > FORECAST_BATCH_MAX_SERIES:
+        return HttpResponse(content=f'At most {FORECAST_BATCH_MAX_SERIES} (region, field) series can be forecast',
+                            status=400)
+    if not backend.requires_api_key and frequency not in MONTHLY_FREQUENCIES:
+        return HttpResponse(content='freq must be in this list for the local backend: ' +
+                                    ', '.join(MONTHLY_FREQUENCIES), status=400)
+
+    # Get the cached forecasts with a single request, with the keys of forecast_weather
+    series = [(region_id, predict_field) for region_id in region_ids for predict_field in predict_fields]
+    suffix = '' if backend.name == 'timegpt' else f'_{backend.name}'
+    cache_keys = [f'forecast_weather_{region_id}_{predict_field}_{nb_months}_{frequency}{suffix}'
+                  for region_id, predict_field in series]
+    cached_responses = cache.get_many(cache_keys)
+    forecasts = {cache_key: json.loads(cached_response) for cache_key, cached_response in cached_responses.items()}
+
+    missing_series = [key for key, cache_key in zip(series, cache_keys) if cache_key not in forecasts]
+    if missing_series:
+        # Check if api_key is valid, the result is cached per api_key
+        if backend.requires_api_key and not token_validator.is_valid(api_key):
+            return HttpResponse(content='Invalid api_key', status=400)
+
+        # Get the regions
+        regions = Region.objects.get_regions_by_ids({region_id for region_id, _ in missing_series})
+        weather_index = weather_store.get()
+        for region_id, _ in missing_series:
+            if region_id not in regions:
+                return HttpResponse(content=f'Invalid region_id: {region_id}', status=400)
+            if regions[region_id].region_id not in weather_index.region_slices:
+                return HttpResponse(content=f'There is no weather data for the region {region_id}', status=400)
+
+        # Forecast all the missing series in one call, the cached series are not forecast again
+        missing_region_ids = list(dict.fromkeys(region_id for region_id, _ in missing_series))
+        missing_fields = list(dict.fromkeys(predict_field for _, predict_field in missing_series))
+        xwine_forecasts = backend.forecast_regions(
+            weather_index=weather_index,
+            region_ids=[regions[region_id].region_id for region_id in missing_region_ids],
+            fields=missing_fields,
+            h=nb_months,
+            freq=frequency,
+            api_key=api_key,
+            series=[(regions[region_id].region_id, predict_field) for region_id, predict_field in missing_series],
+        )
+
+        # Fan out the forecasts into the cache entries of forecast_weather
+        new_responses = {}
+        for region_id, predict_field in missing_series:
+            forecast = xwine_forecasts.get((regions[region_id].region_id, predict_field))
+            if forecast is None:
+                continue
+            cache_key = f'forecast_weather_{region_id}_{predict_field}_{nb_months}_{frequency}{suffix}'
+            forecasts[cache_key] = {
+                'timestamp': forecast['timestamp'],
+                'predict_field': predict_field,
+                'predict_value': forecast['predict_value'],
+            }
+            new_responses[cache_key] = json.dumps(forecasts[cache_key])
+        cache.set_many(new_responses, timeout=CACHE_TTL)
+
     returned_data = {
-        'timestamp': forecast_df['timestamp'].tolist(),
-        'predict_field': predict_field,
-        'predict_value': forecast_df['TimeGPT'].tolist(),
+        'list_forecasts': [
+            dict(forecasts[cache_key], region_id=region_id)
+            for (region_id, _), cache_key in zip(series, cache_keys) if cache_key in forecasts
+        ]
     }
 
-    # Cache the response
-    cache.set(cache_key, json.dumps(returned_data), timeout=CACHE_TTL)
-
     # Serialize the data
-    serializer = PredictSerializer(data=returned_data)
+    serializer = BatchPredictSerializer(data=returned_data)
     if serializer.is_valid():
         return JsonResponse(serializer.data, status=200)
     return HttpResponse(content='Invalid data', status=400)
@@ -131,26 +238,20 @@ def predict_rating(request):
     # Configure the batch_vintage
     batch_vintage = [batch_vintage]
 
-    # Read forecast data
-    path_forecast_df = f'{BASE_DIR}/predict_data/forecast_agg_monthly.parquet'
-
     # Initialize the data processor
-    data_processor = PredictDataProcessor(
+    data_processor = IndexedPredictDataProcessor(
         wine=wine,
         rating_year=rating_year,
-        path_forecast_df=path_forecast_df,
+        forecast_store=forecast_store,
         batch_vintage=batch_vintage,
-        path_minmax_scaler=f'{BASE_DIR}/model/minmax_scaler.save',
-        path_standard_scaler=f'{BASE_DIR}/model/std_scaler.save',
+        scaler_store=scaler_store,
     )
 
     # Process the data
     time_series_input, numerical_input = data_processor.process_data()
 
-    # Initialize the model
-    cnn_model = PredictModel(
-        path_cnn_model=f'{BASE_DIR}/model/cnn_model.h5',
-    )
+    # Get the shared model, or the micro-batcher in front of it
+    cnn_model = get_predict_model()
     list_predict_rating = cnn_model.predict(
         time_series_input=time_series_input,
         numerical_input=numerical_input,
@@ -175,6 +276,116 @@ def predict_rating(request):
     return HttpResponse(content='Invalid data', status=400)
 
 
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def predict_rating_batch(request):
+    """
+    Predict the ratings of a list of (wine_id, batch_vintage, rating_year)
+    with a single forward pass of the model
+    :param request:
+    :return:
+    """
+    items = request.data.get('items', None) if isinstance(request.data, dict) else None
+    if not isinstance(items, list) or len(items) == 0:
+        return HttpResponse(content='Missing parameters: items', status=400)
+    if len(items) > PREDICT_BATCH_MAX_ITEMS:
+        return HttpResponse(content=f'items must contain at most {PREDICT_BATCH_MAX_ITEMS} elements', status=400)
+    # Validate the items
+    list_items = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or item.get('wine_id', None) is None or item.get('rating_year', None) is None:
+            return HttpResponse(content=f'Missing parameters in item {i}: wine_id, rating_year', status=400)
+        try:
+            wine_id = int(item['wine_id'])
+            batch_vintage = int(item.get('batch_vintage', 2023))
+            rating_year = int(item['rating_year'])
+        except (TypeError, ValueError):
+            return HttpResponse(content=f'Invalid item {i}: wine_id, batch_vintage and rating_year must be integers',
+                                status=400)
+        if batch_vintage > 2023 or batch_vintage < 1949:
+            return HttpResponse(content=f'Invalid item {i}: batch_vintage must be between 1949 and 2023', status=400)
+        if batch_vintage > rating_year:
+            return HttpResponse(content=f'Invalid item {i}: rating_year must be greater than batch_vintage',
+                                status=400)
+        list_items.append((wine_id, batch_vintage, rating_year))
+
+    # Get the wines
+    wines = Wine.objects.get_wines_by_ids({wine_id for wine_id, _, _ in list_items})
+    for i, (wine_id, _, _) in enumerate(list_items):
+        if wine_id not in wines:
+            return HttpResponse(content=f'Invalid item {i}: there is no wine with this id', status=400)
+
+    # Get the cached predictions with a single request
+    cache_keys = [f'predict_rating_{wine_id}_{batch_vintage}_{rating_year}'
+                  for wine_id, batch_vintage, rating_year in list_items]
+    cached_responses = cache.get_many(cache_keys)
+    predictions = {cache_key: json.loads(cached_response)['predict_rating']
+                   for cache_key, cached_response in cached_responses.items()}
+
+    # Group the missing predictions by wine and rating_year
+    missing_groups = {}
+    for (wine_id, batch_vintage, rating_year), cache_key in zip(list_items, cache_keys):
+        if cache_key not in predictions:
+            missing_groups.setdefault((wine_id, rating_year), set()).add(batch_vintage)
+
+    if missing_groups:
+        # Process the data of every group
+        list_time_series_input = []
+        list_numerical_input = []
+        list_missing_items = []
+        for (wine_id, rating_year), batch_vintage in missing_groups.items():
+            batch_vintage = sorted(batch_vintage)
+            data_processor = IndexedPredictDataProcessor(
+                wine=wines[wine_id],
+                rating_year=rating_year,
+                forecast_store=forecast_store,
+                batch_vintage=batch_vintage,
+                scaler_store=scaler_store,
+            )
+            time_series_input, numerical_input = data_processor.process_data()
+            list_time_series_input.append(time_series_input)
+            list_numerical_input.append(numerical_input)
+            list_missing_items.extend((wine_id, vintage, rating_year) for vintage in batch_vintage)
+
+        # Predict all the missing ratings in one forward pass
+        cnn_model = get_predict_model()
+        list_predict_rating = cnn_model.predict(
+            time_series_input=np.concatenate(list_time_series_input),
+            numerical_input=np.concatenate(list_numerical_input),
+        )
+
+        # Cache the new predictions under the keys of predict_rating
+        new_responses = {}
+        for (wine_id, batch_vintage, rating_year), prediction in zip(list_missing_items, list_predict_rating):
+            cache_key = f'predict_rating_{wine_id}_{batch_vintage}_{rating_year}'
+            predictions[cache_key] = prediction
+            new_responses[cache_key] = json.dumps({
+                'wine_id': wine_id,
+                'batch_vintage': batch_vintage,
+                'rating_year': rating_year,
+                'predict_rating': prediction
+            })
+        cache.set_many(new_responses, timeout=CACHE_TTL)
+
+    # Return the predictions in the order of the request
+    returned_data = {
+        'list_ratings': [
+            {
+                'wine_id': wine_id,
+                'batch_vintage': batch_vintage,
+                'rating_year': rating_year,
+                'predict_rating': predictions[cache_key]
+            } for (wine_id, batch_vintage, rating_year), cache_key in zip(list_items, cache_keys)
+        ]
+    }
+
+    # Serialize the data
+    serializer = BatchRatingSerializer(data=returned_data)
+    if serializer.is_valid():
+        return JsonResponse(serializer.data, status=200)
+    return HttpResponse(content='Invalid data', status=400)
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def predict_all_rating(request):
@@ -203,39 +414,39 @@ def predict_all_rating(request):
         serializer = ListRatingSerializer(returned_data)
         return JsonResponse(serializer.data, status=200)
 
-    # Get XWine wine_id of the wine
-    xwine_wine_id = wine.wine_id
-
-    # Read forecast data
-    path_forecast_df = f'{BASE_DIR}/predict_data/forecast_agg_monthly.parquet'
-
-    # Get Vintage to predict
-    wine_ratings = pd.read_parquet(f'{BASE_DIR}/db_data/wine_ratings.parquet')
-    filter_wine_ratings = wine_ratings[wine_ratings['WineID'] == xwine_wine_id]
-    batch_vintage = filter_wine_ratings['Vintage'].tolist()
-    list_actual_rating = filter_wine_ratings['AverageRating'].tolist()
-
-    # Initialize the data processor
-    data_processor = PredictDataProcessor(
-        wine=wine,
-        rating_year=rating_year,
-        path_forecast_df=path_forecast_df,
-        batch_vintage=batch_vintage,
-        path_minmax_scaler=f'{BASE_DIR}/model/minmax_scaler.save',
-        path_standard_scaler=f'{BASE_DIR}/model/std_scaler.save',
-    )
-
-    # Process the data
-    time_series_input, numerical_input = data_processor.process_data()
-
-    # Initialize the model
-    model = PredictModel(
-        path_cnn_model=f'{BASE_DIR}/model/cnn_model.h5',
-    )
-    list_predict_rating = model.predict(
-        time_series_input=time_series_input,
-        numerical_input=numerical_input,
-    )
+    # Serve the ratings predicted offline by precompute_ratings when they are up to date
+    precomputed = precomputed_ratings.get_ratings(wine, rating_year)
+    if precomputed is not None:
+        batch_vintage = precomputed['batch_vintage']
+        list_actual_rating = precomputed['list_actual_rating']
+        list_predict_rating = precomputed['list_predict_rating']
+    else:
+        # Get XWine wine_id of the wine
+        xwine_wine_id = wine.wine_id
+
+        # Get Vintage to predict
+        vintages, actual_ratings = ratings_index.get_ratings(xwine_wine_id)
+        batch_vintage = vintages.tolist()
+        list_actual_rating = actual_ratings.tolist()
+
+        # Initialize the data processor
+        data_processor = IndexedPredictDataProcessor(
+            wine=wine,
+            rating_year=rating_year,
+            forecast_store=forecast_store,
+            batch_vintage=batch_vintage,
+            scaler_store=scaler_store,
+        )
+
+        # Process the data
+        time_series_input, numerical_input = data_processor.process_data()
+
+        # Get the shared model, or the micro-batcher in front of it
+        model = get_predict_model()
+        list_predict_rating = model.predict(
+            time_series_input=time_series_input,
+            numerical_input=numerical_input,
+        )
 
     returned_data = {
         'wine_id': wine_id,
@@ -257,3 +468,15 @@ def predict_all_rating(request):
     if serializer.is_valid():
         return JsonResponse(serializer.data, status=200)
     return HttpResponse(content='Invalid data', status=400)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def model_info(request):
+    """
+    Get the load time and the memory footprint of the CNN model of this worker
+    :param request:
+    :return:
+    """
+    serializer = ModelInfoSerializer(model_registry.stats())
+    return JsonResponse(serializer.data, status=200)
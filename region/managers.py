@@ -1,6 +1,8 @@
 from django.db import models
 from rest_framework import exceptions
 from django.db import connection
+from wine_api.paginators import add_page_clauses, count_rows
+from wine_api.search import get_like_operator, get_search_clauses
 import datetime
 
 
@@ -31,16 +33,25 @@ class RegionManager(models.Manager):
             raise exceptions.ValidationError("Page must be greater than 0")
         if page_size < 1:
             raise exceptions.ValidationError("Page size must be greater than 0")
-        offset = (page - 1) * page_size
-        query = """
+        after = data.get("after", None)
+        if after is None:
+            # Page mode, the DB reads and discards the rows of the previous pages
+            where = ""
+            params = [page_size, (page - 1) * page_size]
+        else:
+            # Keyset mode, the DB seeks the first row through the primary key index
+            where = "WHERE region.id > %s"
+            params = [after, page_size, 0]
+        query = f"""
             SELECT region.id, region."RegionID", region.created_at, region.updated_at, region."RegionName",
             region."Country", region."Code", region."Latitude", region."Longitude"
             FROM region
+            {where}
             ORDER BY region.id ASC
             LIMIT %s OFFSET %s
         """
         with connection.cursor() as cursor:
-            cursor.execute(query, [page_size, offset])
+            cursor.execute(query, params)
             wines = cursor.fetchall()
         labels = ['id', 'region_id', 'created_at', 'updated_at', 'region_name',
                   'country', 'code', 'latitude', 'longitude']
@@ -50,6 +61,14 @@ class RegionManager(models.Manager):
     def get_region_by_id(self, id):
         return self.filter(id=id).first()
 
+    def get_regions_by_ids(self, ids):
+        """
+        Returns a dict of the regions with the given ids
+        :param ids: list of region ids in the DB
+        :return:
+        """
+        return {region.id: region for region in self.filter(id__in=ids)}
+
     def get_regions_by_name(self, region_name):
         """
         Returns all regions having region_name in their name
@@ -58,17 +77,18 @@ class RegionManager(models.Manager):
         """
         return self.filter(region_name__icontains=region_name)
 
-    def filter_regions(self, **data):
+    def get_filter_query(self, **data):
         """
-        Returns all regions matching the given filters
+        Returns the query of the regions matching the given filters, without ordering, and the ranking of the search
         :param data: dict
-        :return:
+        :return: tuple of query, params, ranking (None without search), ranking params
         """
         region_name = data.get("region_name", None)
         country = data.get("country", None)
         radius = data.get("radius", None)
         latitude = data.get("latitude", None)
         longitude = data.get("longitude", None)
+        search = data.get("search", None)
 
         if radius and (latitude is None or longitude is None):
             raise exceptions.ValidationError("Missing latitude or longitude")
@@ -77,24 +97,45 @@ class RegionManager(models.Manager):
 
         query = """SELECT id, "RegionID", created_at, updated_at, "RegionName",
                     "Country", "Code", "Latitude", "Longitude" FROM region WHERE """
-        # Add parameters not None to list
+        # Add parameters not None to list, the text columns are matched case-insensitively
+        like = get_like_operator()
         params = []
         if region_name:
-            query += "\"RegionName\" LIKE %s AND "
+            query += f"\"RegionName\" {like} %s AND "
             params.append(f"%{region_name}%")
         if country:
-            query += "\"Country\" LIKE %s AND "
+            query += f"\"Country\" {like} %s AND "
             params.append(f"%{country}%")
         if radius and latitude and longitude:
             # Apply Haversine formula
             query += """(6371 * acos(cos(radians(%s)) * cos(radians("Latitude")) * cos(radians("Longitude") - 
             radians(%s)) + sin(radians(%s)) * sin(radians("Latitude")))) < %s AND """
             params.extend([latitude, longitude, latitude, radius])
+        # Search the term in the name, the best matches first
+        ranking = None
+        ranking_params = []
+        if search:
+            condition, condition_params, ranking, ranking_params = get_search_clauses('"RegionName"', search)
+            query += f"{condition} AND "
+            params.extend(condition_params)
         # If no parameters, add 1=1 to query to avoid error
         query += "1=1"
 
         # # Remove last AND
         # query = query[:-4]
+        return query, params, ranking, ranking_params
+
+    def filter_regions(self, **data):
+        """
+        Returns the regions matching the given filters, the best matches of search first, then by id.
+        The DB only returns the rows of the page, given page and page_size or the keyset bound after
+        :param data: dict of the filters, page, page_size (None for every row) and after
+        :return:
+        """
+        query, params, ranking, ranking_params = self.get_filter_query(**data)
+        query, params = add_page_clauses(query, params, 'id', ranking=ranking, ranking_params=ranking_params,
+                                         page=data.get("page", 1), page_size=data.get("page_size", None),
+                                         after=data.get("after", None))
         with connection.cursor() as cursor:
             cursor.execute(query, params)
             regions = cursor.fetchall()
@@ -104,6 +145,15 @@ class RegionManager(models.Manager):
         result = [dict(zip(labels, row)) for row in regions]
         return result
 
+    def count_regions(self, **data):
+        """
+        Returns the number of regions matching the given filters
+        :param data: dict
+        :return:
+        """
+        query, params, _, _ = self.get_filter_query(**data)
+        return count_rows(query, params)
+
     def update_region(self, region, **data):
         region.region_name = data.get("region_name", region.region_name)
         region.country = data.get("country", region.country)
@@ -0,0 +1,24 @@
+from django.db import migrations
+from wine_api.search import create_trigram_indexes, drop_trigram_indexes
+
+
+# Columns searched with LIKE '%term%' by the filter endpoint
+TRIGRAM_COLUMNS = ['RegionName', 'Country']
+
+
+def create_indexes(apps, schema_editor):
+    create_trigram_indexes(schema_editor, 'region', TRIGRAM_COLUMNS)
+
+
+def drop_indexes(apps, schema_editor):
+    drop_trigram_indexes(schema_editor, 'region', TRIGRAM_COLUMNS)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('region', '0002_add_data'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
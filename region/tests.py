@@ -1,3 +1,71 @@
-from django.test import TestCase
+from urllib.parse import parse_qs, urlparse
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import resolve
+from rest_framework.test import APIRequestFactory, APITestCase
+from region.models import Region
 
-# Create your tests here.
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def get(path, **params):
+    """
+    Send a GET request to the view of a path
+    :param path:
+    :param params: query parameters
+    :return: response
+    """
+    request = APIRequestFactory().get(path, params)
+    match = resolve(path)
+    return match.func(request, *match.args, **match.kwargs)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RegionFilterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        # Created in another order than their ranking by search
+        self.regions = [Region.objects.create(region_id=region_id, region_name=region_name, country=country,
+                                              code=code, latitude=0., longitude=0.)
+                        for region_id, region_name, country, code in [
+                            (1, 'Haut-Medoc', 'France', 'FR'), (2, 'Medoc Superieur', 'France', 'FR'),
+                            (3, 'Napa Valley', 'United States', 'US'), (4, 'Medoc', 'France', 'FR')]]
+        self.ids = [region.id for region in self.regions]
+
+    def test_pages_and_count(self):
+        response = get('/api/v1/regions/filter/', page=2, page_size=3, count='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([region['id'] for region in response.data], self.ids[3:])
+        self.assertEqual(response['X-Total-Count'], '4')
+
+        response = get('/api/v1/regions/filter/', country='france', page_size='all', count='true')
+        self.assertEqual([region['id'] for region in response.data], [self.ids[0], self.ids[1], self.ids[3]])
+        self.assertEqual(response['X-Total-Count'], '3')
+
+    def test_search_ranks_exact_and_prefix_matches_first(self):
+        response = get('/api/v1/regions/filter/', search='medoc', page_size='all')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([region['region_name'] for region in response.data],
+                         ['Medoc', 'Medoc Superieur', 'Haut-Medoc'])
+
+    def test_keyset_pages(self):
+        for path in ['/api/v1/regions/filter/', '/api/v1/regions/']:
+            ids = []
+            after = ''
+            while True:
+                response = get(path, after=after, page_size=3)
+                self.assertEqual(response.status_code, 200, path)
+                ids += [region['id'] for region in response.data['results']]
+                if response.data['next'] is None:
+                    break
+                after = parse_qs(urlparse(response.data['next']).query)['after'][0]
+            self.assertEqual(ids, self.ids, path)
+
+    def test_invalid_after_tokens(self):
+        for path in ['/api/v1/regions/filter/', '/api/v1/regions/']:
+            self.assertEqual(get(path, after='not a token').status_code, 400, path)
+            self.assertEqual(get(path, after='', page_size=0).status_code, 400, path)
+
+    def test_search_is_not_paged_with_after(self):
+        self.assertEqual(get('/api/v1/regions/filter/', after='', search='medoc').status_code, 400)
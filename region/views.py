@@ -29,6 +29,8 @@ class RegionList(SecondListView, CreateView):
     queryset = Region.objects.all()
     serializer_class = RegionSerializer
     permission_classes = [AllowAny]
+    keyset_manager_method = 'get_regions'
+    keyset_serializer_class = SecondRegionSerializer
 
     def get_queryset(self):
         page = self.request.query_params.get('page', '1')
@@ -106,13 +108,15 @@ class RegionFilter(ListView):
         radius = self.request.query_params.get('radius', None)
         latitude = self.request.query_params.get('latitude', None)
         longitude = self.request.query_params.get('longitude', None)
+        search = self.request.query_params.get('search', None)
         data = {
             "region_name": region_name,
             "country": country,
             "radius": radius,
             "latitude": latitude,
-            "longitude": longitude
+            "longitude": longitude,
+            "search": search
         }
-        # Get list of regions matching the given filters
-        list_regions = Region.objects.filter_regions(**data)
+        # Get the page of regions matching the given filters
+        list_regions = self.get_page(Region.objects.filter_regions, Region.objects.count_regions, **data)
         return list_regions
\ No newline at end of file
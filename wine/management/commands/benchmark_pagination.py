@@ -0,0 +1,64 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection
+from region.models import Region
+from wine.models import Wine
+from winery.models import Winery
+
+
+MODELS = {
+    'wine': (Wine, 'get_wines'),
+    'region': (Region, 'get_regions'),
+    'winery': (Winery, 'get_wineries'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare the latency of deep pages of the wine, region and winery listings with page and with after'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', type=str, default='wine,region,winery',
+                            help='Comma separated list of listings: wine, region, winery')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--depths', type=str, default='0,0.25,0.5,0.75,1',
+                            help='Comma separated list of depths, as a fraction of the rows')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of timed queries of a page')
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        depths = [float(depth) for depth in options['depths'].split(',')]
+        self.stdout.write(f'{"listing":>8} {"page":>8} {"rows":>8} {"page (ms)":>10} {"after (ms)":>11}')
+        for name in options['models'].split(','):
+            model, method = MODELS[name]
+            nb_rows = model.objects.count()
+            nb_pages = max(1, -(-nb_rows // page_size))
+            for depth in depths:
+                page = min(nb_pages, int(depth * (nb_pages - 1)) + 1)
+                # The id of the last row of the previous page, as the after token of the page would hold
+                after = self.get_last_id(model, (page - 1) * page_size)
+                page_time, page_rows = self.time_query(model, method, options['repeat'],
+                                                       page=page, page_size=page_size)
+                after_time, after_rows = self.time_query(model, method, options['repeat'],
+                                                         after=after, page_size=page_size)
+                if [row['id'] for row in page_rows] != [row['id'] for row in after_rows]:
+                    self.stderr.write(f'{name} page {page}: both modes return different rows')
+                self.stdout.write(f'{name:>8} {page:>8} {len(page_rows):>8} {page_time * 1000:>10.2f} '
+                                  f'{after_time * 1000:>11.2f}')
+
+    @staticmethod
+    def get_last_id(model, offset):
+        if offset == 0:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT id FROM {model._meta.db_table} ORDER BY id ASC LIMIT 1 OFFSET %s', [offset - 1])
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def time_query(model, method, repeat, **data):
+        durations = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            rows = getattr(model.objects, method)(**data)
+            durations.append(time.perf_counter() - start_time)
+        return float(np.median(durations)), rows
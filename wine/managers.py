@@ -1,6 +1,8 @@
 from django.db import models
 from rest_framework import exceptions
 from django.db import connection
+from wine_api.paginators import add_page_clauses, count_rows
+from wine_api.search import get_like_operator, get_search_clauses
 import datetime
 
 
@@ -28,10 +30,40 @@ class WineManager(models.Manager):
     def get_wine_by_wine_id(self, wine_id):
         return self.filter(wine_id=wine_id).first()
 
+    def get_wines_by_ids(self, ids):
+        """
+        Returns a dict of the wines with the given ids, with their winery and region
+        :param ids: list of wine ids in the DB
+        :return:
+        """
+        wines = self.select_related("winery", "region").filter(id__in=ids)
+        return {wine.id: wine for wine in wines}
+
+    def get_wines_by_wine_ids(self, wine_ids):
+        """
+        Returns a dict of the wines with the given WineIDs, with their winery and region, in one query.
+        When a WineID is duplicated, the wine with the lowest id is kept like get_wine_by_wine_id
+        :param wine_ids: list of WineID from X-Wines dataset
+        :return:
+        """
+        wines = self.select_related("winery", "region").filter(wine_id__in=set(wine_ids)).order_by("id")
+        result = {}
+        for wine in wines:
+            result.setdefault(wine.wine_id, wine)
+        return result
+
+    def get_wine_catalog(self):
+        """
+        Returns the WineID, type, region id, ABV, body and acidity of the wines with a WineID, by increasing id
+        :return: list of tuples
+        """
+        return list(self.filter(wine_id__isnull=False).order_by("id").values_list(
+            "wine_id", "type", "region_id", "abv", "body", "acidity"))
+
     def get_wines(self, **data):
         """
-        Returns all wines given page and page_size
-        :param data:
+        Returns all wines given page and page_size, or the page_size wines after the id after
+        :param data: dict of page and page_size, or of after and page_size
         :return:
         """
         page = data.get("page", 1)
@@ -40,18 +72,27 @@ class WineManager(models.Manager):
             raise exceptions.ValidationError("Page must be greater than 0")
         if page_size < 1:
             raise exceptions.ValidationError("Page size must be greater than 0")
-        offset = (page - 1) * page_size
-        query = """
+        after = data.get("after", None)
+        if after is None:
+            # Page mode, the DB reads and discards the rows of the previous pages
+            where = ""
+            params = [page_size, (page - 1) * page_size]
+        else:
+            # Keyset mode, the DB seeks the first row through the primary key index
+            where = "WHERE wine.id > %s"
+            params = [after, page_size, 0]
+        query = f"""
             SELECT wine.id, wine."WineID", wine.created_at, wine.updated_at, wine."WineName",
             wine."Type", wine."Elaborate", wine."ABV", wine."Body", wine."Acidity",
             region."RegionID", region."RegionName", winery."WineryID", winery."WineryName" 
             FROM wine JOIN winery ON wine."WineryID" = winery.id
             JOIN region ON wine."RegionID" = region.id
+            {where}
             ORDER BY wine.id ASC
             LIMIT %s OFFSET %s
         """
         with connection.cursor() as cursor:
-            cursor.execute(query, [page_size, offset])
+            cursor.execute(query, params)
             wines = cursor.fetchall()
         labels = ['id', 'wine_id', 'created_at', 'updated_at', 'wine_name',
                   'type', 'elaborate', 'abv', 'body', 'acidity',
@@ -60,11 +101,11 @@ class WineManager(models.Manager):
         return result
 
 
-    def filter_wines(self, **data):
+    def get_filter_query(self, **data):
         """
-        Returns all wines matching the given filters
+        Returns the query of the wines matching the given filters, without ordering, and the ranking of the search
         :param data: dict
-        :return:
+        :return: tuple of query, params, ranking (None without search), ranking params
         """
         wine_name = data.get("wine_name", None)
         type = data.get("type", None)
@@ -74,6 +115,7 @@ class WineManager(models.Manager):
         acidity = data.get("acidity", None)
         winery_id = data.get("winery_id", None)
         region_id = data.get("region_id", None)
+        search = data.get("search", None)
 
         query = """SELECT wine.id, wine."WineID", wine.created_at, wine.updated_at, wine."WineName",
                     wine."Type", wine."Elaborate", wine."ABV", wine."Body", wine."Acidity",
@@ -81,16 +123,17 @@ class WineManager(models.Manager):
                   FROM wine JOIN winery ON wine."WineryID" = winery.id
                   JOIN region ON wine."RegionID" = region.id
                   WHERE """
-        # Add parameters not None to list
+        # Add parameters not None to list, the text columns are matched case-insensitively
+        like = get_like_operator()
         params = []
         if wine_name:
-            query += "wine.\"WineName\" LIKE %s AND "
+            query += f"wine.\"WineName\" {like} %s AND "
             params.append(f"%{wine_name}%")
         if type:
             query += "wine.\"Type\" = %s AND "
             params.append(type)
         if elaborate:
-            query += "wine.\"Elaborate\" LIKE %s AND "
+            query += f"wine.\"Elaborate\" {like} %s AND "
             params.append(f"%{elaborate}%")
         if abv:
             query += "wine.\"ABV\" = %s AND "
@@ -107,7 +150,27 @@ class WineManager(models.Manager):
         if region_id:
             query += "wine.\"RegionID\" = %s AND "
             params.append(region_id)
+        # Search the term in the name, the best matches first
+        ranking = None
+        ranking_params = []
+        if search:
+            condition, condition_params, ranking, ranking_params = get_search_clauses('wine."WineName"', search)
+            query += f"{condition} AND "
+            params.extend(condition_params)
         query += "1=1"
+        return query, params, ranking, ranking_params
+
+    def filter_wines(self, **data):
+        """
+        Returns the wines matching the given filters, the best matches of search first, then by id.
+        The DB only returns the rows of the page, given page and page_size or the keyset bound after
+        :param data: dict of the filters, page, page_size (None for every row) and after
+        :return:
+        """
+        query, params, ranking, ranking_params = self.get_filter_query(**data)
+        query, params = add_page_clauses(query, params, 'wine.id', ranking=ranking, ranking_params=ranking_params,
+                                         page=data.get("page", 1), page_size=data.get("page_size", None),
+                                         after=data.get("after", None))
         with connection.cursor() as cursor:
             cursor.execute(query, params)
             wines = cursor.fetchall()
@@ -117,6 +180,15 @@ class WineManager(models.Manager):
         result = [dict(zip(labels, row)) for row in wines]
         return result
 
+    def count_wines(self, **data):
+        """
+        Returns the number of wines matching the given filters
+        :param data: dict
+        :return:
+        """
+        query, params, _, _ = self.get_filter_query(**data)
+        return count_rows(query, params)
+
     def update_wine(self, wine, **data):
         wine.wine_name = data.get("wine_name", wine.wine_name)
         wine.type = data.get("type", wine.type)
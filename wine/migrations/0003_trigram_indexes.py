@@ -0,0 +1,24 @@
+from django.db import migrations
+from wine_api.search import create_trigram_indexes, drop_trigram_indexes
+
+
+# Columns searched with LIKE '%term%' by the filter endpoint
+TRIGRAM_COLUMNS = ['WineName', 'Elaborate']
+
+
+def create_indexes(apps, schema_editor):
+    create_trigram_indexes(schema_editor, 'wine', TRIGRAM_COLUMNS)
+
+
+def drop_indexes(apps, schema_editor):
+    drop_trigram_indexes(schema_editor, 'wine', TRIGRAM_COLUMNS)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('wine', '0002_add_data'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -1,3 +1,162 @@
-from django.test import TestCase
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import resolve
+from rest_framework.test import APIRequestFactory, APITestCase
+from compare.datasets import CompareData, WineVectors
+from compare.delta import compare_delta
+from compare.index import CompareIndexVersion, compare_index
+from region.models import Region
+from wine.models import Wine
+from wine_api.paginators import KeysetPagination
+from winery.models import Winery
 
-# Create your tests here.
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_compare_data():
+    """
+    Compare dataset with two vintages of the WineID 7 and one of the WineID 8
+    :return:
+    """
+    keys = pd.DataFrame({'WineID': [7, 7, 8], 'Vintage': [2000, 2001, 2000]})
+    reviewed_keys = keys.iloc[[0]]
+    return CompareData(
+        pertinent_wine_ratings=keys,
+        normalized_wine_data=WineVectors(keys, np.arange(6, dtype=np.float64).reshape(3, 2)),
+        pertinent_ratings_non_null=reviewed_keys,
+        aggregated_doc_vector=WineVectors(reviewed_keys, np.ones((1, 2))),
+    )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WineUpdateTests(TestCase):
+    def setUp(self):
+        self.region = Region.objects.create(region_id=1, region_name='Bordeaux', country='France', code='FR',
+                                            latitude=44.8, longitude=-0.6)
+        self.winery = Winery.objects.create(winery_id=1, winery_name='Chateau', website='')
+        self.wine = Wine.objects.create(wine_id=7, wine_name='Grand Vin', type='Red', elaborate='Varietal/100%',
+                                        abv=13.5, body='Full-bodied', acidity='High', winery=self.winery,
+                                        region=self.region)
+        self.compare_data = make_compare_data()
+        patcher = mock.patch.object(compare_index, 'get', return_value=CompareIndexVersion(
+            None, self.compare_data, compare_model=None, fingerprint=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_put_replaces_the_rows_of_the_wine(self):
+        path = f'/api/v1/wines/{self.wine.id}/'
+        request = APIRequestFactory().put(path, {
+            'wine_name': 'Grand Vin', 'type': 'Red', 'elaborate': 'Varietal/100%', 'abv': 14.0,
+            'body': 'Full-bodied', 'acidity': 'High', 'region': self.region.id, 'winery': self.winery.id,
+        }, format='json')
+        match = resolve(path)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = match.func(request, *match.args, **match.kwargs)
+        self.assertEqual(response.status_code, 200)
+
+        # The row of the wine is updated, no new wine is created
+        self.assertEqual(Wine.objects.count(), 1)
+        self.wine.refresh_from_db()
+        self.assertEqual((self.wine.wine_id, self.wine.abv), (7, 14.0))
+
+        # Its vintages are served by the delta index, under its WineID, and its old rows are hidden
+        delta = compare_delta.get()
+        self.assertEqual(delta.keys, [(7, 2000), (7, 2001)])
+        self.assertEqual(delta.ids, [self.wine.id, self.wine.id])
+        np.testing.assert_array_equal(delta.get_main_mask(), [False, False, True])
+
+
+def get(path, **params):
+    """
+    Send a GET request to the view of a path
+    :param path:
+    :param params: query parameters
+    :return: response
+    """
+    request = APIRequestFactory().get(path, params)
+    match = resolve(path)
+    return match.func(request, *match.args, **match.kwargs)
+
+
+def get_after(next_link):
+    """
+    After token of the link to the next page
+    :param next_link:
+    :return:
+    """
+    return parse_qs(urlparse(next_link).query)['after'][0]
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WineFilterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        region = Region.objects.create(region_id=1, region_name='Bordeaux', country='France', code='FR',
+                                       latitude=44.8, longitude=-0.6)
+        winery = Winery.objects.create(winery_id=1, winery_name='Chateau', website='')
+        # Created in another order than their ranking by search
+        self.wines = [Wine.objects.create(wine_id=wine_id, wine_name=wine_name, type=wine_type,
+                                          elaborate='Varietal/100%', abv=13.5, body='Full-bodied', acidity='High',
+                                          winery=winery, region=region)
+                      for wine_id, wine_name, wine_type in [
+                          (1, 'Chateau Margaux', 'Red'), (2, 'Le Petit Margaux', 'Red'), (3, 'Margaux Reserve', 'Red'),
+                          (4, 'Pavillon Blanc', 'White'), (5, 'Margaux', 'Red')]]
+        self.ids = [wine.id for wine in self.wines]
+
+    def test_pages_and_count(self):
+        response = get('/api/v1/wines/filter/', page=2, page_size=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([wine['id'] for wine in response.data], self.ids[2:4])
+        self.assertFalse(response.has_header('X-Total-Count'))
+
+        response = get('/api/v1/wines/filter/', page_size='all', count='true')
+        self.assertEqual([wine['id'] for wine in response.data], self.ids)
+        self.assertEqual(response['X-Total-Count'], '5')
+
+        # The count is the number of rows matching the filters, not of the page
+        response = get('/api/v1/wines/filter/', type='Red', page_size=1, count='true')
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response['X-Total-Count'], '4')
+
+    def test_search_ranks_exact_and_prefix_matches_first(self):
+        response = get('/api/v1/wines/filter/', search='margaux', page_size='all', count='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([wine['wine_name'] for wine in response.data],
+                         ['Margaux', 'Margaux Reserve', 'Chateau Margaux', 'Le Petit Margaux'])
+        self.assertEqual(response['X-Total-Count'], '4')
+
+    def test_keyset_pages(self):
+        for path in ['/api/v1/wines/filter/', '/api/v1/wines/']:
+            ids = []
+            after = ''
+            while True:
+                response = get(path, after=after, page_size=2)
+                self.assertEqual(response.status_code, 200, path)
+                self.assertLessEqual(len(response.data['results']), 2)
+                ids += [wine['id'] for wine in response.data['results']]
+                if response.data['next'] is None:
+                    break
+                after = get_after(response.data['next'])
+            self.assertEqual(ids, self.ids, path)
+
+        response = get('/api/v1/wines/filter/', after='', type='White', page_size=2)
+        self.assertEqual([wine['id'] for wine in response.data['results']], self.ids[3:4])
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_after_tokens(self):
+        for path in ['/api/v1/wines/filter/', '/api/v1/wines/']:
+            self.assertEqual(get(path, after='not a token').status_code, 400, path)
+            self.assertEqual(get(path, after=KeysetPagination.encode_cursor(1)[:-2]).status_code, 400, path)
+
+    def test_search_is_not_paged_with_after(self):
+        # The results of a search are not sorted by id
+        self.assertEqual(get('/api/v1/wines/filter/', after='', search='margaux').status_code, 400)
+
+    def test_invalid_pages(self):
+        self.assertEqual(get('/api/v1/wines/filter/', page=0).status_code, 400)
+        self.assertEqual(get('/api/v1/wines/filter/', page_size='many').status_code, 400)
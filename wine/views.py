@@ -13,7 +13,9 @@ from rest_framework.parsers import JSONParser
 from rest_framework.permissions import AllowAny
 from django.http import JsonResponse, HttpResponse
 from django.core.cache import cache
+from django.db import transaction
 from wine_api.settings import CACHE_TTL
+from compare.delta import compare_delta, update_compare_index
 import json
 
 
@@ -24,6 +26,8 @@ class WineList(SecondListView, CreateView):
     queryset = Wine.objects.all()
     serializer_class = WineSerializer
     permission_classes = [AllowAny]
+    keyset_manager_method = 'get_wines'
+    keyset_serializer_class = SecondWineSerializer
 
     def get_queryset(self):
         page = self.request.query_params.get('page', '1')
@@ -61,11 +65,16 @@ class WineList(SecondListView, CreateView):
         data = JSONParser().parse(request)
         serializer = WineSerializer(data=data)
         if serializer.is_valid():
-            serializer.save()
+            self.perform_create(serializer)
             return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
         return JsonResponse(serializer.errors,
                             status=status.HTTP_400_BAD_REQUEST)
 
+    def perform_create(self, serializer):
+        serializer.save()
+        # Make the wine searchable by compare_wine before the compare index is rebuilt
+        update_compare_index(serializer.instance)
+
 
 class WineDetail(RetrieveView, UpdateView, DestroyView):
     """
@@ -87,17 +96,28 @@ class WineDetail(RetrieveView, UpdateView, DestroyView):
 
     def put(self, request, *args, **kwargs):
         data = JSONParser().parse(request)
-        serializer = WineSerializer(data=data)
+        serializer = WineSerializer(self.get_object(), data=data)
         if serializer.is_valid():
-            serializer.save()
+            self.perform_update(serializer)
             return JsonResponse(serializer.data)
         return JsonResponse(serializer.errors,
                             status=status.HTTP_400_BAD_REQUEST)
 
+    def perform_update(self, serializer):
+        serializer.save()
+        # The wine replaces its previous vintages in compare_wine, its rows of the compare dataset are hidden
+        update_compare_index(serializer.instance)
+
     def delete(self, request, *args, **kwargs):
-        Wine.objects.delete_wine(request.wine)
+        self.perform_destroy(request.wine)
         return HttpResponse(status=status.HTTP_204_NO_CONTENT)
 
+    def perform_destroy(self, instance):
+        # The wine is removed from compare_wine with it, its rows of the compare dataset are hidden
+        with transaction.atomic():
+            compare_delta.remove_wine(instance)
+            Wine.objects.delete_wine(instance)
+
 
 class WineFilter(ListView):
     """
@@ -115,6 +135,7 @@ class WineFilter(ListView):
         acidity = self.request.query_params.get('acidity', None)
         winery_id = self.request.query_params.get('winery_id', None)
         region_id = self.request.query_params.get('region_id', None)
+        search = self.request.query_params.get('search', None)
         data = {
             "wine_name": wine_name,
             "type": type,
@@ -124,8 +145,9 @@ class WineFilter(ListView):
             "acidity": acidity,
             "winery_id": winery_id,
             "region_id": region_id,
+            "search": search,
         }
-        # Get list of wines matching the given filters
-        list_wines = Wine.objects.filter_wines(**data)
+        # Get the page of wines matching the given filters
+        list_wines = self.get_page(Wine.objects.filter_wines, Wine.objects.count_wines, **data)
         # Serialize list of wines
         return list_wines
@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class GroupedArrays:
+    """
+    Columns of a dataframe sorted by a key, with the offsets of the rows of every key.
+    The rows of a key are returned as zero-copy slices of contiguous NumPy arrays.
+    """
+
+    def __init__(self, df, key: str, columns: list):
+        """
+        Constructor
+        :param df: dataframe
+        :param key: column to group the rows by
+        :param columns: columns to keep
+        """
+        keys = df[key].to_numpy()
+        # Stable sort to keep the order of the rows of a key
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        self.columns = {}
+        for column in columns:
+            array = np.ascontiguousarray(df[column].to_numpy()[order])
+            array.setflags(write=False)
+            self.columns[column] = array
+        self.keys, starts = np.unique(sorted_keys, return_index=True)
+        stops = np.r_[starts[1:], len(sorted_keys)]
+        self.offsets = dict(zip(self.keys.tolist(), zip(starts.tolist(), stops.tolist())))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def get(self, key, column: str):
+        """
+        Get the values of a column for a key
+        :param key:
+        :param column:
+        :return: read-only array, empty if the key is missing
+        """
+        start, stop = self.offsets.get(key, (0, 0))
+        return self.columns[column][start:stop]
@@ -1,20 +1,163 @@
+import base64
+import binascii
+from django.db import connection
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPagination(PageNumberPagination):
-    def paginate_queryset(self, queryset, request, view=None):
-        page_size = request.query_params.get('page_size', 10)
-        if page_size == 'all':
-            page_size = queryset.count()
-        self.page_size = page_size
-        page_num = request.query_params.get('page', 1)
-        self.page_number = page_num
+    """
+    Pagination of the filter endpoints. The view reads the page of the request with get_page_params
+    and selects its rows in SQL, with LIMIT and OFFSET or with the keyset bound of after,
+    so the rows of the other pages are never fetched.
+    With count=true, the number of matching rows is returned in the X-Total-Count header.
+    """
+    count_query_param = 'count'
+
+    def get_page_params(self, request):
+        """
+        Get the page of the request
+        :param request:
+        :return: dict of page, page_size (None for every row) and after (None without keyset pagination)
+        """
+        self.request = request
+        self.count = None
+        self.with_count = request.query_params.get(self.count_query_param, 'false').lower() in ['true', '1']
+        keyset_pagination = KeysetPagination()
+        self.keyset = keyset_pagination.after_query_param in request.query_params
+        page_size = request.query_params.get('page_size', '10')
         try:
-            return super().paginate_queryset(queryset, request, view=view)
-        except NotFound:
-            return []
+            page = int(request.query_params.get('page', '1'))
+            page_size = None if page_size == 'all' else int(page_size)
+        except ValueError:
+            raise ValidationError('page and page_size must be integers, page_size can also be all')
+        if page < 1:
+            raise ValidationError('Page must be greater than 0')
+        if page_size is not None and page_size < 1:
+            raise ValidationError('Page size must be greater than 0')
+        self.page_size = page_size
+        if not self.keyset:
+            return {'page': page, 'page_size': page_size, 'after': None}
+        # One more row tells that there is a next page
+        return {'page': 1, 'page_size': page_size + 1 if page_size is not None else None,
+                'after': keyset_pagination.get_after(request)}
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # The rows are already the page
+        return list(queryset)
 
     def get_paginated_response(self, data):
-        return Response(data)
+        if self.keyset:
+            response = KeysetPagination().get_paginated_response(self.request, data, self.page_size or len(data))
+        else:
+            response = Response(data)
+        if self.count is not None:
+            response['X-Total-Count'] = self.count
+        return response
+
+
+class KeysetPagination:
+    """
+    Pagination on the primary key: a page holds the rows with an id greater than the id of the after token.
+    The DB seeks the first row through the primary key index instead of reading and discarding the previous pages,
+    so every page has the same cost. An empty after token returns the first page.
+    """
+    after_query_param = 'after'
+    page_size_query_param = 'page_size'
+    page_size = 10
+
+    @staticmethod
+    def encode_cursor(id):
+        """
+        Opaque token of the rows after an id
+        :param id:
+        :return:
+        """
+        return base64.urlsafe_b64encode(f'id:{id}'.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode_cursor(token):
+        """
+        Id of an after token, 0 for an empty token
+        :param token:
+        :return:
+        """
+        if not token:
+            return 0
+        try:
+            prefix, id = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8').split(':')
+            if prefix != 'id':
+                raise ValueError(prefix)
+            return int(id)
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            raise ValidationError('after must be a token returned in next')
+
+    def get_after(self, request):
+        return self.decode_cursor(request.query_params.get(self.after_query_param, ''))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            raise ValidationError('page_size must be an integer with after')
+        if page_size < 1:
+            raise ValidationError('Page size must be greater than 0')
+        return page_size
+
+    def get_paginated_response(self, request, rows, page_size):
+        """
+        Response of a page, with the link to the next page
+        :param request:
+        :param rows: up to page_size + 1 rows sorted by id, the last one only tells that there is a next page
+        :param page_size:
+        :return:
+        """
+        next_link = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_link = replace_query_param(request.build_absolute_uri(), self.after_query_param,
+                                            self.encode_cursor(rows[-1]['id']))
+        return Response({'next': next_link, 'results': rows})
+
+
+def add_page_clauses(query, params, id_column, ranking=None, ranking_params=(), page=1, page_size=None, after=None):
+    """
+    Add the keyset bound, the ordering and the page to a query ending with its WHERE conditions,
+    so the DB only returns the rows of the page
+    :param query:
+    :param params:
+    :param id_column: primary key of the rows
+    :param ranking: ORDER BY expression of a search, None to sort by id
+    :param ranking_params:
+    :param page:
+    :param page_size: None for every row
+    :param after: id of the last row of the previous page for keyset pagination, None to use page
+    :return: tuple of query, params
+    """
+    params = list(params)
+    if after is not None:
+        if ranking is not None:
+            raise ValidationError('after cannot be used with search, the results are not sorted by id')
+        # The DB seeks the first row through the primary key index
+        query += f" AND {id_column} > %s"
+        params.append(after)
+    query += f" ORDER BY {ranking + ', ' if ranking else ''}{id_column} ASC"
+    params += ranking_params
+    if page_size is not None:
+        query += " LIMIT %s OFFSET %s"
+        params += [page_size, (page - 1) * page_size if after is None else 0]
+    return query, params
+
+
+def count_rows(query, params):
+    """
+    Count the rows of a query in the DB
+    :param query:
+    :param params:
+    :return:
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM ({query}) AS counted", params)
+        return cursor.fetchone()[0]
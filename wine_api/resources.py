@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss():
+    """
+    Resident set size of the current process in bytes
+    :return:
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SharedResource:
+    """
+    Resource loaded once per process and shared between requests.
+    Subclasses implement ``load`` and return the loaded value.
+    """
+
+    name = 'resource'
+
+    def __init__(self, *paths, watch=False):
+        """
+        Constructor
+        :param paths: files the resource is loaded from
+        :param watch: reload the resource when one of the files changes on disk
+        """
+        self.paths = [str(path) for path in paths]
+        self.watch = watch
+        self.load_time = None
+        self.loaded_at = None
+        self._value = None
+        self._mtimes = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        raise NotImplementedError
+
+    @property
+    def is_loaded(self):
+        return self._value is not None
+
+    def get(self):
+        """
+        Return the loaded resource, loading it on first use
+        :return:
+        """
+        value = self._value
+        if value is not None and not (self.watch and self.has_changed()):
+            return value
+        with self._lock:
+            if self._value is None or (self.watch and self.has_changed()):
+                self._reload()
+            return self._value
+
+    def reload(self):
+        """
+        Force the resource to be loaded again from disk
+        :return:
+        """
+        with self._lock:
+            self._reload()
+        return self._value
+
+    def has_changed(self):
+        return self._mtimes != self._get_mtimes()
+
+    def _get_mtimes(self):
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _reload(self):
+        mtimes = self._get_mtimes()
+        start_time = time.perf_counter()
+        value = self.load()
+        self.load_time = time.perf_counter() - start_time
+        self.loaded_at = time.time()
+        self._mtimes = mtimes
+        self._value = value
+        logger.info(f'Loaded {self.name} in {self.load_time * 1000:.1f} ms')
@@ -0,0 +1,60 @@
+from django.db import connection
+
+
+def is_postgresql():
+    return connection.vendor == 'postgresql'
+
+
+def get_trigram_index_name(table, column):
+    return f'{table}_{column.lower()}_trgm'
+
+
+def create_trigram_indexes(schema_editor, table, columns):
+    """
+    Create the pg_trgm GIN indexes used by ILIKE '%term%' and by the fuzzy search of the filter endpoints.
+    Other databases have no trigram indexes and are searched by a sequential scan.
+    :param schema_editor:
+    :param table:
+    :param columns: names of the columns in the DB
+    :return:
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in columns:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {get_trigram_index_name(table, column)} '
+                              f'ON {table} USING gin ("{column}" gin_trgm_ops)')
+
+
+def drop_trigram_indexes(schema_editor, table, columns):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in columns:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {get_trigram_index_name(table, column)}')
+
+
+def get_like_operator():
+    """
+    Case-insensitive LIKE operator, ILIKE uses the trigram indexes on Postgres.
+    LIKE is already case-insensitive for ASCII on SQLite and with the default collations of MySQL.
+    :return:
+    """
+    return 'ILIKE' if is_postgresql() else 'LIKE'
+
+
+def get_search_clauses(column, term):
+    """
+    SQL condition and ranking of a search of a term in a column.
+    On Postgres, the rows containing the term or with a word similar to it (pg_trgm word similarity) match,
+    ranked by similarity. Elsewhere, the rows containing the term match, exact matches first then prefixes.
+    The parameters of the condition go in the WHERE clause, those of the ranking in the ORDER BY clause.
+    :param column: quoted column
+    :param term:
+    :return: tuple of condition, condition params, ranking, ranking params
+    """
+    if is_postgresql():
+        return (f'({column} ILIKE %s OR %s <%% {column})', [f'%{term}%', term],
+                f'word_similarity(%s, {column}) DESC, similarity(%s, {column}) DESC', [term, term])
+    return (f'{column} LIKE %s', [f'%{term}%'],
+            f'CASE WHEN LOWER({column}) = LOWER(%s) THEN 0 WHEN {column} LIKE %s THEN 1 ELSE 2 END, '
+            f'LENGTH({column})', [term, f'{term}%'])
@@ -173,6 +173,41 @@ CACHES = {
     }
 }
 
+# Models
+# Load the models and datasets when a serving process starts (wsgi.py) instead of on the first request
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', 'False') == 'True'
+
+# Maximum number of (wine_id, batch_vintage, rating_year) items of a batch prediction
+PREDICT_BATCH_MAX_ITEMS = int(os.environ.get('PREDICT_BATCH_MAX_ITEMS', '1000'))
+
+# Micro-batching of concurrent predictions, disabled when the window is 0
+# Requests arriving within the window are run as one batch of at most PREDICT_MICRO_BATCH_MAX_SIZE rows
+PREDICT_MICRO_BATCH_WINDOW_MS = float(os.environ.get('PREDICT_MICRO_BATCH_WINDOW_MS', '0'))
+PREDICT_MICRO_BATCH_MAX_SIZE = int(os.environ.get('PREDICT_MICRO_BATCH_MAX_SIZE', '64'))
+
+# Maximum size in bytes of the features cached by the prediction data processor
+PREDICT_FEATURE_CACHE_MAX_BYTES = int(os.environ.get('PREDICT_FEATURE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Forecast
+# TimeGPT client, "nixtla" for the remote API or "stub" for a local client used for testing
+TIMEGPT_CLIENT = os.environ.get('TIMEGPT_CLIENT', 'nixtla')
+# Time in seconds during which the validation of an api_key is reused
+TIMEGPT_TOKEN_TTL = int(os.environ.get('TIMEGPT_TOKEN_TTL', '300'))
+# Time in seconds a worker waits for the forecast computed by another worker
+FORECAST_LOCK_TIMEOUT = int(os.environ.get('FORECAST_LOCK_TIMEOUT', '60'))
+# Default forecasting backend, "timegpt" for the TimeGPT API or "local" for the local NumPy engine
+FORECAST_BACKEND = os.environ.get('FORECAST_BACKEND', 'timegpt')
+# Method of the local engine, "holt_winters" or "seasonal_naive"
+LOCAL_FORECAST_METHOD = os.environ.get('LOCAL_FORECAST_METHOD', 'holt_winters')
+# Maximum number of (region, field) series of a batch forecast
+FORECAST_BATCH_MAX_SERIES = int(os.environ.get('FORECAST_BATCH_MAX_SERIES', '2000'))
+
+# Number of similar wines cached by compare_wine for a wine and a vintage, smaller nb_wines are sliced from them
+COMPARE_CACHE_DEPTH = int(os.environ.get('COMPARE_CACHE_DEPTH', '50'))
+
+# Maximum number of wines of list_vintages_batch
+LIST_VINTAGES_BATCH_MAX_WINES = int(os.environ.get('LIST_VINTAGES_BATCH_MAX_WINES', '1000'))
+
 # Logging
 # https://docs.djangoproject.com/en/3.2/topics/logging/
 
@@ -195,14 +230,31 @@ LOGGING = {
             'class': 'wine_api.handlers.RequestHandler',
             # Save the log file by date
             'filename': f'{BASE_DIR}/logs/{datetime.datetime.now().strftime("%Y%m%d")}.log',
-        }
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+            'formatter': 'verbose',
+        },
     },
     'loggers': {
         'wine_api.log_middleware.api_log_middleware': {
             'handlers': ['request'],
             'level': 'INFO',
             'propagate': True,
-        }
+        },
+        'wine_api.resources': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'predict': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'compare': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     },
 
 }
@@ -1,10 +1,13 @@
 import os
 
+import json
+
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 from rest_framework.viewsets import GenericViewSet
 from rest_framework import mixins
-from wine_api.paginators import CustomPagination
+from wine_api.paginators import CustomPagination, KeysetPagination
 from django.http import JsonResponse, HttpResponseNotFound
 from django.views.static import serve
 
@@ -33,11 +36,55 @@ class ListView(mixins.ListModelMixin, GenericViewSet):
     def get_queryset(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
+    def get_page(self, filter_rows, count_rows, **data):
+        """
+        Get the rows of the page of the request matching the filters, selected by the DB
+        :param filter_rows: manager method returning the rows of a page
+        :param count_rows: manager method returning the number of rows, called with count=true
+        :param data: filters
+        :return:
+        """
+        data.update(self.paginator.get_page_params(self.request))
+        if self.paginator.with_count:
+            self.paginator.count = count_rows(**data)
+        return filter_rows(**data)
+
 
 class SecondListView(mixins.ListModelMixin, GenericViewSet):
+    keyset_pagination_class = KeysetPagination
+    # Name of the manager method returning the rows after an id, and serializer of the rows
+    keyset_manager_method = None
+    keyset_serializer_class = None
+
     def get_queryset(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
+    def list(self, request, *args, **kwargs):
+        # Keyset pagination when the after parameter is given, page and page_size otherwise
+        paginator = self.keyset_pagination_class()
+        if paginator.after_query_param not in request.query_params:
+            return super().list(request, *args, **kwargs)
+        page_size = paginator.get_page_size(request)
+        rows = self.get_keyset_page(paginator.get_after(request), page_size + 1)
+        return paginator.get_paginated_response(request, rows, page_size)
+
+    def get_keyset_page(self, after, limit):
+        """
+        Get the rows with an id greater than after, sorted by id
+        :param after: id of the last row of the previous page, 0 for the first page
+        :param limit: maximum number of rows
+        :return: list of serialized rows
+        """
+        model = self.queryset.model
+        cache_key = f'{model._meta.model_name}_list_after_{after}_{limit}'
+        cached_data = cache.get(cache_key)
+        if cached_data is not None:
+            return json.loads(cached_data)
+        returned_data = getattr(model.objects, self.keyset_manager_method)(after=after, page_size=limit)
+        serializer = self.keyset_serializer_class(returned_data, many=True)
+        cache.set(cache_key, json.dumps(serializer.data), timeout=settings.CACHE_TTL)
+        return serializer.data
+
 
 class RetrieveView(mixins.RetrieveModelMixin, GenericViewSet):
     def get(self, request, *args, **kwargs):
@@ -9,8 +9,16 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/wsgi/
 
 import os
 
+from django.apps import apps
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wine_api.settings")
 
 application = get_wsgi_application()
+
+# Only the processes serving requests import this module, runserver in its autoreloaded child,
+# so the management commands and the autoreloader keep loading the models lazily
+if settings.PRELOAD_MODELS:
+    for app_label in ['predict', 'compare']:
+        apps.get_app_config(app_label).preload()
@@ -1,6 +1,8 @@
 from django.db import models
 from rest_framework import exceptions
 from django.db import connection
+from wine_api.paginators import add_page_clauses, count_rows
+from wine_api.search import get_like_operator, get_search_clauses
 import datetime
 
 
@@ -29,14 +31,23 @@ class WineryManager(models.Manager):
             raise exceptions.ValidationError("Page must be greater than 0")
         if page_size < 1:
             raise exceptions.ValidationError("Page size must be greater than 0")
-        offset = (page - 1) * page_size
-        query = """
+        after = data.get("after", None)
+        if after is None:
+            # Page mode, the DB reads and discards the rows of the previous pages
+            where = ""
+            params = [page_size, (page - 1) * page_size]
+        else:
+            # Keyset mode, the DB seeks the first row through the primary key index
+            where = "WHERE id > %s"
+            params = [after, page_size, 0]
+        query = f"""
             SELECT id, "WineryID", created_at, updated_at, "WineryName", "Website" FROM winery
+            {where}
             ORDER BY id ASC
             LIMIT %s OFFSET %s
         """
         with connection.cursor() as cursor:
-            cursor.execute(query, [page_size, offset])
+            cursor.execute(query, params)
             wineries = cursor.fetchall()
         labels = ["id", "winery_id", "created_at", "updated_at", "winery_name", "website"]
         result = [dict(zip(labels, winery)) for winery in wineries]
@@ -53,25 +64,47 @@ class WineryManager(models.Manager):
         """
         return self.filter(winery_name__icontains=winery_name)
 
-    def filter_wineries(self, **data):
+    def get_filter_query(self, **data):
         """
-        Returns all wineries matching the given filters
+        Returns the query of the wineries matching the given filters, without ordering, and the ranking of the search
         :param data: dict
-        :return:
+        :return: tuple of query, params, ranking (None without search), ranking params
         """
         winery_name = data.get("winery_name", None)
         website = data.get("website", None)
+        search = data.get("search", None)
 
         query = """SELECT id, "WineryID", created_at, updated_at, "WineryName", "Website" FROM winery WHERE """
-        # Add parameters not None to list
+        # Add parameters not None to list, the text columns are matched case-insensitively
+        like = get_like_operator()
         params = []
         if winery_name:
-            query += "\"WineryName\" LIKE %s AND "
+            query += f"\"WineryName\" {like} %s AND "
             params.append(f"%{winery_name}%")
         if website:
-            query += "\"Website\" LIKE %s AND "
+            query += f"\"Website\" {like} %s AND "
             params.append(f"%{website}%")
+        # Search the term in the name, the best matches first
+        ranking = None
+        ranking_params = []
+        if search:
+            condition, condition_params, ranking, ranking_params = get_search_clauses('"WineryName"', search)
+            query += f"{condition} AND "
+            params.extend(condition_params)
         query += "1 = 1"
+        return query, params, ranking, ranking_params
+
+    def filter_wineries(self, **data):
+        """
+        Returns the wineries matching the given filters, the best matches of search first, then by id.
+        The DB only returns the rows of the page, given page and page_size or the keyset bound after
+        :param data: dict of the filters, page, page_size (None for every row) and after
+        :return:
+        """
+        query, params, ranking, ranking_params = self.get_filter_query(**data)
+        query, params = add_page_clauses(query, params, 'id', ranking=ranking, ranking_params=ranking_params,
+                                         page=data.get("page", 1), page_size=data.get("page_size", None),
+                                         after=data.get("after", None))
         with connection.cursor() as cursor:
             cursor.execute(query, params)
             wineries = cursor.fetchall()
@@ -79,6 +112,15 @@ class WineryManager(models.Manager):
         result = [dict(zip(labels, winery)) for winery in wineries]
         return result
 
+    def count_wineries(self, **data):
+        """
+        Returns the number of wineries matching the given filters
+        :param data: dict
+        :return:
+        """
+        query, params, _, _ = self.get_filter_query(**data)
+        return count_rows(query, params)
+
     def update_winery(self, winery, **data):
         winery.winery_name = data.get("winery_name", winery.winery_name)
         winery.website = data.get("website", winery.website)
@@ -29,6 +29,8 @@ class WineryList(SecondListView, CreateView):
     queryset = Winery.objects.all()
     serializer_class = WinerySerializer
     permission_classes = [AllowAny]
+    keyset_manager_method = 'get_wineries'
+    keyset_serializer_class = WinerySerializer
 
     def get_queryset(self):
         page = self.request.query_params.get('page', '1')
@@ -101,9 +103,11 @@ class WineryFilter(ListView):
     def get_queryset(self):
         winery_name = self.request.query_params.get('winery_name', None)
         website = self.request.query_params.get('website', None)
+        search = self.request.query_params.get('search', None)
         data = {
             "winery_name": winery_name,
-            "website": website
+            "website": website,
+            "search": search
         }
-        list_wineries = Winery.objects.filter_wineries(**data)
+        list_wineries = self.get_page(Winery.objects.filter_wineries, Winery.objects.count_wineries, **data)
         return list_wineries
\ No newline at end of file